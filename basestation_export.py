@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+from datetime import datetime, timezone
+import argparse
+import logging
+import sys
+
+import psycopg2
+
+# used to read the config file for postgreql - database.ini
+from config import config_new
+
+from classes.readingExport import readingExport
+
+
+version = '1.dev.1'
+
+parser = argparse.ArgumentParser(
+    description="Export weather_reading for a station as csv or parquet")
+
+
+parser.add_argument("--debug", help="helps us debug",
+                    action="store_true")
+
+parser.add_argument("--station", help="Id of the station - default is '05'",
+                    default='5')
+
+parser.add_argument("--since", help="Export from this time (ISO format, UTC unless given)",
+                    required=True)
+
+parser.add_argument("--until", help="Export up to this time (ISO format, UTC unless given) - default is now",
+                    default=None)
+
+parser.add_argument("--format", help="csv (default) or parquet",
+                    choices=['csv', 'parquet'], default='csv')
+
+parser.add_argument("--output", help="File to write - default is stdout (csv only)",
+                    default=None)
+
+parser.add_argument("--imperial", help="Convert to mph, Fahrenheit, inches and inches of mercury, as sent to WOW",
+                    action="store_true")
+
+parser.add_argument("--chunk", help="Rows fetched from the database at a time - default is 10000",
+                    type=int, default=10000)
+
+parser.add_argument("--log_file", help="Location of log file - defauits to ''",
+                    default="/var/log/lora_basestation.log")
+
+parser.add_argument("--log", help="log level - suggest <info> when it is working",
+                    default="INFO")
+
+postgres_params = config_new()
+
+args = parser.parse_args()
+
+loglevel = args.log
+
+numeric_level = getattr(logging, loglevel.upper(), None)
+
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % loglevel)
+
+# initialise logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%d/%m/%Y %H:%M:%S',
+    filename=args.log_file,
+    level=numeric_level)
+
+logger = logging.getLogger(('basestation_export.py: ' + version))
+
+if args.debug:
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setLevel(logging.DEBUG)
+    # simpler formatter for console
+    formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
+    console_handler.setFormatter(formatter)
+    logging.getLogger('').addHandler(console_handler)
+    logger.debug('Running in debug mode')
+
+
+def time_arg(value):
+    # --since / --until to an aware datetime
+    if value is None:
+        return datetime.now(timezone.utc)
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when
+
+
+def main():
+    logger.info('basestation_export.py %s', version)
+
+    station_id = int(args.station)
+    since = time_arg(args.since)
+    until = time_arg(args.until)
+
+    export = readingExport(args.chunk, args.imperial, **postgres_params)
+
+    try:
+        if args.format == 'parquet':
+            if not args.output:
+                print('Error - parquet exports need --output')
+                return
+            rows = export.to_parquet(args.output, station_id, since, until)
+        elif args.output:
+            with open(args.output, 'w', newline='') as out:
+                rows = export.to_csv(out, station_id, since, until)
+        else:
+            rows = export.to_csv(sys.stdout, station_id, since, until)
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error("Export failed")
+        logger.error(error)
+        raise
+
+    logger.info('Exported %d readings for station %d', rows, station_id)
+
+
+if __name__ == '__main__':
+    main()
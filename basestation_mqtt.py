@@ -1,32 +1,18 @@
 #!/usr/bin/env python3
 
-import serial
-import time
-#import datetime
-from datetime import datetime
-from datetime import timedelta
-import pytz
-import math
+# Only what every action needs is imported here - the heavy modules
+# (psycopg2, paho, numpy via the classes) are imported by the actions that
+# use them, so --help and the one-shot downlinks cron runs start quickly
+# (see python -m bench.run_bench --only startup)
+import re
+import json
 import argparse
 import logging
-from time import sleep
-import binascii
-import psycopg2
-
-from configparser import ConfigParser
-
-import io
-import os
-import sys
-import re
-
-# used to read the config file for postgreql - database.ini
-from config import config_new
-from config import config_mqtt
-
-from classes.thingsNetwork import weatherStation
+from datetime import datetime
+from datetime import timezone
 
-from classes.thingsNetwork import ttnMQTT
+# config.ini - parsed once, environment overrides, reloaded on SIGHUP
+from classes.basestationConfig import get_config
 
 version = '2.dev.2'
 
@@ -44,10 +30,25 @@ parser.add_argument("--interactive", help="Prompt for action rather than the loo
 parser.add_argument("--station", help="Id of the station - default is '05'. Only matters for downlinks",
                    default='5')
 
-parser.add_argument("--action", help ="L(isten), listen and (C)ommit,"  +
-                    " update station (D)etails, (R)eboot, C(o)nfirm station data, (Q)uit. Batch mode only",
+parser.add_argument("--action", help ="L(isten), listen and (C)ommit, listen and commit (A)sync,"  +
+                    " update station (D)etails, (R)eboot, C(o)nfirm station data, re(P)lay archive, (S)pool status, (Q)uit. Batch mode only",
                     default = 'l')
 
+parser.add_argument("--stations", help="Downlinks (T, D, O, R) go to these station ids (comma separated) or 'all', over one connection. Default is DEVICE_ID in [mqtt]",
+                    default=None)
+
+parser.add_argument("--queue", help="With T, D, O or R - queue the downlink for the listener to send after each station's next uplink (needs downlink_path in [ingest])",
+                    action="store_true")
+
+parser.add_argument("--archive_dir", help="Uplink archive to replay with --action P - defaults to archive_dir in [ingest]",
+                    default=None)
+
+parser.add_argument("--since", help="Replay only messages received at or after this time (ISO format, UTC if no timezone)",
+                    default=None)
+
+parser.add_argument("--until", help="Replay only messages received at or before this time (ISO format, UTC if no timezone)",
+                    default=None)
+
 parser.add_argument("--update_time", help="Send the current basestation timezone to the weather station (message type 200).",
                     action="store_true")
 
@@ -63,11 +64,19 @@ parser.add_argument("--log_file", help="Location of log file - defauits to ''",
 parser.add_argument("--log", help="log level - suggest <info> when it is working",
                     default="DEBUG")
 
-postgres_params = config_new()
+args = parser.parse_args()
+
+# config.ini is read after the arguments so --help does not need it
+basestation_config = get_config()
 
-mqtt_params = config_mqtt()
+postgres_params = basestation_config.section('postgresql')
 
-args = parser.parse_args()
+mqtt_params = basestation_config.section('mqtt')
+
+mqtt_apps = basestation_config.mqtt_apps()
+
+# typed - the numbers in [ingest] are already ints / floats
+ingest_params = basestation_config.typed('ingest')
 
 loglevel = args.log
 
@@ -115,26 +124,236 @@ station_id = int(args.station)
 # ------------------------------------------------------Main processing starts here ---------------------------------------------------------#
 
 
+def epoch_arg(value):
+    # --since / --until to epoch seconds
+    if value is None:
+        return None
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+def downlink_station():
+    # a weatherStation with just the stations the downlink is for loaded,
+    # rather than the whole table
+    from classes.thingsNetwork import weatherStation
+
+    if args.stations is None:
+        station_ids = [station_id]
+    elif args.stations.lower() == 'all':
+        station_ids = None
+    else:
+        station_ids = [station_id] + [int(sid) for sid in args.stations.split(',')]
+    return weatherStation(station_id, station_ids=station_ids, **postgres_params)
+
+
+def send_downlinks(ws, port, data_for):
+    # send one downlink per target station over a single connection and
+    # report what the broker confirmed. data_for(station id) gives the hex
+    # payload
+    if args.stations is None:
+        targets = [(station_id, mqtt_params['device_id'])]
+    else:
+        if args.stations.lower() == 'all':
+            ids = sorted(ws.stations)
+        else:
+            ids = [int(sid) for sid in args.stations.split(',')]
+        targets = []
+        for sid in ids:
+            device_id = ws.device_for_station(sid)
+            if device_id is None:
+                print('Station %d has no eu_id - skipped' % sid)
+            else:
+                targets.append((sid, device_id))
+
+    downlinks = [(device_id, port, data_for(sid)) for sid, device_id in targets]
+
+    if args.queue:
+        if not ingest_params['downlink_path']:
+            print('No downlink_path set in [ingest]')
+            return
+        from classes.downlinkScheduler import downlinkScheduler
+        scheduler = downlinkScheduler(ingest_params['downlink_path'])
+        for device_id, port, data in downlinks:
+            scheduler.add(device_id, port, data)
+            print('%s port %d: queued' % (device_id, port))
+        scheduler.close()
+        return
+
+    from classes.thingsNetwork import ttnMQTT
+    mqttc = ttnMQTT(ws, False, **mqtt_params)
+    results = mqttc.send_downlinks(downlinks)
+
+    for device_id, port, result in results:
+        print('%s port %d: %s' % (device_id, port, result))
+    logger.info("Downlinks on port %d: %d of %d confirmed", port,
+                sum(result == 'confirmed' for device_id, port, result in results),
+                len(results))
+
+
+def start_writer(ws):
+    spool = None
+    if ingest_params['spool_path']:
+        from classes.readingSpool import readingSpool
+        spool = readingSpool(ingest_params['spool_path'],
+                             ingest_params['spool_max_rows'])
+    ws.start_writer(ingest_params['batch_size'],
+                    ingest_params['flush_ms'], spool=spool)
+
+
+def start_latest(ws):
+    # keep the latest reading per station and serve it, if latest_port is set
+    if ingest_params['latest_port'] <= 0:
+        return None
+    from classes.latestCache import latestReadings, latestServer
+    ws.latest = latestReadings()
+    server = latestServer(ws.latest, ingest_params['latest_host'],
+                          ingest_params['latest_port'])
+    server.start()
+    return server
+
+
+def start_metrics():
+    # serve and/or write the metrics, as configured. Returns what was
+    # started, to stop() on the way out
+    from classes.ingestMetrics import metricsServer, metricsTextfile
+    started = []
+    if ingest_params['metrics_port'] > 0:
+        started.append(metricsServer(port=ingest_params['metrics_port']))
+    if ingest_params['metrics_textfile']:
+        started.append(metricsTextfile(ingest_params['metrics_textfile']))
+    for metrics in started:
+        metrics.start()
+    return started
+
+
+def reload_on_sighup(ws, mqttc, wow=None):
+    # SIGHUP re-reads config.ini - changed [postgresql], [mqtt] and [wow]
+    # settings are applied to the running listener without a restart
+    basestation_config.subscribe(
+        'postgresql', lambda config: ws.pool.reconfigure(**config.section('postgresql')))
+    basestation_config.subscribe(
+        'mqtt', lambda config: mqttc.reconfigure(config.mqtt_apps()))
+    if wow is not None:
+        basestation_config.subscribe(
+            'wow', lambda config: wow.reconfigure(config.section('wow')))
+    basestation_config.reload_on_sighup()
+
+
+def listen_async():
+    # listen and commit on one asyncio event loop, optionally uploading the
+    # station's latest reading to WOW every wow_interval seconds
+    from classes.thingsNetwork import weatherStation
+    from classes.asyncIngest import asyncIngest
+
+    ws = weatherStation(station_id, ingest_params['station_refresh'],
+                        **postgres_params)
+    start_writer(ws)
+    latest = start_latest(ws)
+    metrics = start_metrics()
+
+    archive = None
+    if ingest_params['archive_dir']:
+        from classes.uplinkArchive import uplinkArchive
+        archive = uplinkArchive(ingest_params['archive_dir'],
+                                ingest_params['archive_segment_mb'],
+                                ingest_params['archive_segment_hours'],
+                                ingest_params['archive_keep'])
+
+    jobs = []
+    wow = None
+    if ingest_params['wow_interval'] > 0:
+        from classes.weatherObservation import metofficeWow
+        wow = metofficeWow(station_id, basestation_config.section('wow'),
+                           **postgres_params)
+        wow.latest_cache = ws.latest  # no database round trip for the reading
+        jobs.append(('wow', ingest_params['wow_interval'],
+                     lambda: wow.latest(upload=True)))
+
+    engine = asyncIngest(ws, True, ingest_params, mqtt_apps, jobs, archive)
+    reload_on_sighup(ws, engine, wow)
+    try:
+        engine.run()
+    finally:
+        if latest is not None:
+            latest.stop()
+        for server in metrics:
+            server.stop()
+        ws.close() # writes any buffered readings
+
+
+def replay():
+    # Stream an uplink archive back through decode and the batch writer.
+    # Rows are upserted on (station_id, reading_time) so a replay can be run
+    # more than once, e.g. after a decoder fix
+    from classes.thingsNetwork import weatherStation
+    from classes.uplinkArchive import uplinkArchive
+
+    archive_dir = args.archive_dir or ingest_params['archive_dir']
+    if not archive_dir:
+        print('Error - no archive directory (--archive_dir or archive_dir in [ingest])')
+        return
+
+    archive = uplinkArchive(archive_dir)
+    ws = weatherStation(station_id, **postgres_params)
+    ws.start_writer(1000, ingest_params['flush_ms'], upsert=True)
+
+    messages = 0
+    errors = 0
+    try:
+        for received, payload in archive.replay(epoch_arg(args.since),
+                                                epoch_arg(args.until)):
+            messages += 1
+            try:
+                data = ws.parse_data(json.loads(payload))
+                if 'No payload' not in data:
+                    ws.commit_data(data)
+            except Exception as error:
+                errors += 1
+                logger.error("Unable to replay message received %s: %s",
+                             datetime.fromtimestamp(received, timezone.utc), error)
+    finally:
+        ws.close()
+
+    logger.info("Replayed %d messages from %s, %d errors", messages,
+                archive_dir, errors)
+
+
 def main():
 
     logger.debug('basestation_mqtt.py %s', version)
 
     if args.interactive:
         logger.info("Running in interactive mode")
-        main_prompt = 'L(isten), listen and (C)ommit, send (T)ime, update station (D)etails, C(o)nfirm station data, (R)eboot, (Q)uit: '
+        main_prompt = 'L(isten), listen and (C)ommit, listen and commit (A)sync, send (T)ime, update station (D)etails, C(o)nfirm station data, (R)eboot, re(P)lay archive, (S)pool status, (Q)uit: '
         action = input(main_prompt)
     else:
         logger.info("Running in batch mode")
         action = args.action
     
     if (action.upper() == 'L' or action.upper() == 'C'):
+        from classes.thingsNetwork import weatherStation, ttnMQTT
         commit = (action.upper() == 'C')
-        ws = weatherStation(station_id,**postgres_params)
-        mqttc = ttnMQTT(ws, commit, **mqtt_params)
-        mqttc.process_link(direction = 'UPLINK') # runs forever UPLINKs are device > TTN
+        ws = weatherStation(station_id, ingest_params['station_refresh'],
+                            **postgres_params)
+        if commit:
+            start_writer(ws)
+        latest = start_latest(ws)
+        metrics = start_metrics()
+        mqttc = ttnMQTT(ws, commit, ingest_params, mqtt_apps, **mqtt_params)
+        reload_on_sighup(ws, mqttc)
+        try:
+            mqttc.process_link(direction = 'UPLINK') # runs forever UPLINKs are device > TTN
+        finally:
+            if latest is not None:
+                latest.stop()
+            for server in metrics:
+                server.stop()
+            ws.close() # writes any buffered readings
         
     elif action.upper().startswith('T'):
-        ws = weatherStation(station_id, **postgres_params)
+        ws = downlink_station()
         if len(action) > 1:
             # The string includes a seconds correction - get it
             seconds_correct = int(re.findall(r'-?\d+', action) [0])
@@ -142,26 +361,36 @@ def main():
             seconds_correct = 0    
         
         offset_message = ws.sync_time(seconds_correct)
-        #breakpoint()
-        
-        mqttc = ttnMQTT(ws, False, **mqtt_params)
-        mqttc.process_link(direction = 'DOWNLINK', data = offset_message, port = 200)
+        send_downlinks(ws, 200, lambda sid: offset_message)
         
     elif action.upper() == 'D':
-        ws = weatherStation(station_id,**postgres_params)
-        stationdata_message = ws.send_data()
-        mqttc = ttnMQTT(ws, False, **mqtt_params)
-        mqttc.process_link(direction = 'DOWNLINK', data = stationdata_message, port = 201)
+        ws = downlink_station()
+        send_downlinks(ws, 201, ws.send_data)
     
     elif action.upper() == 'O':
-        ws = weatherStation(station_id,**postgres_params)
-        mqttc = ttnMQTT(ws, False, **mqtt_params)
-        mqttc.process_link(direction = 'DOWNLINK', data = '', port = 202)
+        ws = downlink_station()
+        send_downlinks(ws, 202, lambda sid: '')
     
     elif action.upper() == 'R':
-        ws = weatherStation(station_id,**postgres_params)
-        mqttc = ttnMQTT(ws, False, **mqtt_params)
-        mqttc.process_link(direction = 'DOWNLINK', data = '', port = 203)
+        ws = downlink_station()
+        send_downlinks(ws, 203, lambda sid: '')
+
+    elif action.upper() == 'A':
+        listen_async() # runs until SIGINT / SIGTERM
+
+    elif action.upper() == 'P':
+        replay()
+
+    elif action.upper() == 'S':
+        # readings waiting in the write-ahead spool
+        if not ingest_params['spool_path']:
+            print('No spool_path set in [ingest]')
+        else:
+            from classes.readingSpool import readingSpool
+            spool = readingSpool(ingest_params['spool_path'],
+                                 ingest_params['spool_max_rows'])
+            print(spool.status())
+            spool.close()
 
     elif action.upper() == 'Q':
         exit()
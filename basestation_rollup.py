@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+from datetime import datetime, timezone
+import argparse
+import logging
+
+# used to read the config file for postgreql - database.ini
+from config import config_new
+
+from classes.weatherRollup import weatherRollup
+
+
+version = '1.dev.1'
+
+parser = argparse.ArgumentParser(
+    description="Rebuild the hourly / daily rollups of weather_reading from history")
+
+
+parser.add_argument("--debug", help="helps us debug",
+                    action="store_true")
+
+parser.add_argument("--station", help="Only rebuild these station ids (comma separated) - default is all stations",
+                    default=None)
+
+parser.add_argument("--since", help="Rebuild from this time (ISO format, UTC unless given) - default is the first reading",
+                    default=None)
+
+parser.add_argument("--until", help="Rebuild up to this time (ISO format, UTC unless given) - default is the last reading",
+                    default=None)
+
+parser.add_argument("--days", help="Days to rebuild per transaction - default is 1",
+                    type=int, default=1)
+
+parser.add_argument("--log_file", help="Location of log file - defauits to ''",
+                    default="/var/log/lora_basestation.log")
+
+parser.add_argument("--log", help="log level - suggest <info> when it is working",
+                    default="INFO")
+
+postgres_params = config_new()
+
+args = parser.parse_args()
+
+loglevel = args.log
+
+numeric_level = getattr(logging, loglevel.upper(), None)
+
+if not isinstance(numeric_level, int):
+    raise ValueError('Invalid log level: %s' % loglevel)
+
+# initialise logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%d/%m/%Y %H:%M:%S',
+    filename=args.log_file,
+    level=numeric_level)
+
+logger = logging.getLogger(('basestation_rollup.py: ' + version))
+
+if args.debug:
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.DEBUG)
+    # simpler formatter for console
+    formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
+    console_handler.setFormatter(formatter)
+    logging.getLogger('').addHandler(console_handler)
+    logger.debug('Running in debug mode')
+
+
+def time_arg(value):
+    # --since / --until to an aware datetime
+    if value is None:
+        return None
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when
+
+
+def main():
+    logger.info('basestation_rollup.py %s', version)
+
+    stations = None
+    if args.station:
+        stations = [int(station) for station in args.station.split(',')]
+
+    rollup = weatherRollup(**postgres_params)
+    chunks = rollup.rebuild(since=time_arg(args.since), until=time_arg(args.until),
+                            stations=stations, chunk_days=args.days)
+
+    print("Rebuilt rollups in %d chunks" % chunks)
+    logger.info('Exiting basestation_rollup.py')
+
+
+if __name__ == '__main__':
+    main()
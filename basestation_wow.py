@@ -18,8 +18,10 @@ import re
 # used to read the config file for postgreql - database.ini
 from config import config_new
 from config import config_wow
+from classes.basestationConfig import get_config
 
 from classes.weatherObservation import metofficeWow
+from classes.weatherObservation import metofficeWowFleet
 
 
 version = '1.dev.1'
@@ -36,6 +38,12 @@ parser.add_argument("--update", help= "Specify to actually send reading to met o
 parser.add_argument("--station", help="Id of the station - default is '05'",
                    default='5')
 
+parser.add_argument("--all", help="Upload every station with a wow_station set, rather than just --station",
+                    action="store_true")
+
+parser.add_argument("--interval", help="With --all (or a queue_path), keep running and upload every INTERVAL seconds. 0 (default) uploads once",
+                    type=int, default=0)
+
 parser.add_argument("--log_file", help="Location of log file - defauits to ''",
                     default="/var/log/lora_basestation.log")
 
@@ -91,9 +99,25 @@ station_id = int(args.station)
 def main():
     logger.info('basestation_wow.py %s', version)
 
-    wow = metofficeWow(station_id, wow_params,**postgres_params)
-
-    wow.latest(upload=args.update)
+    if args.all or wow_params.get('queue_path'):
+        # the upload queue (retries and catch up) needs the fleet uploader,
+        # here limited to --station unless --all is given
+        stations = None if args.all else [station_id]
+        fleet = metofficeWowFleet(wow_params, stations, **postgres_params)
+        if args.interval > 0:
+            # running as a service - SIGHUP re-reads config.ini and applies
+            # changed [wow] and [postgresql] settings from the next run
+            basestation_config = get_config()
+            basestation_config.subscribe(
+                'wow', lambda config: fleet.reconfigure(config.section('wow')))
+            basestation_config.subscribe(
+                'postgresql', lambda config: fleet.pool.reconfigure(**config.section('postgresql')))
+            basestation_config.reload_on_sighup()
+        fleet.run(interval=args.interval, upload=args.update)
+    else:
+        wow = metofficeWow(station_id, wow_params,**postgres_params)
+
+        wow.latest(upload=args.update)
 
     logger.info('Exiting basestation_wow.py')
 
@@ -0,0 +1,29 @@
+# What a cron'd downlink (basestation_mqtt.py --action T/D/O/R) does
+# before it talks to the broker: parse the config once, import the
+# listener classes and build a weatherStation with just the target station.
+# The station table is stubbed so no database is needed. Run by
+# bench.run_bench as a fresh process:
+#
+#   python -m bench.downlink_start <config.ini>
+
+import sys
+
+from classes.basestationConfig import get_config
+
+config = get_config(sys.argv[1])
+postgres_params = config.section('postgresql')
+mqtt_params = config.section('mqtt')
+mqtt_apps = config.mqtt_apps()
+ingest_params = config.typed('ingest')
+
+from classes.thingsNetwork import weatherStation
+
+
+class stubStation(weatherStation):
+    def _get_stations(self):
+        return {sid: ('bench', 51.5, -0.1, 10, mqtt_params['device_id'])
+                for sid in self.station_ids}
+
+
+station = stubStation(5, station_ids=[5], **postgres_params)
+assert station.device_for_station(5)
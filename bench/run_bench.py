@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the decode, persist and upload paths. Run from the top of
+# the repo:
+#
+#   python -m bench.run_bench                        decode / parse / ingest / upload / startup
+#   python -m bench.run_bench --dsn "dbname=scratch" ingest into a scratch database too
+#   python -m bench.run_bench --save bench/baseline.json
+#   python -m bench.run_bench --compare bench/baseline.json   exit 1 on a regression
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import statistics
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from classes.uplinkDecoder import uplinkDecoder
+from bench.uplinks import uplinkGenerator, check_roundtrip
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# metrics where bigger is better - everything else is a time
+HIGHER_IS_BETTER = ('msgs_per_s',)
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is KB on linux, bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def summarise(latencies, elapsed, count=None):
+    # latencies in seconds
+    latencies = sorted(latencies)
+    count = len(latencies) if count is None else count
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'messages': count,
+        'msgs_per_s': round(count / elapsed, 1),
+        'p50_ms': round(quantiles[49] * 1000, 4),
+        'p99_ms': round(quantiles[98] * 1000, 4),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def bench_decode(args, generator):
+    decoder = uplinkDecoder()
+    payloads = [generator.payload(100, time.time()) for n in range(args.messages)]
+
+    latencies = []
+    started = time.perf_counter()
+    for payload in payloads:
+        t = time.perf_counter()
+        decoder.decode(100, payload)
+        latencies.append(time.perf_counter() - t)
+    results = {'decode': summarise(latencies, time.perf_counter() - started)}
+
+    try:
+        decoder.decode_batch(100, payloads[:10])  # imports numpy - not part of the timing
+        started = time.perf_counter()
+        decoder.decode_batch(100, payloads)
+        elapsed = time.perf_counter() - started
+        results['decode_batch'] = {'messages': len(payloads),
+                                   'msgs_per_s': round(len(payloads) / elapsed, 1),
+                                   'peak_rss_mb': peak_rss_mb()}
+    except ImportError:
+        print('numpy not installed - decode_batch skipped')
+    return results
+
+
+def make_station(generator, postgres_params=None):
+    # a weatherStation whose stations come from the generator, or from the
+    # scratch database. Imported here - thingsNetwork needs psycopg2 and paho
+    from classes.thingsNetwork import weatherStation
+
+    if postgres_params is not None:
+        return weatherStation(min(generator.stations()), **postgres_params)
+
+    class syntheticStation(weatherStation):
+        def _get_stations(self):
+            return generator.stations()
+
+    return syntheticStation(min(generator.stations()))
+
+
+def bench_parse(args, generator):
+    station = make_station(generator)
+    messages = generator.messages(args.messages)
+
+    latencies = []
+    started = time.perf_counter()
+    for message in messages:
+        t = time.perf_counter()
+        station.parse_data(json.loads(message))
+        latencies.append(time.perf_counter() - t)
+    return {'parse': summarise(latencies, time.perf_counter() - started)}
+
+
+def bench_ingest(args, generator, postgres_params=None):
+    # End to end through the listener's pipeline: an in-process stand-in
+    # for the mqtt broker publishes to the ingest queue as fast as it will
+    # take them, the workers decode (and with a database, commit through
+    # the batch writer). Latency is publish to handled
+    from classes.thingsNetwork import ttnMQTT
+    from classes.ingestQueue import ingestQueue
+
+    station = make_station(generator, postgres_params)
+    if postgres_params is not None:
+        # use the devices the scratch database knows about
+        generator = uplinkGenerator(seed=args.seed, device_ids=[
+            station.device_for_station(sid) for sid in station.stations
+            if station.device_for_station(sid)])
+        station.start_writer(args.batch_size, 500, upsert=True)
+
+    mqttc = ttnMQTT(station, postgres_params is not None,
+                    user='bench', password='', public_tls_address='localhost',
+                    public_tls_address_port='1883')
+    messages = generator.messages(args.messages)
+
+    latencies = []
+    lock = threading.Lock()
+
+    def handle(item):
+        published, payload = item
+        mqttc.handle_uplink(payload)
+        with lock:
+            latencies.append(time.perf_counter() - published)
+
+    ingest = ingestQueue(handle, args.workers, args.messages)
+    ingest.start()
+    started = time.perf_counter()
+    for message in messages:
+        ingest.submit((time.perf_counter(), message))
+    ingest.stop()
+    if postgres_params is not None:
+        station.close()  # the last batch is part of the run
+    elapsed = time.perf_counter() - started
+
+    name = 'ingest_db' if postgres_params is not None else 'ingest'
+    return {name: summarise(latencies, elapsed)}
+
+
+class _wowStandIn(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as WOW does
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_upload(args, generator):
+    # WOW uploads through metofficeWowFleet against a local stand-in server
+    from classes.weatherObservation import metofficeWowFleet, wow_fields
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _wowStandIn)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    fleet = metofficeWowFleet({
+        'software': 'bench',
+        'upload_url': 'http://127.0.0.1:%d/automaticreading?' % httpd.server_address[1],
+        'workers': args.workers,
+        'rate_per_minute': 0})
+
+    reading = {'reading_time': datetime.now(timezone.utc), 'bar_uncorrected': 1013.2,
+               'rain_today': 1.2, 'temperature': 12.3, 'humidity': 80, 'wind_dir': 270,
+               'wind_speed': 12.5, 'wind_gust_10m': 20.1, 'wind_gust_dir_10m': 260}
+    fields = wow_fields(reading, 0.4, '123456', '123456', 'bench')
+
+    count = max(args.messages // 10, 100)
+    started = time.perf_counter()
+    futures = [fleet._executor.submit(fleet._upload_one, fields) for n in range(count)]
+    latencies = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    httpd.shutdown()
+    httpd.server_close()
+    return {'upload': summarise(latencies, elapsed)}
+
+
+# the config a cron'd downlink would read - no database or broker is touched
+STARTUP_CONFIG = """[postgresql]
+host = localhost
+database = weather
+user = bench
+password = bench
+[mqtt]
+user = bench@ttn
+password = bench
+public_tls_address = localhost
+public_tls_address_port = 8883
+device_id = eui-70b3d57ed005a1b2
+"""
+
+# cold start of a downlink (config, imports, station) on the Raspberry Pi
+# hosts. Saved with the results and checked by --compare whatever the
+# baseline's own time was
+STARTUP_TARGET_MS = 500
+
+
+def time_runs(args, command):
+    # median / max wall time of fresh processes, or None (with the reason
+    # printed) if one fails - timing an import error would make a very good
+    # looking baseline
+    times = []
+    for n in range(args.startup_runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable] + command, cwd=ROOT,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - started)
+        if result.returncode:
+            error = result.stderr.decode().strip().splitlines()
+            print('%s skipped - %s' % (' '.join(command), error[-1] if error else result.returncode))
+            return None
+    return {'median_ms': round(statistics.median(times) * 1000, 1),
+            'max_ms': round(max(times) * 1000, 1),
+            'peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)}
+
+
+def bench_startup(args):
+    # startup is what the cron'd downlinks (T/D/O/R) pay on every run: a
+    # fresh interpreter, one config parse, the listener classes and a
+    # weatherStation with just the target station (bench/downlink_start.py).
+    # startup_help is basestation_mqtt.py --help, the floor
+    results = {}
+    with tempfile.NamedTemporaryFile('w', suffix='.ini') as config_file:
+        config_file.write(STARTUP_CONFIG)
+        config_file.flush()
+        downlink = time_runs(args, ['-m', 'bench.downlink_start', config_file.name])
+        if downlink is not None:
+            downlink['target_ms'] = args.startup_target
+            results['startup'] = downlink
+    cli = time_runs(args, ['basestation_mqtt.py', '--help'])
+    if cli is not None:
+        results['startup_help'] = cli
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # [(bench, metric, baseline, now), ...] for everything worse than the
+    # baseline by more than tolerance, and any median_ms over the target_ms
+    # saved with the baseline
+    regressions = []
+    for name, metrics in baseline['results'].items():
+        for metric, then in metrics.items():
+            now = results.get(name, {}).get(metric)
+            if now is None or metric in ('messages', 'peak_rss_mb', 'target_ms') or not then:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                worse = now < then * (1 - tolerance)
+            else:
+                worse = now > then * (1 + tolerance)
+            if worse:
+                regressions.append((name, metric, then, now))
+
+        target = metrics.get('target_ms')
+        now = results.get(name, {}).get('median_ms')
+        if target and now is not None and now > target:
+            regressions.append((name, 'target_ms', target, now))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode / persist / upload benchmarks")
+    parser.add_argument("--messages", help="Messages per benchmark - default 20000",
+                        type=int, default=20000)
+    parser.add_argument("--devices", help="Synthetic devices - default 50",
+                        type=int, default=50)
+    parser.add_argument("--seed", help="Generator seed - default 1", type=int, default=1)
+    parser.add_argument("--workers", help="Ingest workers / upload threads - default 2",
+                        type=int, default=2)
+    parser.add_argument("--batch_size", help="Writer batch size with --dsn - default 50",
+                        type=int, default=50)
+    parser.add_argument("--dsn", help="libpq connection string of a SCRATCH database with the "
+                        "schema and stations with eu_ids - readings are written to it",
+                        default=None)
+    parser.add_argument("--only", help="Comma separated benchmarks to run: "
+                        "decode, parse, ingest, upload, startup", default=None)
+    parser.add_argument("--startup_runs", help="Cold starts to time - default 5",
+                        type=int, default=5)
+    parser.add_argument("--startup_target", help="Downlink cold start target in ms, saved with "
+                        "the results and checked by --compare - default %d" % STARTUP_TARGET_MS,
+                        type=float, default=STARTUP_TARGET_MS)
+    parser.add_argument("--save", help="Write the results to this JSON file as a baseline",
+                        default=None)
+    parser.add_argument("--compare", help="Compare with a baseline JSON file - exit 1 on a regression",
+                        default=None)
+    parser.add_argument("--tolerance", help="Allowed slowdown against the baseline - default 0.2 (20%%)",
+                        type=float, default=0.2)
+    args = parser.parse_args()
+
+    only = set(args.only.split(',')) if args.only else None
+    generator = uplinkGenerator(args.devices, args.seed)
+    check_roundtrip(100, args.seed)
+
+    results = {}
+
+    def run(name, func, *func_args):
+        if only is not None and name not in only:
+            return
+        try:
+            results.update(func(*func_args))
+        except ImportError as error:
+            print('%s skipped - %s' % (name, error))
+
+    run('decode', bench_decode, args, generator)
+    run('parse', bench_parse, args, generator)
+    run('ingest', bench_ingest, args, generator)
+    if args.dsn:
+        from psycopg2.extensions import parse_dsn
+        run('ingest', bench_ingest, args, generator, parse_dsn(args.dsn))
+    run('upload', bench_upload, args, generator)
+    run('startup', bench_startup, args)
+
+    for name, metrics in results.items():
+        print('%-13s %s' % (name, '  '.join('%s %s' % item for item in metrics.items())))
+
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'messages': args.messages,
+                       'results': results}, out, indent=2)
+        print('Baseline saved to %s' % args.save)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, then, now in regressions:
+            print('REGRESSION %s %s: %s -> %s' % (name, metric, then, now))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against %s' % args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import json
+import time
+import base64
+import random
+from datetime import datetime, timezone
+
+from classes.uplinkDecoder import uplinkDecoder, LAYOUTS, BASELINE_TIME
+
+# Plausible values for each field, (low, high). Anything not listed is 0
+RANGES = {
+    'timezone': (0, 0),
+    'wind_direction': (0, 359),
+    'wind_speed': (0, 60),
+    'wind_gust': (0, 90),
+    'wind_gust_dir': (0, 359),
+    'wind_speed_avg2m': (0, 60),
+    'wind_dir_avg2m': (0, 359),
+    'wind_gust_10m': (0, 90),
+    'wind_gust_dir_10m': (0, 359),
+    'humidity': (20, 100),
+    'temperature': (-15, 35),
+    'rain_1h': (0, 10),
+    'rain_today': (0, 40),
+    'rain_since_last': (0, 2),
+    'bar_uncorrected': (950, 1050),
+    'bar_corrected': (950, 1050),
+    'voltage': (3.2, 4.2),
+    'latitude': (49.9, 58.6),
+    'longitude': (-8.1, 1.7),
+    'altitude': (0, 400),
+}
+
+
+def encode(port, values, layouts=LAYOUTS):
+    # the inverse of uplinkDecoder.decode - values is {field name: value}
+    layout = layouts[port]
+    total_bits = sum(f.bits for f in layout)
+    nbytes = (total_bits + 7) // 8
+
+    raw = 0
+    for f in layout:
+        value = int(round((values.get(f.name, 0) - f.offset) * f.divisor))
+        if value < 0:
+            value += 1 << f.bits
+        raw = (raw << f.bits) | (value & ((1 << f.bits) - 1))
+    raw <<= nbytes * 8 - total_bits
+
+    return raw.to_bytes(nbytes, 'big')
+
+
+class uplinkGenerator(object):
+
+    # Valid TTN v3 uplink messages (as they arrive over mqtt) for a fleet of
+    # synthetic devices. Seeded, so runs are repeatable
+
+    def __init__(self, devices=50, seed=1, ports=(100,), device_ids=None):
+
+        self.random = random.Random(seed)
+        self.ports = tuple(ports)
+        if device_ids is None:
+            device_ids = ['eui-%016x' % (0x70b3d57ed0000000 + n) for n in range(devices)]
+        self.device_ids = list(device_ids)
+        self.f_cnt = {device_id: 0 for device_id in self.device_ids}
+
+    def stations(self):
+        # weatherStation._get_stations() shaped rows for the devices
+        return {n + 1: ('bench %d' % (n + 1), 51.5, -0.1, 20,
+                        device_id.partition('eui-')[2].upper())
+                for n, device_id in enumerate(self.device_ids)}
+
+    def values(self, port, when):
+        # as many decimals as the field carries
+        values = {f.name: round(self.random.uniform(*RANGES.get(f.name, (0, 0))),
+                                len(str(f.divisor)) - 1)
+                  for f in LAYOUTS[port]}
+        values['offset_time'] = int(when) - BASELINE_TIME
+        values['timezone'] = 0
+        return values
+
+    def payload(self, port, when):
+        return encode(port, self.values(port, when))
+
+    def message(self, device_id=None, port=None, when=None):
+        # one uplink as the raw mqtt payload (bytes)
+        if device_id is None:
+            device_id = self.random.choice(self.device_ids)
+        if port is None:
+            port = self.random.choice(self.ports)
+        if when is None:
+            when = time.time()
+        self.f_cnt[device_id] += 1
+
+        received = datetime.fromtimestamp(when, timezone.utc)
+        return json.dumps({
+            'end_device_ids': {'device_id': device_id,
+                               'application_ids': {'application_id': 'bench'}},
+            'received_at': received.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'uplink_message': {
+                'f_port': port,
+                'f_cnt': self.f_cnt[device_id],
+                'frm_payload': base64.b64encode(self.payload(port, when)).decode(),
+                'rx_metadata': [{'rssi': self.random.randint(-120, -60),
+                                 'snr': round(self.random.uniform(-10, 12), 1)}],
+            }
+        }).encode()
+
+    def messages(self, count, start=None, interval=1):
+        # count messages, with reading times interval seconds apart
+        if start is None:
+            start = time.time() - count * interval
+        return [self.message(when=start + n * interval) for n in range(count)]
+
+
+def check_roundtrip(count=1000, seed=1):
+    # encode() and the decoder agree - the generator is only useful if they do
+    generator = uplinkGenerator(seed=seed, ports=tuple(LAYOUTS))
+    decoder = uplinkDecoder()
+    for n in range(count):
+        port = generator.random.choice(tuple(LAYOUTS))
+        values = generator.values(port, time.time())
+        decoded = decoder.decode(port, encode(port, values))
+        for name, value in values.items():
+            if abs(decoded[name] - value) > 1e-6:
+                raise AssertionError('%s: encoded %r, decoded %r' % (name, value, decoded[name]))
+    return count
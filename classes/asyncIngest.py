@@ -0,0 +1,359 @@
+import json
+import time
+import random
+import signal
+import asyncio
+import logging
+import concurrent.futures
+
+import paho.mqtt.client as mqtt
+
+from classes.ingestMetrics import METRICS
+from classes.uplinkDedup import uplinkDedup
+
+
+class mqttAsyncHelper(object):
+
+    # Drives a paho client from an asyncio event loop instead of
+    # client.loop() / loop_forever(), using paho's socket callbacks. connect()
+    # and reconnect() block (DNS, TCP, TLS), so they run in an executor and
+    # the callbacks they make are passed to the loop's own thread
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.fd = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _on_loop(self, func, *args):
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    # by file descriptor - the socket may be closed by the time a callback
+    # from the executor reaches the loop
+
+    def on_socket_open(self, client, userdata, sock):
+        self._on_loop(self._open, sock.fileno())
+
+    def _open(self, fd):
+        self.fd = fd
+        self.loop.add_reader(fd, self.client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self._on_loop(self._close)
+
+    def _close(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.fd = None
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self._register_write)
+
+    def _register_write(self):
+        if self.fd is not None:
+            self.loop.add_writer(self.fd, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self._unregister_write)
+
+    def _unregister_write(self):
+        if self.fd is not None:
+            self.loop.remove_writer(self.fd)
+
+    async def misc_loop(self):
+        # keepalives and retries - what loop() does between reads
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class asyncIngest(object):
+
+    # Single event loop ingest: mqtt receive for one or more TTN
+    # applications, decode, database writes and periodic jobs (e.g. WOW
+    # uploads) run as tasks. Blocking calls (database, http) are handed to
+    # a small executor so they never hold up the loop
+
+    def __init__(self, weather_station, commit=False, ingest_params=None,
+                 applications=(), jobs=(), archive=None):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising asyncIngest object")
+
+        if ingest_params is None:
+            ingest_params = {}
+
+        self.weather_station = weather_station
+        self.commit = commit
+        self.applications = list(applications)  # ttn_params dicts
+        self.jobs = list(jobs)  # (name, interval seconds, callable)
+        self.archive = archive
+
+        self.workers = int(ingest_params.get('workers', 2))
+        self.queue_size = int(ingest_params.get('queue_size', 1000))
+        self.stats_interval = int(ingest_params.get('stats_interval', 300))
+
+        # copies of an uplink (redelivered after a reconnect...) are dropped
+        self.dedup = None
+        if int(ingest_params.get('dedup_size', 10000)) > 0:
+            self.dedup = uplinkDedup(ingest_params.get('dedup_size', 10000),
+                                     ingest_params.get('dedup_hours', 24))
+
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+        self.reconnects = 0
+        self._latency_total = 0.0
+        self._latency_count = 0
+        self._latency_max = 0.0
+
+        self.loop = None
+        self.queue = None
+        self.executor = None
+        self.clients = []
+        self._pending = {}  # client : ttn_params to reconnect with
+        self._stop = None
+
+        self.logger.debug("asyncIngest initialised")
+
+    def run(self):
+        asyncio.run(self._main())
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    def stats(self):
+        if self._latency_count:
+            latency_avg = self._latency_total / self._latency_count
+        else:
+            latency_avg = 0.0
+        stats = {
+            'depth': self.queue.qsize() if self.queue is not None else 0,
+            'received': self.received,
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'errors': self.errors,
+            'duplicates': self.dedup.duplicates if self.dedup is not None else 0,
+            'reconnects': self.reconnects,
+            'latency_avg_ms': round(latency_avg * 1000, 1),
+            'latency_max_ms': round(self._latency_max * 1000, 1)
+        }
+        self._latency_total = 0.0
+        self._latency_count = 0
+        self._latency_max = 0.0
+        return stats
+
+    # mqtt callbacks - these run on the event loop (from loop_read)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.logger.info("Connected to %s", userdata['user'])
+            # only uplinks - not the join / ack / location traffic under #
+            client.subscribe("v3/" + userdata['user'] + "/devices/+/up", 0)
+        else:
+            self.logger.error("Failed to connect to %s: %d", userdata['user'], rc)
+
+    def on_message(self, client, userdata, message):
+        self.received += 1
+        if self.archive is not None:
+            try:
+                self.archive.append(message.payload)
+            except OSError as error:
+                self.logger.error("Unable to archive message: %s", error)
+        try:
+            self.queue.put_nowait((time.monotonic(), message.payload))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self.logger.warning("Ingest queue full - message dropped")
+
+    def on_disconnect(self, client, userdata, rc):
+        self.logger.info("Disconnected from %s with result code %d",
+                         userdata['user'], rc)
+        if self._stop.is_set():
+            return
+        ttn_params = self._pending.pop(client, None)
+        if ttn_params is not None:
+            # asked to by _reconfigure - back with the new settings
+            self._apply_settings(client, ttn_params)
+            self.loop.create_task(self._reconnect(client, ttn_params, delay=0))
+        elif rc != 0:
+            METRICS.inc('basestation_mqtt_reconnects_total',
+                        application=userdata['user'])
+            self.loop.create_task(self._reconnect(client, userdata))
+
+    async def _reconnect(self, client, userdata, delay=1):
+        while not self._stop.is_set():
+            await asyncio.sleep(delay)
+            try:
+                await self.loop.run_in_executor(None, client.reconnect)
+                self.reconnects += 1
+                self.logger.info("Reconnected to %s", userdata['user'])
+                return
+            except OSError as error:
+                self.logger.warning("Reconnect to %s failed: %s",
+                                    userdata['user'], error)
+                delay = min(max(delay * 2, 1), 60)
+
+    def reconfigure(self, applications):
+        # New [mqtt] settings for the running listener - safe to call from
+        # any thread (e.g. the config reload), the clients are only touched
+        # from the event loop
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._reconfigure, list(applications))
+
+    @staticmethod
+    def _apply_settings(client, ttn_params):
+        client.user_data_set(ttn_params)
+        client.username_pw_set(ttn_params['user'], ttn_params['password'])
+        client.connect_async(ttn_params['public_tls_address'],
+                             int(ttn_params['public_tls_address_port']), 60)
+
+    def _reconfigure(self, applications):
+        # a connected client disconnects, and on_disconnect reconnects it
+        # with the new settings (in the executor, like every connect). One
+        # that is not connected is already being retried by _reconnect
+        if len(applications) != len(self.applications):
+            self.logger.warning("TTN applications added or removed - "
+                                "restart the listener to pick them up")
+        for n, client in enumerate(self.clients[:len(applications)]):
+            new = applications[n]
+            if new == self.applications[n]:
+                continue
+            self.logger.info("mqtt settings for %s changed - reconnecting", new['user'])
+            self.applications[n] = new
+            if client.is_connected():
+                self._pending[client] = new
+                client.disconnect()
+            else:
+                self._apply_settings(client, new)
+
+    async def _connect(self, ttn_params):
+        client = mqtt.Client(f'python=mqtt-{random.randint(0,1000)}',
+                             userdata=ttn_params)
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.on_disconnect = self.on_disconnect
+        mqttAsyncHelper(self.loop, client)
+
+        client.username_pw_set(ttn_params['user'], ttn_params['password'])
+        client.tls_set()
+        # DNS, TCP and the TLS handshake - not on the loop
+        await self.loop.run_in_executor(
+            None, client.connect, ttn_params['public_tls_address'],
+            int(ttn_params['public_tls_address_port']), 60)
+        return client
+
+    # tasks
+
+    async def _worker(self):
+        while True:
+            queued, payload = await self.queue.get()
+            parsed_json = None
+            handled = True
+            try:
+                parsed_json = json.loads(payload)
+                if self.dedup is not None and self.dedup.seen(parsed_json):
+                    self.logger.debug("Duplicate uplink dropped")
+                else:
+                    handled = False
+                    # in the executor - parse_data can reload the station
+                    # index from the database (station_for_device)
+                    data = await self.loop.run_in_executor(
+                        self.executor, self.weather_station.parse_data, parsed_json)
+                    self.logger.debug("Decoded data:%s", data)
+                    handled = True
+                    if 'No payload' in data:
+                        self.logger.info("Ignoring message with no payload")
+                    else:
+                        self.weather_station.cache_latest(data)
+                        if self.commit:
+                            handled = await self.loop.run_in_executor(
+                                self.executor, self.weather_station.commit_data, data)
+                self.processed += 1
+            except Exception:
+                self.errors += 1
+                self.logger.exception("Error processing message")
+            finally:
+                if not handled and self.dedup is not None:
+                    # not written - let a redelivered copy through
+                    self.dedup.forget(parsed_json)
+                latency = time.monotonic() - queued
+                self._latency_total += latency
+                self._latency_count += 1
+                self._latency_max = max(self._latency_max, latency)
+                self.queue.task_done()
+
+    async def _job(self, name, interval, func):
+        while True:
+            try:
+                await self.loop.run_in_executor(self.executor, func)
+            except Exception:
+                self.logger.exception("Job %s failed", name)
+            await asyncio.sleep(interval)
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self.logger.info("Async ingest: %s", self.stats())
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers + len(self.jobs))
+        self._stop = asyncio.Event()
+        METRICS.collector('ingest_queue', lambda: {
+            'basestation_ingest_queue_depth': self.queue.qsize(),
+            'basestation_ingest_dropped_total': self.dropped})
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self._stop.set)
+
+        self.clients = [await self._connect(ttn_params)
+                        for ttn_params in self.applications]
+
+        tasks = [asyncio.create_task(self._worker())
+                 for n in range(self.workers)]
+        tasks += [asyncio.create_task(self._job(*job)) for job in self.jobs]
+        tasks.append(asyncio.create_task(self._log_stats()))
+
+        try:
+            await self._stop.wait()
+            self.logger.info("Stopping")
+        finally:
+            # structured shutdown - stop receiving, finish what has been
+            # received, then stop everything else
+            for client in self.clients:
+                client.disconnect()
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout=30)
+            except asyncio.TimeoutError:
+                self.logger.warning("%d messages not processed", self.queue.qsize())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.executor.shutdown(wait=True)
+            if self.archive is not None:
+                self.archive.close()
+            self.logger.info("Async ingest stopped: %s", self.stats())
@@ -0,0 +1,261 @@
+import os
+import re
+import signal
+import logging
+import threading
+from configparser import ConfigParser
+
+# Everything config.ini may hold that has a type other than a string, and
+# the defaults for optional settings. Keys not listed are kept as strings.
+# REQUIRED keys must be set (in the file or the environment) whenever their
+# section is there
+REQUIRED = object()
+
+SCHEMA = {
+    'postgresql': {
+        'port': (int, None),
+        'pool_min': (int, None),
+        'pool_max': (int, None),
+        'pool_check_idle': (float, None),
+    },
+    'mqtt': {
+        'user': (str, REQUIRED),
+        'password': (str, REQUIRED),
+        'public_tls_address': (str, REQUIRED),
+        'public_tls_address_port': (int, REQUIRED),
+        'all_devices': (bool, None),
+    },
+    'wow': {
+        'software': (str, REQUIRED),
+        'upload_url': (str, REQUIRED),
+        'workers': (int, None),
+        'timeout': (float, None),
+        'catchup_minutes': (int, None),
+        'catchup_hours': (int, None),
+        'rate_per_minute': (float, None),
+    },
+    'ingest': {
+        'batch_size': (int, '50'),
+        'flush_ms': (int, '2000'),
+        'workers': (int, '2'),
+        'queue_size': (int, '1000'),
+        'stats_interval': (int, '300'),
+        'station_refresh': (int, '300'),
+        'archive_dir': (str, ''),
+        'archive_segment_mb': (float, '16'),
+        'archive_segment_hours': (float, '24'),
+        'archive_keep': (int, '0'),
+        'spool_path': (str, ''),
+        'spool_max_rows': (int, '100000'),
+        'wow_interval': (int, '0'),
+        'latest_port': (int, '0'),
+        'latest_host': (str, '127.0.0.1'),
+        'downlink_path': (str, ''),
+        'downlink_sync_hours': (float, '24'),
+        'downlink_max_attempts': (int, '3'),
+        'drift_threshold': (float, '0'),
+        'drift_window': (int, '48'),
+        'drift_min_points': (int, '12'),
+        'drift_cooldown_hours': (float, '6'),
+        'metrics_port': (int, '0'),
+        'metrics_textfile': (str, ''),
+        'dedup_size': (int, '10000'),
+        'dedup_hours': (float, '24'),
+    },
+}
+
+# sections that may be missing altogether - their defaults are used
+OPTIONAL_SECTIONS = ('ingest',)
+
+ENV_PREFIX = 'BASESTATION_'
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+def get_config(filename='config.ini'):
+    # Returns the shared config for this file, parsing it on first use
+    with _configs_lock:
+        config = _configs.get(filename)
+        if config is None:
+            config = basestationConfig(filename)
+            _configs[filename] = config
+    return config
+
+
+def _env_name(section):
+    # 'mqtt:garden' -> 'MQTT_GARDEN'
+    return re.sub(r'[^0-9A-Za-z]', '_', section).upper()
+
+
+def _schema(section):
+    # [mqtt:<name>] sections take whatever they do not set from [mqtt], so
+    # nothing is required in them
+    base, extra, name = section.partition(':')
+    schema = SCHEMA.get(base, {})
+    if extra:
+        schema = {key: (kind, None) for key, (kind, default) in schema.items()}
+    return schema
+
+
+def _convert(kind, value):
+    if kind is bool:
+        if value.lower() not in ConfigParser.BOOLEAN_STATES:
+            raise ValueError('not a boolean: %r' % value)
+        return ConfigParser.BOOLEAN_STATES[value.lower()]
+    return kind(value)
+
+
+class basestationConfig(object):
+
+    # config.ini parsed once, with BASESTATION_<SECTION>_<KEY> environment
+    # variables overriding it (e.g. BASESTATION_MQTT_PASSWORD), checked
+    # against SCHEMA and cached section by section. Use get_config() for
+    # the shared instance.
+    #
+    # reload() (or SIGHUP, after reload_on_sighup()) re-reads the file. A
+    # config that does not validate is logged and ignored. Otherwise the
+    # functions subscribed to each changed section are called with this
+    # object, so a long running listener can pick up new credentials or a
+    # new WOW url without a restart
+
+    def __init__(self, filename='config.ini'):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising basestationConfig object")
+
+        self.filename = filename
+        self._subscribers = {}  # section : [func, ...]
+        self._lock = threading.Lock()
+        self._sections = self._load()
+
+        self.logger.debug("basestationConfig initialised from %s - sections %s",
+                          filename, ', '.join(self._sections))
+
+    def _load(self):
+        # {section: {key: string value}} with the environment overrides and
+        # defaults applied. Raises Exception if it does not validate
+        parser = ConfigParser()
+        parser.read(self.filename)
+        sections = {name: dict(parser.items(name)) for name in parser.sections()}
+
+        # longest section names first, so BASESTATION_MQTT_GARDEN_USER is
+        # [mqtt:garden] user rather than [mqtt] garden_user
+        known = sorted(set(sections) | set(SCHEMA), key=len, reverse=True)
+        for variable, value in os.environ.items():
+            if not variable.startswith(ENV_PREFIX):
+                continue
+            rest = variable[len(ENV_PREFIX):]
+            for section in known:
+                prefix = _env_name(section) + '_'
+                if rest.startswith(prefix) and len(rest) > len(prefix):
+                    sections.setdefault(section, {})[rest[len(prefix):].lower()] = value
+                    break
+
+        for section in OPTIONAL_SECTIONS:
+            sections.setdefault(section, {})
+
+        errors = []
+        for section, values in sections.items():
+            for key, (kind, default) in _schema(section).items():
+                if key not in values:
+                    if default is REQUIRED:
+                        errors.append('[%s] %s is not set' % (section, key))
+                    elif default is not None:
+                        values[key] = default
+                    continue
+                try:
+                    _convert(kind, values[key])
+                except ValueError:
+                    errors.append('[%s] %s = %r is not a valid %s'
+                                  % (section, key, values[key], kind.__name__))
+        if errors:
+            raise Exception('Invalid configuration in {0}: {1}'.format(
+                self.filename, '; '.join(errors)))
+
+        return sections
+
+    def sections(self):
+        return list(self._sections)
+
+    def has_section(self, section):
+        return section in self._sections
+
+    def section(self, section):
+        # {key: string value} - a copy, as the config_... functions returned
+        sections = self._sections
+        if section not in sections:
+            raise Exception('Section {0} not found in the {1} file'.format(section, self.filename))
+        return dict(sections[section])
+
+    def typed(self, section):
+        # section() with the values SCHEMA knows about converted
+        values = self.section(section)
+        for key, (kind, default) in _schema(section).items():
+            if key in values:
+                values[key] = _convert(kind, values[key])
+        return values
+
+    def get(self, section, key, fallback=None):
+        return self.typed(section).get(key, fallback) if self.has_section(section) else fallback
+
+    def mqtt_apps(self, section='mqtt'):
+        # [mqtt] plus one [mqtt:<name>] section for each extra TTN
+        # application. Anything not set in an extra section is taken from
+        # [mqtt]
+        base = self.section(section)
+        apps = [base]
+        for name in self._sections:
+            if name.startswith(section + ':'):
+                app = dict(base)
+                app.update(self._sections[name])
+                apps.append(app)
+        return apps
+
+    def subscribe(self, section, func):
+        # func(config) is called after a reload that changes the section.
+        # Subscribing to 'mqtt' covers the [mqtt:<name>] sections too
+        with self._lock:
+            self._subscribers.setdefault(section, []).append(func)
+
+    def reload(self):
+        # Returns the sections that changed, or None if the new config was
+        # rejected (the current one is kept)
+        try:
+            sections = self._load()
+        except Exception as error:
+            self.logger.error("Config reload failed - keeping the current config: %s", error)
+            return None
+
+        with self._lock:
+            old, self._sections = self._sections, sections
+            changed = sorted(name for name in set(old) | set(sections)
+                             if old.get(name) != sections.get(name))
+            subscribers = dict(self._subscribers)
+
+        self.logger.info("Config reloaded from %s - changed: %s", self.filename,
+                         ', '.join(changed) or 'nothing')
+
+        called = set()
+        for name in changed:
+            for func in subscribers.get(name.partition(':')[0], []):
+                if func in called:
+                    continue  # once per reload, however many sections changed
+                called.add(func)
+                try:
+                    func(self)
+                except Exception:
+                    self.logger.exception("Error applying the reloaded config")
+        return changed
+
+    def reload_on_sighup(self):
+        # The handler only starts the reload - subscribers reconnect to
+        # brokers and databases, which is no work for a signal handler.
+        # Must be called from the main thread
+        def handler(signum, frame):
+            threading.Thread(target=self.reload, name='config-reload',
+                             daemon=True).start()
+
+        signal.signal(signal.SIGHUP, handler)
+        self.logger.info("Reloading %s on SIGHUP (pid %d)", self.filename, os.getpid())
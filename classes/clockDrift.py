@@ -0,0 +1,98 @@
+import time
+import logging
+import threading
+import collections
+
+
+def theil_sen(points):
+    # Robust straight line fit - (slope, intercept) from the medians of
+    # the pairwise slopes, so a few delayed or replayed messages do not
+    # drag the line about the way they would with least squares
+    slopes = []
+    for i, (x1, y1) in enumerate(points):
+        for x2, y2 in points[i + 1:]:
+            if x2 != x1:
+                slopes.append((y2 - y1) / (x2 - x1))
+    slope = _median(slopes) if slopes else 0.0
+    intercept = _median([y - slope * x for x, y in points])
+    return slope, intercept
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+class clockDrift(object):
+
+    # Tracks how far each station's clock is from TTN's received_at, from
+    # the (received_at, device time) pairs of its last `window` uplinks.
+    # The offset now is estimated from a Theil-Sen fit over the window.
+    # add() returns a seconds correction for a 200 downlink when the offset
+    # passes threshold. The window is then cleared (the clock is about to
+    # jump) and no more are suggested for cooldown_hours
+
+    # a 200 carries the correction in one signed byte
+    MAX_CORRECTION = 127
+
+    def __init__(self, window=48, threshold=10, min_points=12, cooldown_hours=6):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising clockDrift object")
+
+        self.window = int(window)
+        self.threshold = float(threshold)  # seconds
+        self.min_points = max(int(min_points), 2)
+        self.cooldown = float(cooldown_hours) * 3600
+
+        self._points = {}  # device id : deque of (received, offset)
+        self._estimate = {}  # device id : (offset now, drift ppm)
+        self._corrected = {}  # device id : when the last correction was made
+        self._lock = threading.Lock()
+
+        self.logger.debug("clockDrift initialised")
+
+    def add(self, device_id, received, device_time):
+        # received and device_time are epoch seconds. Returns the correction
+        # to send (seconds, negative when the station clock is fast) or None
+        with self._lock:
+            points = self._points.get(device_id)
+            if points is None:
+                points = self._points[device_id] = collections.deque(maxlen=self.window)
+            points.append((received, device_time - received))
+
+            if len(points) < self.min_points:
+                return None
+
+            # fit relative to the first point - keeps the slopes well
+            # conditioned with epoch sized x values
+            base = points[0][0]
+            slope, intercept = theil_sen([(x - base, y) for x, y in points])
+            offset = slope * (received - base) + intercept
+            self._estimate[device_id] = (offset, slope * 1e6)
+
+            if abs(offset) < self.threshold:
+                return None
+            if time.monotonic() - self._corrected.get(device_id, -self.cooldown) < self.cooldown:
+                return None
+
+            correction = -int(round(offset))
+            correction = max(-self.MAX_CORRECTION, min(self.MAX_CORRECTION, correction))
+            self._corrected[device_id] = time.monotonic()
+            points.clear()
+
+        self.logger.info("%s clock is %.1fs %s (drift %.1f ppm) - correcting by %ds",
+                         device_id, abs(offset), 'fast' if offset > 0 else 'slow',
+                         slope * 1e6, correction)
+        return correction
+
+    def status(self):
+        # {device id: {'offset_s': ..., 'drift_ppm': ...}}
+        with self._lock:
+            return {device_id: {'offset_s': round(offset, 1),
+                                'drift_ppm': round(ppm, 1)}
+                    for device_id, (offset, ppm) in self._estimate.items()}
@@ -0,0 +1,210 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.pool
+
+# One pool per set of connection parameters, shared by every object in the
+# process (weatherStation, metofficeWow and their _get_stations loaders)
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(**postgres_params):
+    # Returns the shared pool for these connection parameters, creating it
+    # on first use. pool_min / pool_max / pool_check_idle are read from the
+    # [postgresql] section but are not passed on to psycopg2.connect
+    key = tuple(sorted(postgres_params.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = postgresPool(**postgres_params)
+            _pools[key] = pool
+    return pool
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+class postgresPool(object):
+
+    # errors that mean the connection itself is dead (server restart,
+    # network drop) rather than a problem with the statement
+    CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+    def __init__(self, pool_min=1, pool_max=4, pool_check_idle=30,
+                 **postgres_params):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising postgresPool object")
+
+        self.pool_min = int(pool_min)
+        self.pool_max = int(pool_max)
+        # connections idle for longer than this (seconds) are checked with a
+        # round trip before being handed out - 0 checks every time
+        self.pool_check_idle = float(pool_check_idle)
+        self.postgres_params = postgres_params
+
+        self.reconnects = 0
+
+        # when a connection last failed - every connection used before then
+        # is checked before it is handed out again, however recently
+        self._lost_at = 0
+
+        self._pool = None
+        self._last_used = {}  # id(connection) : monotonic time returned
+        self._owner = {}  # id(connection) : psycopg2 pool it is checked out from
+        self._lock = threading.Lock()
+
+        self.logger.debug("postgresPool initialised (min %d, max %d)",
+                          self.pool_min, self.pool_max)
+
+    def _get_pool(self):
+        # the pool is created lazily so that a database which is down at
+        # start up does not stop the listener from starting
+        with self._lock:
+            if self._pool is None:
+                self._pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.pool_min, self.pool_max, **self.postgres_params)
+                self.logger.debug("PostgreSQL connection pool open")
+            return self._pool
+
+    def _healthy(self, pconn):
+        if pconn.closed:
+            return False
+
+        last_used = self._last_used.get(id(pconn), 0)
+        if time.monotonic() - last_used < self.pool_check_idle and last_used > self._lost_at:
+            return True
+
+        try:
+            pcur = pconn.cursor()
+            pcur.execute("SELECT 1")
+            pcur.close()
+            pconn.rollback()
+            return True
+        except self.CONNECTION_ERRORS:
+            return False
+
+    def getconn(self):
+        pool = self._get_pool()
+
+        # a restarted server leaves every pooled connection dead - keep
+        # discarding until we get a live one (or the pool opens a new one)
+        for attempt in range(self.pool_max + 1):
+            pconn = pool.getconn()
+            if self._healthy(pconn):
+                self._owner[id(pconn)] = pool
+                return pconn
+
+            self.logger.warning("Discarding dead PostgreSQL connection")
+            self.reconnects += 1
+            self._last_used.pop(id(pconn), None)
+            pool.putconn(pconn, close=True)
+
+        raise psycopg2.OperationalError(
+            "Unable to get a working PostgreSQL connection from the pool")
+
+    def putconn(self, pconn, close=False):
+        owner = self._owner.pop(id(pconn), None)
+        if owner is None:
+            return  # the pool has been closed
+
+        if owner is not self._pool:
+            # checked out before a reconfigure() - close it, and the old
+            # pool once all of its connections are back
+            self._last_used.pop(id(pconn), None)
+            owner.putconn(pconn, close=True)
+            with self._lock:
+                if owner not in self._owner.values():
+                    owner.closeall()
+            return
+
+        if not pconn.closed and not close:
+            # never hand out a connection part way through a transaction
+            try:
+                pconn.rollback()
+            except self.CONNECTION_ERRORS:
+                close = True
+
+        if close or pconn.closed:
+            self._last_used.pop(id(pconn), None)
+        else:
+            self._last_used[id(pconn)] = time.monotonic()
+
+        owner.putconn(pconn, close=close or bool(pconn.closed))
+
+    @contextmanager
+    def connection(self):
+        # with pool.connection() as pconn: ...
+        # The connection goes back to the pool afterwards, or is thrown away
+        # if it failed with a connection level error
+        pconn = self.getconn()
+        broken = False
+        try:
+            yield pconn
+        except self.CONNECTION_ERRORS:
+            broken = True
+            self._lost_at = time.monotonic()
+            raise
+        finally:
+            self.putconn(pconn, close=broken)
+
+    def run(self, func):
+        # Returns func(pconn), run on a connection from the pool. A recently
+        # used connection is handed out unchecked, so after a server restart
+        # it fails on first use - func is then run once more on a checked
+        # connection. func must commit its own work and be safe to repeat
+        for attempt in (1, 2):
+            connected = False
+            try:
+                with self.connection() as pconn:
+                    connected = True
+                    return func(pconn)
+            except self.CONNECTION_ERRORS as error:
+                if attempt == 2 or not connected:
+                    raise  # no connection to be had - the database is down
+                self.logger.warning("PostgreSQL connection lost, retrying on another: %s",
+                                    str(error).strip())
+
+    def reconfigure(self, **params):
+        # New [postgresql] settings (e.g. a rotated password) without a
+        # restart. Connections checked out carry on and are closed when they
+        # come back; new ones are made with the new settings
+        key = tuple(sorted(params.items()))
+        with _pools_lock:
+            if _pools.get(key) is self:
+                return  # nothing has changed
+            # get_pool() with the new settings should find this pool
+            for old_key, pool in list(_pools.items()):
+                if pool is self:
+                    del _pools[old_key]
+            _pools[key] = self
+
+        postgres_params = dict(params)
+        with self._lock:
+            self.pool_min = int(postgres_params.pop('pool_min', 1))
+            self.pool_max = int(postgres_params.pop('pool_max', 4))
+            self.pool_check_idle = float(postgres_params.pop('pool_check_idle', 30))
+            self.postgres_params = postgres_params
+            retired, self._pool = self._pool, None
+            if retired is not None and retired not in self._owner.values():
+                retired.closeall()
+
+        self.logger.info("PostgreSQL settings changed - new connections will use them")
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self._last_used.clear()
+                self._owner.clear()
+                self.logger.debug("PostgreSQL connection pool closed")
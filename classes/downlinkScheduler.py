@@ -0,0 +1,215 @@
+import re
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+
+# our correlation ids, as they come back in TTN's down/... events
+CORRELATION_PREFIX = 'basestation:'
+CORRELATION_RE = re.compile(rb'basestation:[0-9a-f]{32}')
+
+# downlink states
+QUEUED = 'queued'  # waiting for the device's next uplink
+PUSHED = 'pushed'  # published to TTN
+SENT = 'sent'      # TTN has transmitted it, waiting for the device's ack
+
+# A frame counter that goes back is a reboot if it restarts near 0, or
+# goes back further than a late or re-delivered uplink could take it.
+# Smaller steps back are uplinks out of order and are ignored
+REBOOT_F_CNT = 3
+F_CNT_WINDOW = 16
+
+
+class downlinkScheduler(object):
+
+    # Persistent per device downlink queue (sqlite) for the listener. Class
+    # A devices only listen after an uplink, so commands wait here and are
+    # pushed when the device is next heard from, over the listener's own
+    # mqtt connection. At most one command per (device, port) is kept - a
+    # newer one replaces it. Commands are sent confirmed and stay until
+    # TTN reports the device's ack; nacks, failures and commands never
+    # acked within ack_timeout are retried up to max_attempts times.
+    #
+    # It also queues a time sync (200) every sync_hours per device, and a
+    # station report request (202) when a device's frame counter is reset
+    # (it has rebooted - see REBOOT_F_CNT)
+
+    def __init__(self, path, sync_payload=None, sync_hours=24, max_attempts=3,
+                 ack_timeout=6 * 3600):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising downlinkScheduler object")
+
+        self.path = path
+        self.sync_payload = sync_payload  # callable giving the 200 payload
+        self.sync_seconds = float(sync_hours) * 3600  # 0 - no periodic sync
+        self.max_attempts = int(max_attempts)
+        self.ack_timeout = float(ack_timeout)
+
+        self.pushed = 0
+        self.acked = 0
+        self.failed = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS downlink ("
+                           "device_id TEXT NOT NULL, "
+                           "port INTEGER NOT NULL, "
+                           "payload TEXT NOT NULL, "
+                           "state TEXT NOT NULL, "
+                           "queued REAL NOT NULL, "
+                           "pushed REAL, "
+                           "correlation_id TEXT, "
+                           "attempts INTEGER NOT NULL DEFAULT 0, "
+                           "PRIMARY KEY (device_id, port))")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS device ("
+                           "device_id TEXT PRIMARY KEY, "
+                           "f_cnt INTEGER, "
+                           "last_sync REAL)")
+
+        self.logger.debug("downlinkScheduler initialised - %d downlinks waiting in %s",
+                          len(self), path)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM downlink").fetchone()[0]
+
+    def _add(self, device_id, port, payload, replace=True):
+        self._conn.execute("INSERT OR " + ("REPLACE" if replace else "IGNORE") +
+                           " INTO downlink "
+                           "(device_id, port, payload, state, queued) "
+                           "VALUES (?, ?, ?, ?, ?)",
+                           (device_id, port, payload, QUEUED, time.time()))
+
+    def add(self, device_id, port, payload=''):
+        # queue a command (hex payload) for the device's next uplink,
+        # replacing any not yet acked on the same port
+        with self._lock:
+            self._add(device_id, port, payload)
+        self.logger.info("Queued port %d downlink for %s", port, device_id)
+
+    def on_uplink(self, device_id, f_cnt=None):
+        # Called for every uplink, after repeats have been dropped. Returns
+        # the downlinks to push now as [(port, hex payload, correlation id),
+        # ...] - they are marked as pushed
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            row = self._conn.execute("SELECT f_cnt, last_sync FROM device "
+                                     "WHERE device_id = ?", (device_id,)).fetchone()
+            if row is None:
+                last_f_cnt, last_sync = None, None
+                self._conn.execute("INSERT INTO device (device_id) VALUES (?)",
+                                   (device_id,))
+            else:
+                last_f_cnt, last_sync = row
+
+            if f_cnt is not None:
+                if last_f_cnt is None or f_cnt > last_f_cnt:
+                    self._conn.execute("UPDATE device SET f_cnt = ? WHERE device_id = ?",
+                                       (f_cnt, device_id))
+                elif f_cnt < last_f_cnt and (f_cnt < REBOOT_F_CNT or
+                                             last_f_cnt - f_cnt > F_CNT_WINDOW):
+                    self.logger.info("%s frame counter reset (%d -> %d) - "
+                                     "requesting a station report",
+                                     device_id, last_f_cnt, f_cnt)
+                    self._add(device_id, 202, '')
+                    self._conn.execute("UPDATE device SET f_cnt = ? WHERE device_id = ?",
+                                       (f_cnt, device_id))
+                elif f_cnt < last_f_cnt:
+                    self.logger.debug("%s uplink out of order (%d after %d)",
+                                      device_id, f_cnt, last_f_cnt)
+
+            if self.sync_seconds > 0 and self.sync_payload is not None \
+                    and (last_sync is None or now - last_sync >= self.sync_seconds):
+                # never replaces a 200 already waiting (e.g. a drift correction)
+                self._add(device_id, 200, self.sync_payload(), replace=False)
+                self._conn.execute("UPDATE device SET last_sync = ? WHERE device_id = ?",
+                                   (now, device_id))
+
+            # anything pushed that has not been acked in time goes round again
+            stale = self._conn.execute(
+                "SELECT port FROM downlink WHERE device_id = ? AND state != ? "
+                "AND pushed < ?", (device_id, QUEUED, now - self.ack_timeout)).fetchall()
+            for (port,) in stale:
+                self._retry(device_id, port, 'not acked')
+
+            rows = self._conn.execute(
+                "SELECT port, payload FROM downlink WHERE device_id = ? AND state = ? "
+                "ORDER BY queued", (device_id, QUEUED)).fetchall()
+            downlinks = []
+            for port, payload in rows:
+                correlation_id = CORRELATION_PREFIX + uuid.uuid4().hex
+                self._conn.execute("UPDATE downlink SET state = ?, pushed = ?, "
+                                   "correlation_id = ?, attempts = attempts + 1 "
+                                   "WHERE device_id = ? AND port = ?",
+                                   (PUSHED, now, correlation_id, device_id, port))
+                downlinks.append((port, payload, correlation_id))
+            self._conn.execute("COMMIT")
+
+        self.pushed += len(downlinks)
+        return downlinks
+
+    def _retry(self, device_id, port, reason):
+        attempts = self._conn.execute(
+            "SELECT attempts FROM downlink WHERE device_id = ? AND port = ?",
+            (device_id, port)).fetchone()[0]
+        if attempts >= self.max_attempts:
+            self.failed += 1
+            self.logger.error("Port %d downlink for %s %s after %d attempts - dropped",
+                              port, device_id, reason, attempts)
+            self._conn.execute("DELETE FROM downlink WHERE device_id = ? AND port = ?",
+                               (device_id, port))
+        else:
+            self.logger.warning("Port %d downlink for %s %s - will retry",
+                                port, device_id, reason)
+            self._conn.execute("UPDATE downlink SET state = ? WHERE device_id = ? "
+                               "AND port = ?", (QUEUED, device_id, port))
+
+    def on_event(self, event, payload):
+        # a TTN v3/<app>/devices/<device>/down/<event> message. Matched to
+        # our downlinks by the correlation ids in the raw payload
+        ids = [match.decode() for match in CORRELATION_RE.findall(payload)]
+        if not ids:
+            return
+
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for correlation_id in ids:
+                row = self._conn.execute(
+                    "SELECT device_id, port FROM downlink WHERE correlation_id = ?",
+                    (correlation_id,)).fetchone()
+                if row is None:
+                    continue  # replaced, or an event we have already had
+                device_id, port = row
+                if event == 'ack':
+                    self.acked += 1
+                    self.logger.info("Port %d downlink acked by %s", port, device_id)
+                    self._conn.execute("DELETE FROM downlink WHERE device_id = ? "
+                                       "AND port = ?", (device_id, port))
+                elif event == 'sent':
+                    self._conn.execute("UPDATE downlink SET state = ? WHERE device_id = ? "
+                                       "AND port = ?", (SENT, device_id, port))
+                elif event in ('nack', 'failed'):
+                    self._retry(device_id, port, event)
+            self._conn.execute("COMMIT")
+
+    def stats(self):
+        with self._lock:
+            states = dict(self._conn.execute(
+                "SELECT state, count(*) FROM downlink GROUP BY state"))
+        return {
+            'waiting': states.get(QUEUED, 0),
+            'in_flight': states.get(PUSHED, 0) + states.get(SENT, 0),
+            'pushed': self.pushed,
+            'acked': self.acked,
+            'failed': self.failed
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,253 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds - from a sub millisecond decode to a slow database or WOW upload
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class ingestMetrics(object):
+
+    # Counters, gauges and histograms in the Prometheus text format, with
+    # no client library needed. One shared instance (METRICS, below) is
+    # updated from wherever the work happens and served by metricsServer
+    # or written to a node_exporter textfile
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+        self.buckets = tuple(buckets)
+
+        self._types = {}  # name : (type, help)
+        self._values = {}  # (name, labels) : value
+        self._histograms = {}  # (name, labels) : [bucket counts, sum, count]
+        self._collectors = {}  # key : func
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        # kind is counter, gauge or histogram
+        self._types[name] = (kind, text)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][n] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # with METRICS.timer('basestation_decode_seconds'): ...
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def collector(self, key, func):
+        # func() is called on every render and returns {name: value} gauges
+        # (e.g. queue depth) that are cheaper read than kept up to date. A
+        # later func with the same key replaces the earlier one, so a
+        # listener that is set up again does not leave the old one behind
+        with self._lock:
+            self._collectors[key] = func
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('%s="%s"' % (key, value.replace('\\', '\\\\').replace('"', '\\"'))
+                              for key, value in labels) + '}'
+
+    def render(self):
+        with self._lock:
+            collectors = list(self._collectors.values())
+        for func in collectors:
+            try:
+                for name, value in func().items():
+                    self.set(name, value)
+            except Exception as error:
+                self.logger.error("Metrics collector failed: %s", error)
+
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted((key, (list(counts), total, count))
+                                for key, (counts, total, count) in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._types:
+                kind, text = self._types[name]
+                lines.append('# HELP %s %s' % (name, text))
+                lines.append('# TYPE %s %s' % (name, kind))
+            described.add(name)
+
+        for (name, labels), value in values:
+            header(name)
+            lines.append('%s%s %s' % (name, self._labels(labels), value))
+
+        for (name, labels), (counts, total, count) in histograms:
+            header(name)
+            for bound, bucket in zip(self.buckets, counts):
+                lines.append('%s_bucket%s %d' % (name, self._labels(labels, (('le', str(bound)),)), bucket))
+            lines.append('%s_bucket%s %d' % (name, self._labels(labels, (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %s' % (name, self._labels(labels), total))
+            lines.append('%s_count%s %d' % (name, self._labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # atomically, so node_exporter never reads half a file
+        temp = path + '.tmp'
+        with open(temp, 'w') as out:
+            out.write(self.render())
+        os.replace(temp, path)
+
+
+METRICS = ingestMetrics()
+
+METRICS.describe('basestation_messages_received_total', 'counter',
+                 'Uplinks decoded, by f_port and device')
+METRICS.describe('basestation_decode_seconds', 'histogram',
+                 'Time to decode an uplink (parse_data)')
+METRICS.describe('basestation_commit_seconds', 'histogram',
+                 'Time to hand a reading to the database or batch writer (commit_data)')
+METRICS.describe('basestation_db_write_seconds', 'histogram',
+                 'Time to write a batch of readings to PostgreSQL')
+METRICS.describe('basestation_db_rows_written_total', 'counter',
+                 'Readings written to PostgreSQL')
+METRICS.describe('basestation_db_failed_total', 'counter',
+                 'Readings PostgreSQL rejected, or that were lost while it was unreachable')
+METRICS.describe('basestation_db_write_errors_total', 'counter',
+                 'Batch writes that failed because PostgreSQL could not be reached')
+METRICS.describe('basestation_duplicates_dropped_total', 'counter',
+                 'Repeated uplinks dropped before decoding')
+METRICS.describe('basestation_db_duplicates_total', 'counter',
+                 'Readings PostgreSQL already had (same station and reading time)')
+METRICS.describe('basestation_mqtt_reconnects_total', 'counter',
+                 'Unexpected mqtt disconnections')
+METRICS.describe('basestation_station_last_seen_timestamp_seconds', 'gauge',
+                 'When each station was last heard from (epoch seconds)')
+METRICS.describe('basestation_station_rssi_dbm', 'gauge',
+                 'RSSI of the last uplink from each station')
+METRICS.describe('basestation_station_snr_db', 'gauge',
+                 'SNR of the last uplink from each station')
+METRICS.describe('basestation_wow_latest_seconds', 'histogram',
+                 'Time for a metofficeWow.latest run')
+METRICS.describe('basestation_ingest_queue_depth', 'gauge',
+                 'Messages waiting for the ingest workers')
+METRICS.describe('basestation_ingest_dropped_total', 'counter',
+                 'Messages dropped because the ingest queue was full')
+
+
+class _metricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+        data = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug("metrics: " + format, *args)
+
+
+class metricsServer(object):
+
+    # Serves /metrics on a background thread
+
+    def __init__(self, metrics=METRICS, host='127.0.0.1', port=9108):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising metricsServer object")
+
+        self.httpd = ThreadingHTTPServer((host, int(port)), _metricsHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.metrics = metrics
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        name='metrics', daemon=True)
+        self._thread.start()
+        self.logger.info("Serving metrics on http://%s:%d/metrics",
+                         *self.httpd.server_address[:2])
+
+    def stop(self):
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.httpd.server_close()
+
+
+class metricsTextfile(object):
+
+    # Rewrites a node_exporter textfile collector file every interval
+    # seconds on a background thread
+
+    def __init__(self, path, metrics=METRICS, interval=15):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising metricsTextfile object")
+
+        self.path = path
+        self.metrics = metrics
+        self.interval = float(interval)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.metrics.write_textfile(self.path)
+            except OSError as error:
+                self.logger.error("Unable to write metrics to %s: %s", self.path, error)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='metrics-textfile',
+                                        daemon=True)
+        self._thread.start()
+        self.logger.info("Writing metrics to %s every %ds", self.path, self.interval)
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.metrics.write_textfile(self.path)  # final values
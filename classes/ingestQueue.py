@@ -0,0 +1,119 @@
+import time
+import queue
+import logging
+import threading
+
+
+class ingestQueue(object):
+
+    # Bounded queue between the mqtt network thread and a pool of worker
+    # threads. submit() never blocks - if the workers cannot keep up the
+    # message is dropped and counted rather than stalling the mqtt loop
+
+    def __init__(self, handler, workers=2, queue_size=1000):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising ingestQueue object")
+
+        self.handler = handler
+        self.workers = int(workers)
+        self.queue = queue.Queue(maxsize=int(queue_size))
+
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+        self.max_depth = 0
+
+        # latency = time from submit() to the handler finishing
+        self._latency_total = 0.0
+        self._latency_count = 0
+        self._latency_max = 0.0
+
+        self._lock = threading.Lock()
+        self._threads = []
+
+        self.logger.debug("ingestQueue initialised (%d workers, queue %d)",
+                          self.workers, self.queue.maxsize)
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._worker,
+                                      name='ingest-%d' % n,
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, payload):
+        with self._lock:
+            self.received += 1
+        try:
+            self.queue.put_nowait((time.monotonic(), payload))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            self.logger.warning("Ingest queue full - message dropped")
+            return False
+
+        depth = self.queue.qsize()
+        with self._lock:
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return True
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            queued, payload = item
+            try:
+                self.handler(payload)
+                with self._lock:
+                    self.processed += 1
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                self.logger.exception("Error processing message")
+            finally:
+                latency = time.monotonic() - queued
+                with self._lock:
+                    self._latency_total += latency
+                    self._latency_count += 1
+                    if latency > self._latency_max:
+                        self._latency_max = latency
+                self.queue.task_done()
+
+    def stop(self):
+        # let the workers finish what is already queued, then exit
+        for thread in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self, reset_latency=True):
+        with self._lock:
+            if self._latency_count:
+                latency_avg = self._latency_total / self._latency_count
+            else:
+                latency_avg = 0.0
+            stats = {
+                'depth': self.queue.qsize(),
+                'max_depth': self.max_depth,
+                'received': self.received,
+                'dropped': self.dropped,
+                'processed': self.processed,
+                'errors': self.errors,
+                'latency_avg_ms': round(latency_avg * 1000, 1),
+                'latency_max_ms': round(self._latency_max * 1000, 1)
+            }
+            if reset_latency:
+                self._latency_total = 0.0
+                self._latency_count = 0
+                self._latency_max = 0.0
+                self.max_depth = 0
+        return stats
@@ -0,0 +1,139 @@
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from urllib import request, error as urlerror
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class latestReadings(object):
+
+    # The latest weather report for each station, as the listener decoded
+    # it - weather_reading column names plus rssi / snr, when it was
+    # received and whether it is in weather_reading yet (persisted). Shared
+    # by the ingest workers and the read api
+
+    def __init__(self):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising latestReadings object")
+
+        self._readings = {}  # station id : reading dict
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._readings)
+
+    def update(self, station_id, reading, rssi=None, snr=None):
+        # reading is {weather_reading column: value}. Older readings (late
+        # or replayed messages) do not replace newer ones
+        entry = dict(reading, rssi=rssi, snr=snr, received=time.time(),
+                     persisted=False)
+        with self._lock:
+            current = self._readings.get(station_id)
+            if current is not None and current['reading_time'] > entry['reading_time']:
+                return False
+            if current is not None and current['reading_time'] == entry['reading_time']:
+                entry['persisted'] = current['persisted']  # a repeat
+            self._readings[station_id] = entry
+        return True
+
+    def persisted(self, station_id, reading_time):
+        # the writer has committed this reading - ignored if a newer one has
+        # come in since
+        with self._lock:
+            entry = self._readings.get(station_id)
+            if entry is not None and entry['reading_time'] == reading_time:
+                entry['persisted'] = True
+
+    def get(self, station_id):
+        with self._lock:
+            entry = self._readings.get(station_id)
+        return dict(entry) if entry is not None else None
+
+    def all(self):
+        with self._lock:
+            return {station_id: dict(entry)
+                    for station_id, entry in self._readings.items()}
+
+
+class _latestHandler(BaseHTTPRequestHandler):
+
+    # GET /latest            every station
+    # GET /latest/<station>  one station, 404 if nothing received yet
+
+    def do_GET(self):
+        cache = self.server.cache
+        parts = self.path.strip('/').split('/')
+
+        if parts == ['latest']:
+            body = {str(station_id): entry for station_id, entry in cache.all().items()}
+        elif len(parts) == 2 and parts[0] == 'latest' and parts[1].lstrip('-').isdigit():
+            body = cache.get(int(parts[1]))
+            if body is None:
+                self.send_error(404, "No reading for station %s" % parts[1])
+                return
+        else:
+            self.send_error(404)
+            return
+
+        data = json.dumps(body, default=str).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug("latest api: " + format, *args)
+
+
+class latestServer(object):
+
+    # Serves a latestReadings over http on a background thread. Binds to
+    # localhost by default - this is for the WOW uploader and health
+    # checks on the same machine
+
+    def __init__(self, cache, host='127.0.0.1', port=8081):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising latestServer object")
+
+        self.httpd = ThreadingHTTPServer((host, int(port)), _latestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.cache = cache
+        self._thread = None
+
+        self.logger.debug("latestServer initialised")
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        name='latest-api', daemon=True)
+        self._thread.start()
+        self.logger.info("Serving latest readings on http://%s:%d/latest",
+                         *self.httpd.server_address[:2])
+
+    def stop(self):
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.httpd.server_close()
+
+
+def fetch_latest(url, station_id, timeout=2):
+    # Reading for one station from a latestServer at url (e.g.
+    # http://127.0.0.1:8081), with reading_time as a datetime. None if the
+    # listener has nothing for the station or cannot be reached
+    try:
+        with request.urlopen('%s/latest/%d' % (url.rstrip('/'), station_id),
+                             timeout=timeout) as response:
+            reading = json.loads(response.read())
+    except (urlerror.URLError, OSError, ValueError):
+        return None
+
+    reading['reading_time'] = datetime.fromisoformat(reading['reading_time'])
+    return reading
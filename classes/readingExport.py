@@ -0,0 +1,115 @@
+import csv
+import logging
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for parquet exports
+    pa = None
+
+try:
+    import numpy as np
+except ImportError:  # only needed for imperial units
+    np = None
+
+import utilities as convert
+from classes.databasePool import get_pool
+from classes.readingWriter import READING_COLUMNS
+
+# everything but the time and station is exported as a float, so csv and
+# parquet get the same values whatever the column types in the database
+EXPORT_QUERY = (
+    'SELECT reading_time, station_id, ' +
+    ', '.join(column + '::float8' for column in READING_COLUMNS[2:]) + ' '
+    'FROM weather_reading '
+    'WHERE station_id = %s AND reading_time >= %s AND reading_time < %s '
+    'ORDER BY reading_time')
+
+# --imperial: the units WOW uses. Converted a column at a time
+IMPERIAL = {
+    'wind_speed': ('kph', 'mph'),
+    'wind_gust': ('kph', 'mph'),
+    'wind_speed_avg2m': ('kph', 'mph'),
+    'wind_gust_10m': ('kph', 'mph'),
+    'temperature': ('celsius', 'fahrenheit'),
+    'rain_1h': ('mm', 'in'),
+    'rain_today': ('mm', 'in'),
+    'rain_since_last': ('mm', 'in'),
+    'bar_uncorrected': ('hpa', 'inhg'),
+    'bar_corrected': ('hpa', 'inhg'),
+}
+
+
+class readingExport(object):
+
+    # Streams weather_reading for a station and time range through a named
+    # (server side) cursor, chunk_rows at a time, so memory use does not
+    # depend on how much is exported
+
+    def __init__(self, chunk_rows=10000, imperial=False, **postgres_params):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising readingExport object")
+
+        self.pool = get_pool(**postgres_params)
+        self.chunk_rows = int(chunk_rows)
+        self.imperial = imperial
+
+        self.exported = 0
+
+        self.logger.debug("readingExport initialised")
+
+    def columns(self, station_id, since, until):
+        # yields each chunk as {column: [values]}
+        with self.pool.connection() as pconn:
+            pcur = pconn.cursor(name='reading_export')
+            pcur.itersize = self.chunk_rows
+            pcur.execute(EXPORT_QUERY, (station_id, since, until))
+            try:
+                while True:
+                    rows = pcur.fetchmany(self.chunk_rows)
+                    if not rows:
+                        break
+                    self.exported += len(rows)
+                    chunk = dict(zip(READING_COLUMNS, (list(column) for column in zip(*rows))))
+                    if self.imperial:
+                        self._convert(chunk)
+                    yield chunk
+            finally:
+                pcur.close()
+
+    @staticmethod
+    def _convert(chunk):
+        # missing values come back from numpy as nan - put the Nones back
+        if np is None:
+            raise ImportError("numpy is required for imperial units")
+        for column, (from_unit, to_unit) in IMPERIAL.items():
+            values = convert.convert(chunk[column], from_unit, to_unit)
+            chunk[column] = np.where(np.isnan(values), None, values).tolist()
+
+    def to_csv(self, out, station_id, since, until):
+        # out is an open text file
+        writer = csv.writer(out)
+        writer.writerow(READING_COLUMNS)
+        for chunk in self.columns(station_id, since, until):
+            writer.writerows(zip(*(chunk[column] for column in READING_COLUMNS)))
+        return self.exported
+
+    def to_parquet(self, path, station_id, since, until):
+        # one row group per chunk
+        if pa is None:
+            raise ImportError("pyarrow is required for parquet exports")
+
+        schema = pa.schema(
+            [('reading_time', pa.timestamp('us', tz='UTC')),
+             ('station_id', pa.int32())] +
+            [(column, pa.float64()) for column in READING_COLUMNS[2:]])
+
+        writer = pq.ParquetWriter(path, schema)
+        try:
+            for chunk in self.columns(station_id, since, until):
+                writer.write_table(pa.Table.from_pydict(chunk, schema=schema))
+        finally:
+            writer.close()
+        return self.exported
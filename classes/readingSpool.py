@@ -0,0 +1,93 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+
+class readingSpool(object):
+
+    # Local write-ahead journal for weather_reading rows (sqlite). Rows are
+    # written here before PostgreSQL and deleted once they are committed
+    # there, so a database outage costs latency rather than readings
+
+    def __init__(self, path, max_rows=100000):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising readingSpool object")
+
+        self.path = path
+        self.max_rows = int(max_rows)  # bounds disk use - oldest go first
+        self.discarded = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        # WAL with synchronous=NORMAL survives the process dying without an
+        # fsync per reading
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS reading ("
+                           "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "spooled REAL NOT NULL, "
+                           "row TEXT NOT NULL)")
+
+        self._count = self._conn.execute("SELECT count(*) FROM reading").fetchone()[0]
+
+        self.logger.debug("readingSpool initialised - %d readings waiting in %s",
+                          self._count, path)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, values):
+        with self._lock:
+            self._conn.execute("INSERT INTO reading (spooled, row) VALUES (?, ?)",
+                               (time.time(), json.dumps(list(values))))
+            self._count += 1
+
+            if self._count > self.max_rows:
+                excess = self._count - self.max_rows
+                self._conn.execute("DELETE FROM reading WHERE id IN "
+                                   "(SELECT id FROM reading ORDER BY id LIMIT ?)",
+                                   (excess,))
+                self._count -= excess
+                self.discarded += excess
+                self.logger.error("Spool full (%d readings) - oldest %d discarded",
+                                  self.max_rows, excess)
+
+    def peek(self, limit):
+        # oldest first, as [(id, row), ...]
+        with self._lock:
+            rows = self._conn.execute("SELECT id, row FROM reading "
+                                      "ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return [(rowid, tuple(json.loads(row))) for rowid, row in rows]
+
+    def delete(self, ids):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("DELETE FROM reading WHERE id = ?",
+                                   [(rowid,) for rowid in ids])
+            self._conn.execute("COMMIT")
+            self._count = self._conn.execute(
+                "SELECT count(*) FROM reading").fetchone()[0]
+
+    def oldest(self):
+        # epoch seconds the oldest waiting reading was spooled, or None
+        with self._lock:
+            return self._conn.execute(
+                "SELECT min(spooled) FROM reading").fetchone()[0]
+
+    def status(self):
+        oldest = self.oldest()
+        return {
+            'backlog': self._count,
+            'oldest_age_s': round(time.time() - oldest) if oldest else 0,
+            'discarded': self.discarded,
+            'max_rows': self.max_rows
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
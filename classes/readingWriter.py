@@ -0,0 +1,313 @@
+import time
+import logging
+import threading
+
+import psycopg2
+import psycopg2.extras
+
+from classes.ingestMetrics import METRICS
+
+# Column order of the rows handed to readingWriter.add() - see
+# weatherStation.reading_values()
+READING_COLUMNS = (
+    "reading_time",
+    "station_id",
+    "wind_dir",
+    "wind_speed",
+    "wind_gust",
+    "wind_gust_dir",
+    "wind_speed_avg2m",
+    "wind_dir_avg2m",
+    "wind_gust_10m",
+    "wind_gust_dir_10m",
+    "humidity",
+    "temperature",
+    "rain_1h",
+    "rain_today",
+    "rain_since_last",
+    "bar_uncorrected",
+    "bar_corrected",
+    "battery",
+    "light",
+)
+
+INSERT_READING = ("INSERT INTO weather_reading (" +
+                  ", ".join(READING_COLUMNS) + ") VALUES ")
+
+# sql/001_weather_reading_unique.sql - both ON CONFLICT clauses need it
+READING_INDEX = "weather_reading_station_time_key"
+
+# The listener keeps the reading it has - a repeat of one (e.g. redelivered
+# by TTN) must not add a second row or count its rain twice. Also needs the
+# unique index
+IGNORE_READING = " ON CONFLICT (station_id, reading_time) DO NOTHING"
+
+# Replays overwrite what is already there, so re-running one after a decoder
+# fix corrects the stored readings. Needs the unique index from
+# sql/001_weather_reading_unique.sql
+UPSERT_READING = (" ON CONFLICT (station_id, reading_time) DO UPDATE SET " +
+                  ", ".join("%s = EXCLUDED.%s" % (column, column)
+                            for column in READING_COLUMNS[2:]))
+
+
+class readingWriter(object):
+
+    # Buffers weather_reading rows and writes them in one statement when
+    # either batch_size rows are waiting or the oldest has waited flush_ms.
+    # With a readingSpool the buffer is the spool, so rows survive the
+    # database (or this process) going down and are retried with backoff.
+    # on_commit, if given, is called with the rows the database has after
+    # each write
+
+    # errors in the statement or the schema (missing table, column or the
+    # unique index ON CONFLICT needs, no permission) rather than in a row.
+    # Every row would fail the same way, so they are not tried one by one or
+    # counted as rejected - they stay in the spool until the schema is fixed
+    SCHEMA_ERRORS = (psycopg2.ProgrammingError,)
+
+    def __init__(self, pool, batch_size=50, flush_ms=2000, upsert=False,
+                 spool=None, max_backoff=300, on_commit=None):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising readingWriter object")
+
+        self.pool = pool
+        self.batch_size = int(batch_size)
+        self.flush_ms = int(flush_ms)
+        self.on_conflict = UPSERT_READING if upsert else IGNORE_READING
+        self.spool = spool
+        self.max_backoff = float(max_backoff)  # seconds
+        self.on_commit = on_commit
+
+        self.written = 0
+        self.duplicates = 0  # rows the database already had
+        self.failed = 0
+        self.batches = 0
+        self.last_error = None
+
+        self._committed = []  # rows of the current write the database has
+        self._rows = []
+        self._first_added = 0  # a backlog left in the spool is due now
+        self._retry_delay = 0
+        self._retry_at = 0
+        self._closing = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.RLock()
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='readingWriter',
+                                        daemon=True)
+        self._thread.start()
+
+        self.logger.debug("readingWriter initialised (batch %d rows, %d ms)",
+                          self.batch_size, self.flush_ms)
+
+    def add(self, values):
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("readingWriter is closed")
+            if not self.pending():
+                self._first_added = time.monotonic()
+            if self.spool is not None:
+                self.spool.append(values)
+            else:
+                self._rows.append(tuple(values))
+            pending = self.pending()
+            if pending == 1 or pending >= self.batch_size:
+                self._cond.notify()
+
+    def pending(self):
+        if self.spool is not None:
+            return len(self.spool)
+        return len(self._rows)
+
+    def status(self):
+        status = {
+            'pending': self.pending(),
+            'written': self.written,
+            'duplicates': self.duplicates,
+            'failed': self.failed,
+            'batches': self.batches,
+            'retry_in_s': round(max(0, self._retry_at - time.monotonic())),
+            'last_error': self.last_error
+        }
+        if self.spool is not None:
+            status.update(self.spool.status())
+        return status
+
+    def _take(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.pending() and not self._closing:
+                    self._cond.wait()
+                if self._closing:
+                    return  # close() writes whatever is left
+
+                deadline = self._first_added + self.flush_ms / 1000
+                while self.pending() < self.batch_size and not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                if self.spool is None:
+                    rows = self._take()
+
+            if self.spool is None:
+                self._write(rows)
+            elif not self._drain_batch():
+                self._backoff()
+
+    def _drain_batch(self):
+        # write the oldest spooled rows, deleting them once they are in the
+        # database. False if the database could not be reached or the
+        # schema is wrong (see _write)
+        with self._write_lock:
+            batch = self.spool.peek(self.batch_size)
+            if not batch:
+                return True
+            if not self._write([row for rowid, row in batch]):
+                return False
+            self.spool.delete([rowid for rowid, row in batch])
+            self._retry_delay = 0
+            self._retry_at = 0
+            return True
+
+    def _backoff(self):
+        # exponential backoff while the database is down - close() cuts it short
+        self._retry_delay = min(max(self._retry_delay * 2, 1), self.max_backoff)
+        self._retry_at = time.monotonic() + self._retry_delay
+        self.logger.warning("%d readings spooled - retrying database in %ds",
+                            self.pending(), self._retry_delay)
+        with self._cond:
+            if not self._closing:
+                self._cond.wait(self._retry_delay)
+
+    def flush(self):
+        # write anything buffered now, in the calling thread
+        if self.spool is not None:
+            while self.pending():
+                if not self._drain_batch():
+                    self.logger.warning("%d readings left in spool %s",
+                                        self.pending(), self.spool.path)
+                    return
+            return
+
+        with self._cond:
+            rows = self._take()
+        if rows:
+            self._write(rows)
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+        if self.spool is not None:
+            self.spool.close()
+        self.logger.info("readingWriter closed: %d rows in %d batches, %d duplicates, %d failed",
+                         self.written, self.batches, self.duplicates, self.failed)
+
+    def _insert_batch(self, pconn, rows):
+        cursor = pconn.cursor()
+        psycopg2.extras.execute_values(cursor,
+                                       INSERT_READING + "%s" + self.on_conflict,
+                                       rows, page_size=len(rows))
+        inserted = cursor.rowcount  # one statement - rows not already there
+        pconn.commit()
+        cursor.close()
+        return inserted
+
+    def _insert_rows(self, pconn, rows):
+        # slow path after a failed batch - one bad row only loses itself
+        cursor = pconn.cursor()
+        query = (INSERT_READING + "(" + ", ".join(["%s"] * len(READING_COLUMNS)) +
+                 ")" + self.on_conflict)
+        for row in rows:
+            try:
+                cursor.execute(query, row)
+                pconn.commit()
+                self._committed.append(row)
+                if cursor.rowcount == 0:
+                    self.duplicates += 1
+                else:
+                    self.written += 1
+            except self.pool.CONNECTION_ERRORS:
+                raise
+            except self.SCHEMA_ERRORS:
+                pconn.rollback()
+                raise
+            except psycopg2.Error as error:
+                pconn.rollback()
+                self.failed += 1
+                self.logger.error("PostgreSQL error - reading not inserted: %s", row)
+                self.logger.error(error)
+        cursor.close()
+
+    def _insert(self, pconn, rows):
+        # the batch, or row by row if it is rejected. Safe to repeat on a new
+        # connection - rows already in are counted as duplicates
+        self._committed = []
+        try:
+            inserted = self._insert_batch(pconn, rows)
+            self._committed = list(rows)
+            self.written += inserted
+            self.duplicates += len(rows) - inserted
+        except self.pool.CONNECTION_ERRORS:
+            raise
+        except self.SCHEMA_ERRORS:
+            pconn.rollback()
+            raise
+        except psycopg2.Error as error:
+            pconn.rollback()
+            self.logger.warning("Batch of %d rows failed, retrying row by row: %s",
+                                len(rows), error)
+            self._insert_rows(pconn, rows)
+
+    def _write(self, rows):
+        # True once every row is either in the database or has been rejected
+        # by it. False if the database could not be reached, or the statement
+        # failed on the schema (SCHEMA_ERRORS) - the rows are lost unless
+        # they are in the spool
+        with self._write_lock, METRICS.timer('basestation_db_write_seconds'):
+            written, failed, duplicates = self.written, self.failed, self.duplicates
+            try:
+                self.pool.run(lambda pconn: self._insert(pconn, rows))
+                self.batches += 1
+                self.last_error = None
+                METRICS.inc('basestation_db_rows_written_total', self.written - written)
+                METRICS.inc('basestation_db_failed_total', self.failed - failed)
+                METRICS.inc('basestation_db_duplicates_total', self.duplicates - duplicates)
+                self.logger.debug('%i records inserted into database.', self.written - written)
+                self._notify_commit()
+                return True
+            except (Exception, psycopg2.DatabaseError) as error:
+                self.last_error = str(error).strip()
+                self.logger.error("PostgreSQL error")
+                self.logger.error(error)
+                METRICS.inc('basestation_db_write_errors_total')
+                METRICS.inc('basestation_db_rows_written_total', self.written - written)
+                METRICS.inc('basestation_db_duplicates_total', self.duplicates - duplicates)
+                if self.spool is None:
+                    lost = len(rows) - (self.written - written) - (self.failed - failed) \
+                        - (self.duplicates - duplicates)
+                    self.failed += lost
+                    self.logger.error("%d readings not inserted", lost)
+                METRICS.inc('basestation_db_failed_total', self.failed - failed)
+                self._notify_commit()  # any that went in row by row
+                return False
+
+    def _notify_commit(self):
+        committed, self._committed = self._committed, []
+        if self.on_commit is None or not committed:
+            return
+        try:
+            self.on_commit(committed)
+        except Exception:
+            self.logger.exception("on_commit failed")
@@ -5,6 +5,7 @@ import math
 import sys
 import os
 import logging
+import threading
 
 import collections
 import psycopg2
@@ -14,10 +15,22 @@ import random
 import json
 import base64
 
+from classes.databasePool import get_pool
+from classes.ingestQueue import ingestQueue
+from classes.uplinkArchive import uplinkArchive
+from classes.downlinkScheduler import downlinkScheduler
+from classes.clockDrift import clockDrift
+from classes.uplinkDedup import uplinkDedup
+from classes.ingestMetrics import METRICS
+from classes.uplinkDecoder import uplinkDecoder, BASELINE_TIME
+from classes.readingWriter import readingWriter, READING_COLUMNS, INSERT_READING, IGNORE_READING, \
+    READING_INDEX
+
 
 class ttnMQTT(object):
 
-    def __init__(self, weather_station, commit=False, **ttn_params):
+    def __init__(self, weather_station, commit=False, ingest_params=None,
+                 applications=None, **ttn_params):
 
         self.logger = logging.getLogger(__name__)
         self.logger.addHandler(logging.NullHandler())
@@ -31,32 +44,333 @@ class ttnMQTT(object):
         self.client_id = f'python=mqtt-{random.randint(0,1000)}'
         self.ttn_params = ttn_params
 
+        # ttn_params for every TTN application to listen to - one mqtt
+        # connection each, all feeding the same ingest queue
+        if not applications:
+            applications = [ttn_params]
+        self.applications = applications
+        self.reconnects = 0
+        self._clients = []  # listening - [(mqtt client, ttn_params), ...]
+        self._pending = {}  # mqtt client : ttn_params to reconnect with
+        self._pending_lock = threading.Lock()
+
+        if ingest_params is None:
+            ingest_params = {}
+        self.workers = int(ingest_params.get('workers', 2))
+        self.queue_size = int(ingest_params.get('queue_size', 1000))
+        self.stats_interval = int(ingest_params.get('stats_interval', 300))
+        self.ingest = None  # created by process_link for uplinks
+
+        self.archive = None
+        if ingest_params.get('archive_dir'):
+            self.archive = uplinkArchive(
+                ingest_params['archive_dir'],
+                ingest_params.get('archive_segment_mb', 16),
+                ingest_params.get('archive_segment_hours', 24),
+                ingest_params.get('archive_keep', 0))
+
+        # copies of an uplink (redelivered after a reconnect...) are dropped
+        self.dedup = None
+        if int(ingest_params.get('dedup_size', 10000)) > 0:
+            self.dedup = uplinkDedup(ingest_params.get('dedup_size', 10000),
+                                     ingest_params.get('dedup_hours', 24))
+
+        # downlinks queued until each device's next uplink
+        self.scheduler = None
+        self._device_clients = {}  # device id : (mqtt client, application)
+        if ingest_params.get('downlink_path'):
+            self.scheduler = downlinkScheduler(
+                ingest_params['downlink_path'],
+                lambda: weather_station.sync_time(0),
+                ingest_params.get('downlink_sync_hours', 24),
+                ingest_params.get('downlink_max_attempts', 3))
+
+        # station clocks are corrected (200 downlinks) from their drift
+        # against TTN's received_at - needs the scheduler to send them
+        self.drift = None
+        if self.scheduler is not None and float(ingest_params.get('drift_threshold', 0)) > 0:
+            self.drift = clockDrift(
+                ingest_params.get('drift_window', 48),
+                ingest_params['drift_threshold'],
+                ingest_params.get('drift_min_points', 12),
+                ingest_params.get('drift_cooldown_hours', 6))
+
+    @staticmethod
+    def received_time(parsed_json):
+        # TTN's received_at (RFC 3339, nanoseconds) as epoch seconds
+        stamp = parsed_json.get('received_at') \
+            or parsed_json.get('uplink_message', {}).get('received_at')
+        if not stamp:
+            return time.time()
+        seconds, _, fraction = stamp.rstrip('Z').partition('.')
+        received = datetime.fromisoformat(seconds).replace(tzinfo=timezone.utc).timestamp()
+        if fraction:
+            received += float('0.' + fraction)
+        return received
+
+    def check_drift(self, parsed_json, data):
+        # queue a time sync with a correction if the station's clock has
+        # drifted too far
+        if 'offset_time' not in data:
+            return
+        device_id = parsed_json['end_device_ids']['device_id']
+        correction = self.drift.add(device_id, self.received_time(parsed_json),
+                                    data['offset_time'] + BASELINE_TIME)
+        if correction is not None:
+            weather_station = self.client_userdata['weather_station']
+            self.scheduler.add(device_id, 200, weather_station.sync_time(correction))
+
+    def push_downlinks(self, parsed_json):
+        # the device has just been heard from - push whatever the scheduler
+        # has for it over the connection the uplink arrived on. Repeats
+        # have already been dropped by the dedup
+        device_id = parsed_json['end_device_ids']['device_id']
+        uplink = parsed_json.get('uplink_message')
+        # TTN leaves f_cnt out of the json when it is 0
+        f_cnt = uplink.get('f_cnt', 0) if uplink is not None else None
+        downlinks = self.scheduler.on_uplink(device_id, f_cnt)
+        if not downlinks:
+            return
+
+        mqttc, application = self._device_clients[device_id]
+        topic = "v3/" + application + "/devices/" + device_id + "/down/push"
+        for port, data, correlation_id in downlinks:
+            msg = self.downlink_message(port, data, correlation_id, confirmed=True)
+            info = mqttc.publish(topic, msg, qos=1)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                self.logger.info("Send %s to topic %s", msg, topic)
+            else:
+                self.logger.error("Failed to send message to topic %s: %s",
+                                  topic, mqtt.error_string(info.rc))
+                self.scheduler.add(device_id, port, data)  # try again next uplink
+
+    def handle_uplink(self, payload):
+        # runs on an ingest worker thread - decode and (maybe) commit one
+        # raw mqtt payload
+        parsed_json = json.loads(payload)
+        if self.dedup is not None and self.dedup.seen(parsed_json):
+            self.logger.debug("Duplicate uplink dropped")
+            return
+        handled = False
+        try:
+            handled = self._handle_uplink(parsed_json)
+        finally:
+            if not handled and self.dedup is not None:
+                self.dedup.forget(parsed_json)
+
+    def _handle_uplink(self, parsed_json):
+        # False if the reading could not be written
+        weather_station = self.client_userdata['weather_station']
+        data = weather_station.parse_data(parsed_json)
+        self.logger.debug("Decoded data:%s", data)
+
+        if self.drift is not None:
+            self.check_drift(parsed_json, data)
+        if self.scheduler is not None:
+            self.push_downlinks(parsed_json)
+
+        if 'No payload' in data:
+            self.logger.info("Ignoring message with no payload")
+            return True
+
+        weather_station.cache_latest(data)
+
+        if self.client_userdata['commit']:
+            return weather_station.commit_data(data)
+        return True
+
+    def log_stats(self):
+        stats = self.ingest.stats()
+        self.logger.info("Ingest queue: depth %(depth)d (max %(max_depth)d), "
+                         "received %(received)d, dropped %(dropped)d, "
+                         "processed %(processed)d, errors %(errors)d, "
+                         "latency avg %(latency_avg_ms)sms max %(latency_max_ms)sms, "
+                         "reconnects %(reconnects)d",
+                         dict(stats, reconnects=self.reconnects))
+
+        writer = self.client_userdata['weather_station'].writer
+        if writer is not None:
+            stats['writer'] = writer.status()
+            self.logger.info("Writer: %s", stats['writer'])
+        if self.dedup is not None:
+            stats['dedup'] = self.dedup.stats()
+            self.logger.info("Dedup: %s", stats['dedup'])
+        if self.scheduler is not None:
+            stats['downlinks'] = self.scheduler.stats()
+            self.logger.info("Downlinks: %s", stats['downlinks'])
+        if self.drift is not None:
+            stats['clocks'] = self.drift.status()
+            self.logger.info("Station clocks: %s", stats['clocks'])
+        return stats
+
+    def _topics(self, ttn_params):
+        # only uplinks - not the join / ack / location traffic under #.
+        # The scheduler also needs the downlink events
+        devices = "v3/" + ttn_params['user'] + "/devices/+/"
+        if self.scheduler is None:
+            return [devices + "up"]
+        return [devices + "up", devices + "down/+"]
+
+    def _apply_settings(self, client, ttn_params):
+        # only sets the client's fields - the connection is (re)made by the
+        # client's network thread
+        client.user_data_set(dict(self.client_userdata, application=ttn_params['user'],
+                                  topic=self._topics(ttn_params)))
+        client.username_pw_set(ttn_params['user'], ttn_params['password'])
+        client.connect_async(ttn_params['public_tls_address'],
+                             int(ttn_params['public_tls_address_port']), 60)
+
+    def reconfigure(self, applications):
+        # New [mqtt] settings (e.g. rotated credentials) for a running
+        # listener. Clients whose settings changed reconnect with them -
+        # the ingest queue and the writer carry on, so nothing already
+        # received is lost. Called from the config reload thread, so the
+        # socket is left to each client's network thread: a connected
+        # client is asked to disconnect, and on_disconnect (on that thread)
+        # applies the new settings, which the network loop then reconnects
+        # with. A client that is not connected just gets the new settings
+        # for its next retry
+        applications = list(applications)
+        if len(applications) != len(self.applications):
+            self.logger.warning("TTN applications added or removed - "
+                                "restart the listener to pick them up")
+        for n, (client, old) in enumerate(self._clients[:len(applications)]):
+            new = applications[n]
+            if new == old:
+                continue
+            self.logger.info("mqtt settings for %s changed - reconnecting", new['user'])
+            self._clients[n] = (client, new)
+            if client.is_connected():
+                with self._pending_lock:
+                    self._pending[client] = new
+                client.disconnect()
+            else:
+                self._apply_settings(client, new)
+
+        for n, new in enumerate(applications[:len(self.applications)]):
+            self.applications[n] = new
+        self.ttn_params = self.applications[0]
+
+    @staticmethod
+    def downlink_message(port, data='', correlation_id=None, confirmed=False):
+        # TTN v3 down/push body for a hex payload. A correlation id comes
+        # back in TTN's down/... events for the downlink; confirmed
+        # downlinks are acked by the device (down/ack)
+        if data != '':
+            b64 = base64.b64encode(bytes.fromhex(data)).decode()
+        else:
+            b64 = 'AA=='  # Zero
+        downlink = {'f_port': port, 'frm_payload': b64, 'priority': 'NORMAL'}
+        if confirmed:
+            downlink['confirmed'] = True
+        if correlation_id is not None:
+            downlink['correlation_ids'] = [correlation_id]
+        return json.dumps({'downlinks': [downlink]})
+
+    def send_downlinks(self, downlinks, timeout=30):
+        # downlinks is [(device_id, port, hex data), ...]. Publishes them all
+        # over one connection to the [mqtt] application with QoS 1, and
+        # waits up to timeout seconds for the broker to acknowledge each
+        # (on_publish). Returns [(device_id, port, result), ...] where
+        # result is 'confirmed', 'unconfirmed' or why it was not sent
+        connected = threading.Event()
+        acked = set()
+        done = threading.Condition()
+
+        def on_connect(client, userdata, flags, rc):
+            if rc == 0:
+                connected.set()
+            else:
+                self.logger.error("Failed to connect to %s: %d",
+                                  self.ttn_params['user'], rc)
+
+        def on_publish(client, userdata, mid):
+            with done:
+                acked.add(mid)
+                done.notify_all()
+
+        mqttc = mqtt.Client(self.client_id)
+        mqttc.on_connect = on_connect
+        mqttc.on_publish = on_publish
+        mqttc.username_pw_set(self.ttn_params['user'],
+                              self.ttn_params['password'])
+        mqttc.tls_set()
+        mqttc.connect(self.ttn_params['public_tls_address'],
+                      int(self.ttn_params['public_tls_address_port']), 60)
+        mqttc.loop_start()
+
+        results = []
+        try:
+            if not connected.wait(timeout):
+                return [(device_id, port, 'not sent - unable to connect')
+                        for device_id, port, data in downlinks]
+
+            published = []  # (mid, device_id, port)
+            for device_id, port, data in downlinks:
+                topic = "v3/" + self.ttn_params['user'] + "/devices/" + device_id + "/down/push"
+                msg = self.downlink_message(port, data)
+                info = mqttc.publish(topic, msg, qos=1)
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    self.logger.info("Send %s to topic %s", msg, topic)
+                    published.append((info.mid, device_id, port))
+                else:
+                    self.logger.error("Failed to send message to topic %s: %s",
+                                      topic, mqtt.error_string(info.rc))
+                    results.append((device_id, port,
+                                    'not sent - ' + mqtt.error_string(info.rc)))
+
+            deadline = time.monotonic() + timeout
+            with done:
+                while any(mid not in acked for mid, device_id, port in published):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    done.wait(remaining)
+                for mid, device_id, port in published:
+                    results.append((device_id, port,
+                                    'confirmed' if mid in acked else 'unconfirmed'))
+        finally:
+            mqttc.disconnect()
+            mqttc.loop_stop()
+
+        return results
+
     def process_link(self, direction='UPLINK', data='', port = 0):
 
         # define callbacks
 
         def on_message(client, userdata, message):
+            # keep this quick - it runs on the mqtt network thread. The
+            # decode and database work happens on the ingest workers
             self = userdata['ttnMQTT']
             self.logger.debug("Message received")
-            parsed_json = json.loads(message.payload)
-            weather_station = userdata[
-                'weather_station']  # weatherStation object is in userdata
-            data = weather_station.parse_data(parsed_json)
-            self.logger.debug("Decoded data:%s", data)
-
-            if 'No payload' in data:
-                self.logger.info("Ignoring message with no payload")
+            # v3/<application>/devices/<device>/up or .../down/<event>
+            topic = message.topic.split('/')
+            if len(topic) > 5 and topic[4] == 'down':
+                self.scheduler.on_event(topic[5], message.payload)
                 return
-
-            if userdata['commit']:
-                weather_station.commit_data(data)
+            if self.scheduler is not None:
+                self._device_clients[topic[3]] = (client, userdata['application'])
+            if self.archive is not None:
+                try:
+                    self.archive.append(message.payload)
+                except OSError as error:
+                    self.logger.error("Unable to archive message: %s", error)
+            self.ingest.submit(message.payload)
 
         def on_connect(client, userdata, flags, rc):
             self = userdata['ttnMQTT']
             if rc == 0:
-                self.logger.info("Connected")
+                self.logger.info("Connected to %s", userdata['application'])
+                if userdata['topic'] is not None:
+                    # (re)subscribe on every connect - sessions are not kept
+                    for topic in userdata['topic']:
+                        self.logger.info("Subscribing to topic %s with QOS: %d",
+                                         topic, qos)
+                        client.subscribe(topic, qos)
             else:
-                self.logger.error("Failed to connect")
+                self.logger.error("Failed to connect to %s",
+                                  userdata['application'])
 
         def on_subscribe(client, userdata, mid, granted_qos):
             self = userdata['ttnMQTT']
@@ -65,36 +379,58 @@ class ttnMQTT(object):
         def on_disconnect(client, userdata, rc):
 
             self = userdata['ttnMQTT']
-            self.logger.info("\nDisconnected with result code %d", rc)
+            self.logger.info("\nDisconnected from %s with result code %d",
+                             userdata['application'], rc)
+            with self._pending_lock:
+                ttn_params = self._pending.pop(client, None)
+            if ttn_params is not None:
+                # asked to by reconfigure - connect_async leaves the client
+                # for the network loop to reconnect, with the new settings
+                self._apply_settings(client, ttn_params)
+                self.logger.info("Reconnecting as %s", ttn_params['user'])
+                return
             if rc != 0:
-                raise ConnectionError(
-                    "Unexpected disconnection from mqtt. Result: " + str(rc))
+                if userdata['topic'] is not None:
+                    # listening - the client's network thread reconnects
+                    self.reconnects += 1
+                    METRICS.inc('basestation_mqtt_reconnects_total',
+                                application=userdata['application'])
+                    self.logger.warning("Unexpected disconnection from mqtt - reconnecting")
+                else:
+                    raise ConnectionError(
+                        "Unexpected disconnection from mqtt. Result: " + str(rc))
 
         def stop(client):
             client.disconnect()
 
-        mqttc = mqtt.Client(self.client_id, userdata=self.client_userdata)
+        def make_client(ttn_params, topic=None):
+            # one client per TTN application. topic is a list of topics
+            # subscribed to on connect
+            userdata = dict(self.client_userdata,
+                            application=ttn_params['user'], topic=topic)
+            mqttc = mqtt.Client(f'python=mqtt-{random.randint(0,1000)}',
+                                userdata=userdata)
 
-        # assign callbacks
+            # assign callbacks
 
-        mqttc.on_connect = on_connect
-        mqttc.on_subscribe = on_subscribe
-        mqttc.on_message = on_message
-        mqttc.on_disconnect = on_disconnect
+            mqttc.on_connect = on_connect
+            mqttc.on_subscribe = on_subscribe
+            mqttc.on_message = on_message
+            mqttc.on_disconnect = on_disconnect
 
-        #  authenticate
+            #  authenticate
 
-        mqttc.username_pw_set(self.ttn_params['user'],
-                              self.ttn_params['password'])
+            mqttc.username_pw_set(ttn_params['user'],
+                                  ttn_params['password'])
 
-        mqttc.tls_set()
+            mqttc.tls_set()
 
-        # connect
+            # connect
 
-        mqttc.connect(self.ttn_params['public_tls_address'],
-                      int(self.ttn_params['public_tls_address_port']), 60)
+            mqttc.connect(ttn_params['public_tls_address'],
+                          int(ttn_params['public_tls_address_port']), 60)
 
-        # subscribe
+            return mqttc
 
         # Meaning Quality of Service (QoS)
         # QoS = 0 - at most once
@@ -109,19 +445,45 @@ class ttnMQTT(object):
 
         if direction == 'UPLINK':
 
-            self.logger.info("Subscribing to topic # with QOS: %d", qos)
+            self.ingest = ingestQueue(self.handle_uplink, self.workers,
+                                      self.queue_size)
+            self.ingest.start()
+            METRICS.collector('ingest_queue', lambda: {
+                'basestation_ingest_queue_depth': self.ingest.queue.qsize(),
+                'basestation_ingest_dropped_total': self.ingest.dropped})
+            next_stats = time.monotonic() + self.stats_interval
 
-            mqttc.subscribe("#", qos)
+            self._clients = [(make_client(ttn_params, self._topics(ttn_params)), ttn_params)
+                             for ttn_params in self.applications]
+            clients = [mqttc for mqttc, ttn_params in self._clients]
+
+            for mqttc in clients:
+                mqttc.loop_start()
 
             try:
                 run = True
                 while run:
-                    mqttc.loop(10)
-                    print(".", end="", flush=True)
+                    time.sleep(10)
+                    if time.monotonic() >= next_stats:
+                        self.log_stats()
+                        next_stats = time.monotonic() + self.stats_interval
             except KeyboardInterrupt:
-                stop(mqttc)
+                for mqttc in clients:
+                    stop(mqttc)
+            finally:
+                for mqttc in clients:
+                    mqttc.loop_stop()
+                # finish anything already queued before the writer is closed
+                self.ingest.stop()
+                self.log_stats()
+                if self.archive is not None:
+                    self.archive.close()
+                if self.scheduler is not None:
+                    self.scheduler.close()
 
         elif direction == 'DOWNLINK':  # downlink = TTN >> end_device
+            mqttc = make_client(self.ttn_params)
+
             topic = "v3/" + self.ttn_params[
                 'user'] + "/devices/" + self.ttn_params[
                     'device_id'] + "/down/push"
@@ -134,15 +496,7 @@ class ttnMQTT(object):
 
             #self.logger.info("Sending message via loraWAN port: %d ", port)
 
-            if data != '':
-                b64 = base64.b64encode(bytes.fromhex(data)).decode()
-                self.logger.debug("Convert hex payload %s to base64 %s", data,b64)
-                
-            else:
-                b64 = 'AA==' # Zero
-                
-
-            msg = '{"downlinks":[{"f_port":' + str(fport) + ',"frm_payload":"' + b64 + '","priority": "NORMAL"}]}'
+            msg = self.downlink_message(fport, data)
             
             result = mqttc.publish(topic, msg, qos)
             # result: [0, 2]
@@ -156,38 +510,85 @@ class ttnMQTT(object):
 
 class weatherStation(object):
 
-    def _get_stations(self, **postgres_params):
+    def _get_stations(self):
         # gets the details of all the stations from the psql database
         # for future use
         self.logger.debug(
             "getting list of available weather stations from database")
         stations = {}
         try:
-            pconn = psycopg2.connect(**postgres_params)
-            pcur = pconn.cursor()
-            self.logger.debug("PostgreSQL connection open")
-            pcur.execute(
-                "SELECT id,name, latitude, longitude, altitude, eu_id  FROM weather_station"
-            )
-            stations = {
-                col1: (col2, col3, col4, col5, col6)
-                for (col1, col2, col3, col4, col5, col6) in pcur.fetchall()
-            }
-
-            # close the communication with the PostgreSQL
-            pconn.close()
-            self.logger.debug("PostgreSQL connection closed")
+            with self.pool.connection() as pconn:
+                pcur = pconn.cursor()
+                self.logger.debug("PostgreSQL connection open")
+                if self.station_ids is None:
+                    pcur.execute(
+                        "SELECT id,name, latitude, longitude, altitude, eu_id  FROM weather_station"
+                    )
+                else:
+                    pcur.execute(
+                        "SELECT id,name, latitude, longitude, altitude, eu_id  FROM weather_station "
+                        "WHERE id = any(%s)", (list(self.station_ids),)
+                    )
+                stations = {
+                    col1: (col2, col3, col4, col5, col6)
+                    for (col1, col2, col3, col4, col5, col6) in pcur.fetchall()
+                }
+                pcur.close()
+            self.logger.debug("PostgreSQL connection returned to pool")
         except (Exception, psycopg2.DatabaseError) as error:
             self.logger.error("PostgreSQL error")
             self.logger.error(error)
-        finally:
-            if pconn is not None:
-                pconn.close()
-                self.logger.debug('PostgreSQL connection tidied up')
 
         return stations
 
-    def __init__(self, station_id, **postgres_params):
+    @staticmethod
+    def normalise_eui(device_id):
+        # 'eui-70b3d57ed005a1b2' (ttn device id) or '70B3D57ED005A1B2'
+        # (weather_station.eu_id) -> '70B3D57ED005A1B2'
+        if device_id is None:
+            return ''
+        return (device_id.partition('eui-')[2] or device_id).strip().upper()
+
+    def _load_stations(self):
+        # (re)load the station table and the eui -> station id index. If the
+        # load fails keep what we had rather than losing every lookup
+        stations = self._get_stations()
+        if not stations and self.stations:
+            self.logger.warning("Station reload failed - keeping previous list")
+        else:
+            eui_index = {
+                self.normalise_eui(station[4]): key
+                for key, station in stations.items() if station[4]
+            }
+            # swap both in one go - workers may be reading them
+            self.stations, self.eui_index = stations, eui_index
+            self.logger.debug("%d stations loaded, %d with an eui",
+                              len(stations), len(eui_index))
+        self._stations_loaded = time.monotonic()
+
+    def station_for_device(self, device_id):
+        # station id for a ttn device id, -99 if it is not in weather_station.
+        # The index is reloaded every station_refresh seconds, or sooner
+        # (at most once a minute) when an unknown device turns up, so new
+        # stations are picked up without restarting the listener
+        eui = self.normalise_eui(device_id)
+        age = time.monotonic() - self._stations_loaded
+        sid = self.eui_index.get(eui)
+
+        if age >= self.station_refresh or (sid is None and age >= 60):
+            if self._reload_lock.acquire(blocking=False):
+                try:
+                    self._load_stations()
+                finally:
+                    self._reload_lock.release()
+                sid = self.eui_index.get(eui)
+
+        if sid is None:
+            return -99
+        return sid
+
+    def __init__(self, station_id, station_refresh=300, station_ids=None,
+                 **postgres_params):
         # to do - validate ststaion key as 16 characters
 
         self.VALID_MESSAGES = {
@@ -202,25 +603,36 @@ class weatherStation(object):
         self.logger.addHandler(logging.NullHandler())
         self.logger.debug("initialising weatherStation object")
 
-        self.stations = self._get_stations(**postgres_params)
+        self.postgres_params = postgres_params
+        self.pool = get_pool(**postgres_params)
+
+        self.station_refresh = int(station_refresh)  # seconds
+        # only load these stations (e.g. just the one a downlink is for)
+        # rather than the whole table - None loads them all
+        self.station_ids = station_ids
+        self.stations = {}
+        self.eui_index = {}
+        self._reload_lock = threading.Lock()
+        self._load_stations()
         self.station_id = station_id
 
         self.station_data = self.stations[station_id]
 
-        self.postgres_params = postgres_params
+        self.decoder = uplinkDecoder()
+
+        self.writer = None  # see start_writer()
+        self.latest = None  # latestReadings - see cache_latest()
 
         self.logger.debug("weatherStation initialised")
     
-    def _process_2s_complement_wind (self,sensor_direction):
-        # works for 3 hex digit integers only (ie up to 4095) 
-        # Could develop a more general proc?
+    def device_for_station(self, station_id):
+        # ttn device id ('eui-...') for a station, None if it has no eu_id
+        station = self.stations.get(station_id)
+        if station is None or not station[4]:
+            return None
+        return 'eui-' + self.normalise_eui(station[4]).lower()
 
-        if sensor_direction > 0xcff:  # -ve number 2s complement
-                return -1 * (0xfff - sensor_direction + 1)
-        else:
-            return sensor_direction
-                 
-    def send_data(self):
+    def send_data(self, station_id=None):
 
         # Generates a '201' message type
         # |0050FA90|FFFD85D1|00BE 
@@ -231,19 +643,24 @@ class weatherStation(object):
         # Note message type is now transferred via loraWAN port number
 
 
-        latitude_int = int(self.station_data[1] * 100000)
+        if station_id is None:
+            station_data = self.station_data
+        else:
+            station_data = self.stations[station_id]
+
+        latitude_int = int(station_data[1] * 100000)
         if latitude_int < 0:
             latitude_int = latitude_int + 4294967295  # This is a fudge to generate 2s complement for -ve latitude
 
         latitude_hex = hex(latitude_int).replace('0x', '').zfill(8)
 
-        longitude_int = int(self.station_data[2] * 100000)
+        longitude_int = int(station_data[2] * 100000)
         if longitude_int < 0:
             longitude_int = longitude_int + 4294967295  # This is a fudge to generate 2s complement for -ve longitude
 
         longitude_hex = hex(longitude_int).replace('0x', '').zfill(8)
 
-        altitude = self.station_data[3]
+        altitude = station_data[3]
 
         if altitude < 0:  # This is a fudge to generate 2s complement for -ve heights - Dead Sea!
             altitude = altitude + 65536
@@ -313,14 +730,7 @@ class weatherStation(object):
 
         # get station_id from the ttn device ID - handy later
 
-        station_id = -99
-
-        dev_eui_upper = mqtt_params['device_id'].partition('eui-')[2].upper()
-
-        for key in self.stations:
-            if self.stations[key][4] == dev_eui_upper:
-                station_id = key
-                break
+        station_id = self.station_for_device(mqtt_params['device_id'])
 
         latitude_int = int(self.latitude * 100000)
         if latitude_int < 0:
@@ -345,51 +755,32 @@ class weatherStation(object):
         self._rak811_send_data(message)
 
     def parse_data(self, parsed_json):
-        # define the splits in the data string
-        # all message types
-        MESSAGE_TYPE = slice(0, 2)
-
-        OFFSET_TIME = slice(0, 8)
-        TIMEZONE = slice(8, 10)
-
-        # for weather report - port 100  
-        WIND_DIR = slice(10, 13)
-        WIND_SPEED = slice(13, 17)
-        WIND_GUST = slice(17, 21)
-        WIND_GUST_DIR = slice(21, 24)
-        WIND_SPEED_2M = slice(24, 28)
-        WIND_DIR_2M = slice(28, 31)
-        WIND_GUST_10M = slice(31, 35)
-        WIND_GUST_10M_DIRECTION = slice(35, 38)
-        HUMIDITY = slice(38, 42)
-        TEMPERATURE = slice(42, 46)
-        RAIN_1H = slice(46, 50)
-        RAIN_TODAY = slice(50, 54)
-        RAIN_SINCE_LAST = slice(54, 58)
-        BAR_UNCORRECTED = slice(58, 62)
-        BAR_CORRECTED = slice(62, 66)
-        VOLTAGE = slice(66,70) 
-
-        # for station_report - id 101 (0x65)
-        LATITUDE = slice(10, 18)
-        LONGITUDE = slice(18, 26)
-        ALTITUDE = slice(26, 30)
-
-
-        # Baselines - used to save bytes should be the same as the weather station constants.h file
-        BASELINE_PRESSURE = 900.00
-        BASELINE_TIME = 1640995200 # 2022-01-01 00:00:00 GMT
-        BASELINE_TEMPERATURE = 50.00 
+        # decode, timed and counted for the metrics
+        with METRICS.timer('basestation_decode_seconds'):
+            d = self._parse_data(parsed_json)
+
+        if 'message_type' in d:
+            METRICS.inc('basestation_messages_received_total', f_port=d['message_type'],
+                        device=parsed_json['end_device_ids']['device_id'])
+            if d.get('station_id', -99) != -99:
+                METRICS.set('basestation_station_last_seen_timestamp_seconds',
+                            time.time(), station=d['station_id'])
+                METRICS.set('basestation_station_rssi_dbm', d['RSSI'], station=d['station_id'])
+                METRICS.set('basestation_station_snr_db', d['SNR'], station=d['station_id'])
+        return d
+
+    def _parse_data(self, parsed_json):
+        # The payload layouts for each message type are in
+        # classes/uplinkDecoder.py
 
         # get the data from the message
         dev_eui = parsed_json['end_device_ids']['device_id']
-        dev_eui_upper = dev_eui.partition('eui-')[2].upper()
 
         d = collections.OrderedDict()  # for returning the data
 
         try:
             payload_base64 = parsed_json['uplink_message']['frm_payload']
-            payload = base64.b64decode(payload_base64).hex()
+            payload = base64.b64decode(payload_base64)
         except KeyError:
             self.logger.debug("No payload found")
             d['No payload'] = ''
@@ -404,174 +795,172 @@ class weatherStation(object):
         message_type = parsed_json['uplink_message']['f_port']
 
         if not message_type in self.VALID_MESSAGES:
-            d['Unrecognised data'] = payload
+            d['Unrecognised data'] = payload.hex()
             self.logger.warning(
-                "Message is not recognised - stopping parse:  %s", payload)
+                "Message is not recognised - stopping parse:  %s", payload.hex())
             return d
 
         d['message_type'] = message_type
 
-        sid = -99  # temp copy of station id for lookup
-        for key in self.stations:
-            if self.stations[key][4] == dev_eui_upper:
-                sid = key
-                break
-        
-        d['station_id'] = sid
-        
-        d['offset_time'] =  int(payload[OFFSET_TIME], 16) 
-        
-        timezone = int(payload[TIMEZONE], 16)
-        if timezone > 127:
-            timezone = timezone - 256
+        d['station_id'] = self.station_for_device(dev_eui)
 
-        d['timezone'] = timezone
+        if message_type not in self.decoder.compiled:
+            self.logger.warning("Message type is not recognised: %i",
+                                message_type)
+            return d
+
+        fields = self.decoder.decode(message_type, payload)
+
+        d['offset_time'] = fields.pop('offset_time')
+        d['timezone'] = fields.pop('timezone')
 
         ts = datetime.utcfromtimestamp(d['offset_time'] + BASELINE_TIME)
         d['timestamp'] = (ts.strftime('%Y-%m-%d %H:%M:%S')
                           ) + "+00:00"  # time from stations is always UTC
 
-        # process each of the message types
-
-        if message_type == 100:  # weather report
-
-            # A disconnected wind vane returns -1 so allow for this. 
-            # Rarely the anenometer will be working and the vane not. So 
-            # do this for all direction readings
-                        
-            d['wind_direction'] = self._process_2s_complement_wind(int(payload[WIND_DIR], 16))
-
-            d['wind_speed'] = int(
-                payload[WIND_SPEED],
-                16) / 100  # all but directions have 2 implied decimals
-            d['wind_gust'] = int(payload[WIND_GUST], 16) / 100
-            d['wind_gust_dir'] = self._process_2s_complement_wind(int(payload[WIND_GUST_DIR], 16))
-             
-            d['wind_speed_avg2m'] = int(payload[WIND_SPEED_2M], 16) / 100
-            d['wind_dir_avg2m'] = self._process_2s_complement_wind(int(payload[WIND_DIR_2M], 16))
-            d['wind_gust_10m'] = int(payload[WIND_GUST_10M], 16) / 100
-            d['wind_gust_dir_10m'] = self._process_2s_complement_wind(int(payload[WIND_GUST_10M_DIRECTION], 16))
-            d['humidity'] = int(payload[HUMIDITY], 16) / 100
-            temperature = int(payload[TEMPERATURE], 16)
-
-            if temperature > 0xcfff:  # -ve number - 2s complement
-                temperature = -1 * (0xffff - temperature + 1)
-            d['temperature'] = round (((temperature / 100)  - BASELINE_TEMPERATURE),2) # 2 decimals
-
-            d['rain_1h'] = int(payload[RAIN_1H], 16) / 100
-            d['rain_since_last'] = int(payload[RAIN_SINCE_LAST], 16) / 100
-            d['rain_today'] = int(payload[RAIN_TODAY], 16) / 100
-            d['bar_uncorrected'] = (int(payload[BAR_UNCORRECTED], 16) / 100) + BASELINE_PRESSURE
-            d['bar_corrected'] = round(((int(payload[BAR_CORRECTED], 16) / 100) + BASELINE_PRESSURE),2)
-            d['voltage'] = (int(payload[VOLTAGE], 16) / 100) 
-
-        elif message_type == 101:  # station report
-
-            latitude = int(payload[LATITUDE], 16)
-            if latitude > 0x7fffffff:  #then this i a -ve number
-                latitude = -1 * (0xffffffff - latitude + 1)
-            d['latitude'] = latitude / 100000  # 5 implied decimals
-
-            longitude = int(payload[LONGITUDE], 16)
-            if longitude > 0x7fffffff:  #then this i a -ve number
-                longitude = -1 * (0xffffffff - longitude + 1)
-            d['longitude'] = longitude / 100000
-
-            altitude = int(payload[ALTITUDE], 16)
-            if altitude > 0x7fff:  # ive number
-                altitude = -1 * (0xffff - altitude + 1)
-            d['altitude'] = altitude  # no decimals
+        d.update(fields)
 
-        else:
+        return d
 
-            self.logger.warning("Message type is not recognised: %i",
-                                message_type)
-            # raise ValueError('unexpected message type: x' + payload[MESSAGE_TYPE])
+    def reading_values(self, data):
+        # weather_reading row for a decoded type 100 message, in
+        # readingWriter.READING_COLUMNS order
+        return (
+            data['timestamp'],  # reading_time
+            data['station_id'],
+            data['wind_direction'],  # wind_dir
+            data['wind_speed'],  # wind_speed
+            data['wind_gust'],  # wind_gust
+            data['wind_gust_dir'],  # wind_gust_dir
+            data['wind_speed_avg2m'],  # wind_speed_avg2m
+            data['wind_dir_avg2m'],  # wind_dir_avg2m
+            data['wind_gust_10m'],  # wind_gust_10m
+            data['wind_gust_dir_10m'],  # wind_gust_dir_10m
+            data['humidity'],  # humidity
+            data['temperature'],  # temperature
+            data['rain_1h'],  # rain_1h
+            data['rain_today'],  # rain_today
+            data['rain_since_last'],  # rain_since_last
+            data['bar_uncorrected'],  # bar_uncorrected
+            data['bar_corrected'],  # bar_corrected
+            data['voltage'],  # battery
+            0  # light
+        )
+
+    def cache_latest(self, data):
+        # keep a decoded weather report as the station's latest reading, if
+        # there is a latestReadings to keep it in
+        if self.latest is None or data.get('message_type') != 100 \
+                or data.get('station_id', -99) == -99:
+            return
+        self.latest.update(data['station_id'],
+                           dict(zip(READING_COLUMNS, self.reading_values(data))),
+                           rssi=data['RSSI'], snr=data['SNR'])
+
+    def has_reading_index(self):
+        # True if weather_reading has the unique index the writer's ON
+        # CONFLICT needs (sql/001_weather_reading_unique.sql), None if the
+        # database cannot be reached to tell
+        try:
+            with self.pool.connection() as pconn:
+                pcur = pconn.cursor()
+                pcur.execute("SELECT 1 FROM pg_indexes WHERE tablename = 'weather_reading' "
+                             "AND indexname = %s", (READING_INDEX,))
+                found = pcur.fetchone() is not None
+                pcur.close()
+                pconn.rollback()
+            return found
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.logger.error("PostgreSQL error")
+            self.logger.error(error)
+            return None
+
+    def start_writer(self, batch_size=50, flush_ms=2000, upsert=False,
+                     spool=None):
+        # From now on commit_data buffers rows and writes them in batches.
+        # Call close() before exiting so the last batch is written. With a
+        # readingSpool rows are journalled locally until the database has them.
+        # Without the unique index every insert would fail, so the writer is
+        # not started. A database that is down is not checked - the writer
+        # keeps the rows (in the spool, if there is one) until it is back
+        if self.has_reading_index() is False:
+            raise Exception("weather_reading has no {0} index - apply "
+                            "sql/001_weather_reading_unique.sql first".format(READING_INDEX))
+        self.writer = readingWriter(self.pool, batch_size, flush_ms, upsert,
+                                    spool, on_commit=self.readings_committed)
+
+    def readings_committed(self, rows):
+        # rows (READING_COLUMNS order) now in weather_reading - their rain
+        # is in wow_rain_pending, so the WOW uploader can send them from
+        # the latestReadings
+        if self.latest is None:
+            return
+        for row in rows:
+            self.latest.persisted(row[1], row[0])
 
-        return d
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
 
     def commit_data(self, data):
+        # False if the database could not take the reading. With a writer
+        # it is buffered (or spooled) and True returned
+        with METRICS.timer('basestation_commit_seconds'):
+            return self._commit_data(data)
+
+    def _commit_data(self, data):
 
         if 'Unrecognised data' in data:
             self.logger.warning("Attempt to commit 'Unrecognised data':%s",
                                 data['Unrecognised data'])
             self.logger.warning("Not committing data to database")
-            return
+            return True
 
         # only committing weather reports at moment
         if data['message_type'] != 100:
             self.logger.info("Ignoring message type: %i", data['message_type'])
-            return
+            return True
 
-        try:
-            pconn = psycopg2.connect(**self.postgres_params)
-            cursor = pconn.cursor()
-            self.logger.debug("PostgreSQL connection open")
+        pvalues = self.reading_values(data)
 
-            pquery = ("INSERT INTO weather_reading ( "
-                      "reading_time, "
-                      "station_id, "
-                      "wind_dir, "
-                      "wind_speed, "
-                      "wind_gust, "
-                      "wind_gust_dir, "
-                      "wind_speed_avg2m, "
-                      "wind_dir_avg2m, "
-                      "wind_gust_10m, "
-                      "wind_gust_dir_10m, "
-                      "humidity, "
-                      "temperature, "
-                      "rain_1h, "
-                      "rain_today, "
-                      "rain_since_last, "
-                      "bar_uncorrected, "
-                      "bar_corrected, "
-                      "battery, "
-                      "light) "
-                      "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, "
-                      "%s, %s, %s, %s, %s, %s, %s, %s, %s)")
+        if self.writer is not None:
+            self.writer.add(pvalues)
+            return True
 
-            self.logger.debug('postgreSQL query: %s', pquery)
+        pquery = (INSERT_READING + "(" +
+                  ", ".join(["%s"] * len(READING_COLUMNS)) + ")" +
+                  IGNORE_READING)
 
-            pvalues = [
-                data['timestamp'],  # reading_time
-                data['station_id'],
-                data['wind_direction'],  # wind_dir
-                data['wind_speed'],  # wind_speed
-                data['wind_gust'],  # wind_gust
-                data['wind_gust_dir'],  # wind_gust_dir
-                data['wind_speed_avg2m'],  # wind_speed_avg2m
-                data['wind_dir_avg2m'],  # wind_dir_avg2m
-                data['wind_gust_10m'],  # wind_gust_10m
-                data['wind_gust_dir_10m'],  # wind_gust_dir_10m
-                data['humidity'],  # humidity
-                data['temperature'],  # temperature
-                data['rain_1h'],  # rain_1h
-                data['rain_today'],  # rain_today
-                data['rain_since_last'],  # rain_since_last
-                data['bar_uncorrected'],  # bar_uncorrected
-                data['bar_corrected'],  # bar_corrected
-                data['voltage'],  # battery
-                0
-            ]  # light
+        def insert(pconn):
+            cursor = pconn.cursor()
+            self.logger.debug("PostgreSQL connection open")
+            self.logger.debug('postgreSQL query: %s', pquery)
 
             cursor.execute(pquery, pvalues)
 
             pconn.commit()
 
             count = cursor.rowcount
-
-            self.logger.debug('%i record inserted into database.', count)
-
             self.logger.debug("Closing cursor")
             cursor.close()
             self.logger.debug("Cursor closed")
+            return count
 
+        try:
+            # retried once on a new connection if this one has died
+            count = self.pool.run(insert)
+            self.readings_committed([pvalues])
+            METRICS.inc('basestation_db_rows_written_total', count)
+            if count == 0:
+                # already there - a copy the dedup did not catch
+                METRICS.inc('basestation_db_duplicates_total')
+
+            self.logger.debug('%i record inserted into database.', count)
+            self.logger.debug("PostgreSQL connection returned to pool")
+            return True
         except (Exception, psycopg2.DatabaseError) as error:
+            METRICS.inc('basestation_db_failed_total')
             self.logger.error("PostgreSQL error")
             self.logger.error(error)
-        finally:
-            if pconn is not None:
-                pconn.close()
-                self.logger.debug('PostgreSQL connection tidied up')
-
+            return False
@@ -0,0 +1,154 @@
+import os
+import time
+import gzip
+import struct
+import logging
+import threading
+from datetime import datetime, timezone
+
+# Each record is the time the message was received (epoch seconds), the
+# payload length and then the raw mqtt payload, in gzip compressed segments
+RECORD = struct.Struct('>dI')
+
+SEGMENT_PREFIX = 'uplinks-'
+SEGMENT_SUFFIX = '.bin.gz'
+SEGMENT_TIME = '%Y%m%dT%H%M%S'
+
+
+class uplinkArchive(object):
+
+    # Append only archive of every mqtt message received, so readings can be
+    # replayed after a database outage or a decoder fix
+
+    def __init__(self, directory, segment_mb=16, segment_hours=24,
+                 keep_segments=0, flush_seconds=5):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising uplinkArchive object")
+
+        self.directory = directory
+        self.segment_bytes = int(float(segment_mb) * 1024 * 1024)
+        self.segment_seconds = float(segment_hours) * 3600
+        self.keep_segments = int(keep_segments)  # 0 - keep everything
+        self.flush_seconds = float(flush_seconds)
+
+        self.archived = 0
+
+        self._segment = None
+        self._segment_written = 0
+        self._segment_opened = 0
+        self._last_flush = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.logger.debug("uplinkArchive initialised in %s", self.directory)
+
+    @staticmethod
+    def _segment_order(path):
+        # uplinks-<start>[-n].bin.gz - by start time, then n
+        stamp, _, n = os.path.basename(path)[
+            len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)].partition('-')
+        return stamp, int(n or 0)
+
+    def segments(self):
+        # oldest first
+        return sorted((os.path.join(self.directory, name)
+                       for name in os.listdir(self.directory)
+                       if name.startswith(SEGMENT_PREFIX)
+                       and name.endswith(SEGMENT_SUFFIX)),
+                      key=self._segment_order)
+
+    @staticmethod
+    def segment_start(path):
+        stamp = uplinkArchive._segment_order(path)[0]
+        return datetime.strptime(stamp, SEGMENT_TIME).replace(
+            tzinfo=timezone.utc).timestamp()
+
+    def _open_segment(self, now):
+        name = SEGMENT_PREFIX + datetime.fromtimestamp(
+            now, timezone.utc).strftime(SEGMENT_TIME)
+        path = os.path.join(self.directory, name + SEGMENT_SUFFIX)
+        n = 1
+        while os.path.exists(path):  # two rotations in the same second
+            path = os.path.join(self.directory, '%s-%d%s' % (name, n, SEGMENT_SUFFIX))
+            n += 1
+
+        self._segment = gzip.open(path, 'wb')
+        self._segment_written = 0
+        self._segment_opened = now
+        self.logger.info("Archiving uplinks to %s", path)
+        self._prune()
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def _prune(self):
+        if self.keep_segments <= 0:
+            return
+        for path in self.segments()[:-self.keep_segments]:
+            self.logger.info("Removing old archive segment %s", path)
+            os.remove(path)
+
+    def append(self, payload, received=None):
+        if received is None:
+            received = time.time()
+
+        with self._lock:
+            if (self._segment is None
+                    or self._segment_written >= self.segment_bytes
+                    or received - self._segment_opened >= self.segment_seconds):
+                self._close_segment()
+                self._open_segment(received)
+
+            self._segment.write(RECORD.pack(received, len(payload)))
+            self._segment.write(payload)
+            self._segment_written += RECORD.size + len(payload)
+            self.archived += 1
+
+            # keep what is on disk reasonably current without paying for a
+            # gzip flush on every message
+            if received - self._last_flush >= self.flush_seconds:
+                self._segment.flush()
+                self._last_flush = received
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+    def replay(self, since=None, until=None):
+        # yields (received, payload) in the order they were archived.
+        # since / until are epoch seconds and filter on the received time
+        segments = self.segments()
+        for n, path in enumerate(segments):
+            if until is not None and self.segment_start(path) > until:
+                break
+            # a segment ends where the next one starts (names are only
+            # accurate to the second)
+            if since is not None and n + 1 < len(segments) \
+                    and self.segment_start(segments[n + 1]) + 1 < since:
+                continue
+
+            self.logger.info("Replaying %s", path)
+            with gzip.open(path, 'rb') as segment:
+                try:
+                    while True:
+                        header = segment.read(RECORD.size)
+                        if len(header) < RECORD.size:
+                            break
+                        received, length = RECORD.unpack(header)
+                        payload = segment.read(length)
+                        if len(payload) < length:
+                            break
+                        if since is not None and received < since:
+                            continue
+                        if until is not None and received > until:
+                            return
+                        yield received, payload
+                except EOFError:
+                    # the segment still being written, or a crash before it
+                    # was closed - everything before this point is good
+                    self.logger.warning("Archive segment %s ends early", path)
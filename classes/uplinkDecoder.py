@@ -0,0 +1,179 @@
+import collections
+import logging
+
+# Baselines - used to save bytes should be the same as the weather station constants.h file
+BASELINE_PRESSURE = 900.00
+BASELINE_TIME = 1640995200 # 2022-01-01 00:00:00 GMT
+BASELINE_TEMPERATURE = 50.00
+
+# One entry per field, in payload order (big endian, no padding)
+#   name          key in the decoded data
+#   bits          width of the field - 12 bit wind directions are fine
+#   signed_above  raw values above this are negative (2s complement over
+#                 bits). The station uses odd thresholds, e.g. wind
+#                 directions are only negative above 0xcff
+#   divisor       implied decimals - raw / divisor
+#   offset        added after dividing (baselines)
+#   decimals      round() the result, None to leave it alone
+field = collections.namedtuple(
+    'field', 'name bits signed_above divisor offset decimals',
+    defaults=(None, 1, 0, None))
+
+# all message types start with the station time and timezone
+HEADER = (
+    field('offset_time', 32),  # seconds since BASELINE_TIME
+    field('timezone', 8, signed_above=127),  # hours
+)
+
+# Layouts by loraWAN port (= message type). Adding a message type is just
+# a new entry here
+LAYOUTS = {
+    100: HEADER + (  # weather report
+        # A disconnected wind vane returns -1 so allow for this.
+        # Rarely the anenometer will be working and the vane not. So
+        # do this for all direction readings
+        field('wind_direction', 12, signed_above=0xcff),
+        field('wind_speed', 16, divisor=100),  # all but directions have 2 implied decimals
+        field('wind_gust', 16, divisor=100),
+        field('wind_gust_dir', 12, signed_above=0xcff),
+        field('wind_speed_avg2m', 16, divisor=100),
+        field('wind_dir_avg2m', 12, signed_above=0xcff),
+        field('wind_gust_10m', 16, divisor=100),
+        field('wind_gust_dir_10m', 12, signed_above=0xcff),
+        field('humidity', 16, divisor=100),
+        field('temperature', 16, signed_above=0xcfff, divisor=100,
+              offset=-BASELINE_TEMPERATURE, decimals=2),
+        field('rain_1h', 16, divisor=100),
+        field('rain_today', 16, divisor=100),
+        field('rain_since_last', 16, divisor=100),
+        field('bar_uncorrected', 16, divisor=100, offset=BASELINE_PRESSURE),
+        field('bar_corrected', 16, divisor=100, offset=BASELINE_PRESSURE,
+              decimals=2),
+        field('voltage', 16, divisor=100),
+    ),
+    101: HEADER + (  # station report
+        field('latitude', 32, signed_above=0x7fffffff, divisor=100000),  # 5 implied decimals
+        field('longitude', 32, signed_above=0x7fffffff, divisor=100000),
+        field('altitude', 16, signed_above=0x7fff),  # no decimals
+    ),
+    # sync time and update station data are downlinks, but another base
+    # station's can be heard - only the header is decoded, as it always was
+    200: HEADER,
+    201: HEADER,
+}
+
+
+class uplinkDecoder(object):
+
+    # Turns the LAYOUTS tables into shift/mask lists once, then decodes a
+    # payload with a single int.from_bytes and one pass over the fields
+
+    def __init__(self, layouts=LAYOUTS):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+        self.layouts = layouts
+        self.compiled = {port: self._compile(layout)
+                         for port, layout in layouts.items()}
+
+    @staticmethod
+    def _compile(layout):
+        total_bits = sum(f.bits for f in layout)
+        nbytes = (total_bits + 7) // 8
+        spare = nbytes * 8 - total_bits  # unused bits at the end
+
+        steps = []
+        position = 0
+        for f in layout:
+            position += f.bits
+            shift = total_bits - position + spare
+            # round(raw / 100 + offset, 2) is exactly (raw + offset * 100) / 100
+            # - one division, the same in decode() and decode_batch()
+            scaled = None
+            if f.decimals is not None and f.divisor == 10 ** f.decimals \
+                    and float(f.offset * f.divisor).is_integer():
+                scaled = int(f.offset * f.divisor)
+            steps.append((f.name, shift, (1 << f.bits) - 1, f.signed_above,
+                          1 << f.bits, f.divisor, f.offset, f.decimals, scaled))
+
+        return nbytes, tuple(steps)
+
+    def length(self, port):
+        return self.compiled[port][0]
+
+    def decode(self, port, payload):
+        # payload is the raw frm_payload bytes. Anything after the last
+        # field is ignored
+        nbytes, steps = self.compiled[port]
+        if len(payload) < nbytes:
+            raise ValueError('message type %d needs %d bytes, got %d'
+                             % (port, nbytes, len(payload)))
+
+        raw = int.from_bytes(payload[:nbytes], 'big')
+
+        d = collections.OrderedDict()
+        for name, shift, mask, signed_above, modulus, divisor, offset, decimals, scaled in steps:
+            value = (raw >> shift) & mask
+            if signed_above is not None and value > signed_above:
+                value -= modulus
+            if scaled is not None:
+                d[name] = (value + scaled) / divisor
+                continue
+            if divisor != 1:
+                value = value / divisor
+            if offset:
+                value = value + offset
+            if decimals is not None:
+                value = round(value, decimals)
+            d[name] = value
+
+        return d
+
+    def decode_batch(self, port, payloads):
+        # Vectorised decode() for replays and backfills. payloads is a list
+        # of frm_payload bytes, all for the same port. Returns an
+        # OrderedDict of numpy arrays, one per field plus 'timestamp'
+        # (datetime64, UTC). Values match decode() exactly
+        try:
+            # imported here, not at the top - numpy is slow to import and the
+            # listener and one-shot downlinks never batch decode
+            import numpy as np
+        except ImportError:
+            raise ImportError("numpy is required for uplinkDecoder.decode_batch")
+
+        nbytes, steps = self.compiled[port]
+        if any(len(payload) < nbytes for payload in payloads):
+            raise ValueError('message type %d needs %d bytes' % (port, nbytes))
+
+        raw = np.frombuffer(b''.join(payload[:nbytes] for payload in payloads),
+                            dtype=np.uint8).reshape(len(payloads), nbytes)
+        bits = np.unpackbits(raw, axis=1)
+
+        columns = collections.OrderedDict()
+        position = 0
+        for name, shift, mask, signed_above, modulus, divisor, offset, decimals, scaled in steps:
+            width = modulus.bit_length() - 1
+            weights = np.left_shift(np.int64(1), np.arange(width - 1, -1, -1, dtype=np.int64))
+            value = bits[:, position:position + width].astype(np.int64) @ weights
+            position += width
+
+            if signed_above is not None:
+                value = np.where(value > signed_above, value - modulus, value)
+
+            if scaled is not None:
+                value = (value + scaled) / divisor
+            else:
+                if divisor != 1:
+                    value = value / divisor
+                if offset:
+                    value = value + offset
+                if decimals is not None:
+                    value = np.array([round(v, decimals) for v in value.tolist()])
+
+            columns[name] = value
+
+        if 'offset_time' in columns:
+            columns['timestamp'] = (columns['offset_time'] + BASELINE_TIME).astype('datetime64[s]')
+
+        return columns
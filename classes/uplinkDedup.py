@@ -0,0 +1,77 @@
+import time
+import logging
+import threading
+import collections
+
+from classes.ingestMetrics import METRICS
+
+
+class uplinkDedup(object):
+
+    # Remembers recent uplinks so copies of one - redelivered by TTN after
+    # a reconnect, or retransmitted by the device - are dropped before they
+    # are decoded and written. An uplink is known by its device, frame
+    # counter and payload (which carries the reading's offset_time), so a
+    # device that reboots and starts counting again is not mistaken for a
+    # repeat. Bounded: at most size uplinks, each forgotten after ttl_hours.
+    # The unique index on weather_reading (station_id, reading_time) catches
+    # anything older. An uplink that could not be written is forgotten again
+    # (forget()), so a redelivered copy of it is not dropped
+
+    def __init__(self, size=10000, ttl_hours=24):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising uplinkDedup object")
+
+        self.size = int(size)
+        self.ttl = float(ttl_hours) * 3600
+
+        self.checked = 0
+        self.duplicates = 0
+
+        self._seen = collections.OrderedDict()  # key : monotonic time first seen, oldest first
+        self._lock = threading.Lock()
+
+        self.logger.debug("uplinkDedup initialised (%d uplinks, %ss)", self.size, self.ttl)
+
+    @staticmethod
+    def key(parsed_json):
+        # TTN leaves f_cnt out of the json when it is 0
+        uplink = parsed_json.get('uplink_message', {})
+        return (parsed_json.get('end_device_ids', {}).get('device_id'),
+                uplink.get('f_cnt', 0),
+                uplink.get('frm_payload'))
+
+    def seen(self, parsed_json):
+        # True if this uplink has already been seen - otherwise it is
+        # remembered and False returned
+        key = self.key(parsed_json)
+        now = time.monotonic()
+        with self._lock:
+            self.checked += 1
+            while self._seen:
+                first = next(iter(self._seen.values()))
+                if now - first < self.ttl:
+                    break
+                self._seen.popitem(last=False)
+
+            if key in self._seen:
+                self.duplicates += 1
+                METRICS.inc('basestation_duplicates_dropped_total')
+                return True
+
+            self._seen[key] = now
+            if len(self._seen) > self.size:
+                self._seen.popitem(last=False)
+            return False
+
+    def forget(self, parsed_json):
+        # the uplink was not decoded or written - let the next copy through
+        with self._lock:
+            self._seen.pop(self.key(parsed_json), None)
+
+    def stats(self):
+        with self._lock:
+            return {'checked': self.checked, 'duplicates': self.duplicates,
+                    'remembered': len(self._seen)}
@@ -1,48 +1,94 @@
 import re
 import time
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+from decimal import Decimal
 import math
 import sys
 import os
 import logging
 from urllib import request, parse
 import collections
+import threading
+import http.client
+import concurrent.futures
 import psycopg2
+import psycopg2.extras
 
 
 import utilities as convert
+from classes.databasePool import get_pool
+from classes.wowQueue import wowUploadQueue
+from classes.latestCache import fetch_latest
+from classes.ingestMetrics import METRICS
+
+# Reading columns wow_fields() needs, as selected from weather_reading
+WOW_READING_COLUMNS = ('reading_time, bar_uncorrected, rain_today, temperature, humidity, '
+                       'wind_dir, wind_speed, wind_gust_10m, wind_gust_dir_10m')
+
+
+def as_utc(when):
+    # a datetime (or isoformat string) with a timezone. timestamp without
+    # time zone columns come back from psycopg2 naive - they hold UTC
+    if isinstance(when, str):
+        when = datetime.fromisoformat(when)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when
+
+
+def wow_fields(reading, total_mm, siteid, site_key, software):
+    # reading is a dictionary of weather_reading field name / value pairs -
+    # change the db field names for the met office ones and convert the
+    # units as well. total_mm is the rain since the last upload
+    result = {}
+    result ['dateutc'] = reading['reading_time'].replace(tzinfo=None)
+    result ['baromin'] = convert.hpa_to_inches(reading['bar_uncorrected'])
+    result ['dailyrainin'] = convert.mm_to_inches(reading['rain_today'])
+    result ['humidity'] = convert.limit_percent(reading['humidity'])
+    result ['tempf'] = convert.celsius_to_f(reading['temperature'])
+    result ['winddir'] = reading['wind_dir']
+    result ['windspeedmph'] = convert.kph_to_mph(reading['wind_speed'])
+    result ['windgustdir'] = reading['wind_gust_dir_10m']
+    result ['windgustmph'] = convert.kph_to_mph(reading['wind_gust_10m'])
+
+    if total_mm is None: # happens if this is run when no previous uploads to wow
+        total_mm = 0.00
+
+    result['rainin'] = convert.mm_to_inches(total_mm)
+
+    # Add in the wow keys and software id for upload
+    result['siteid'] = siteid
+    result['siteAuthenticationKey'] = site_key
+    result ['softwaretype'] = software
+
+    return result
+
 
 class metofficeWow(object):
 
-    def _get_stations(self, **postgres_params):
+    def _get_stations(self):
     # gets the details of all the stations from the psql database
     # for future use
         self.logger.debug(
             "getting list of available weather stations from database")
         stations = {}
         try:
-            pconn = psycopg2.connect(**postgres_params)
-            pcur = pconn.cursor()
-            self.logger.debug("PostgreSQL connection open")
-            pcur.execute(
-                "SELECT id,name, wow_station, wow_key,  wow_last_upload FROM weather_station"
-            )
-           
-            stations = {
-                col1: (col2, col3, col4, col5)
-                for (col1, col2, col3, col4, col5) in pcur.fetchall()
-            }
-
-            # close the communication with the PostgreSQL
-            pconn.close()
-            self.logger.debug("PostgreSQL connection closed")
+            with self.pool.connection() as pconn:
+                pcur = pconn.cursor()
+                self.logger.debug("PostgreSQL connection open")
+                pcur.execute(
+                    "SELECT id,name, wow_station, wow_key,  wow_last_upload FROM weather_station"
+                )
+
+                stations = {
+                    col1: (col2, col3, col4, col5)
+                    for (col1, col2, col3, col4, col5) in pcur.fetchall()
+                }
+                pcur.close()
+            self.logger.debug("PostgreSQL connection returned to pool")
         except (Exception, psycopg2.DatabaseError) as error:
             self.logger.error("PostgreSQL error")
             self.logger.error(error)
-        finally:
-            if pconn is not None:
-                pconn.close()
-                self.logger.debug('PostgreSQL connection tidied up')
 
         return stations
 
@@ -53,19 +99,52 @@ class metofficeWow(object):
         self.logger.addHandler(logging.NullHandler())
         self.logger.debug("initialising weatherStation object")
 
-        self.stations = self._get_stations(**postgres_params)
+        self.postgres_params = postgres_params
+        self.pool = get_pool(**postgres_params)
+
+        self.stations = self._get_stations()
         self.station_id = station_id
 
         self.station_data = self.stations[station_id]
-
-        self.postgres_params = postgres_params
         
         self.software = wow_params['software']
         self.upload_url = wow_params['upload_url']
+
+        # where to look for the latest reading before the database - a
+        # latestReadings in the same process, or a listener's latest api
+        self.latest_cache = None
+        self.latest_url = wow_params.get('latest_url')
         
         self.logger.debug("metofficeWow initialised")
 
+    def reconfigure(self, wow_params):
+        # new [wow] settings (e.g. after a config reload) for the next upload
+        self.software = wow_params['software']
+        self.upload_url = wow_params['upload_url']
+        self.latest_url = wow_params.get('latest_url')
+        self.logger.info("WOW settings changed - uploading to %s", self.upload_url)
+
+    def _cached_reading(self):
+        # the latest reading from the listener, or None. Only once the
+        # writer has committed it - until then its rain is not in
+        # wow_rain_pending
+        reading = None
+        if self.latest_cache is not None:
+            reading = self.latest_cache.get(self.station_id)
+            if reading is not None:
+                reading['reading_time'] = datetime.fromisoformat(reading['reading_time'])
+        if reading is None and self.latest_url:
+            reading = fetch_latest(self.latest_url, self.station_id)
+        if reading is not None and not reading.get('persisted'):
+            self.logger.debug("Listener's latest reading not written yet - using the database")
+            return None
+        return reading
+
     def latest(self, upload=False):
+        with METRICS.timer('basestation_wow_latest_seconds'):
+            self._latest(upload)
+
+    def _latest(self, upload=False):
         self.logger.debug("Fetching latest reading")
         
         # List of available fields for wow uploads and local database equivalent
@@ -88,74 +167,395 @@ class metofficeWow(object):
         # windgustmph   degrees             wind_gust_10m (km/h)
         
         try:
-            pconn = psycopg2.connect(**self.postgres_params)
-            pcur = pconn.cursor()
-            self.logger.debug("PostgreSQL connection open")
-            
-            query = 'select reading_time, bar_uncorrected, rain_today, temperature, humidity, ' \
-                    'wind_dir, wind_speed, wind_gust_10m, wind_gust_dir_10m ' \
-                     'from weather_reading where station_id = ' + str(self.station_id) + ' order by reading_time desc limit 1;'
-            
-            pcur.execute(query)
+            with self.pool.connection() as pconn:
+                pcur = pconn.cursor()
+                self.logger.debug("PostgreSQL connection open")
             
-            columns = pcur.description 
-            result = [{columns[index][0]:column for index, column in enumerate(value)} for value in pcur.fetchall()] [0]
-            
-            reading_time = result['reading_time'] # will need later
-
-            # result is now a dictionary of field name/ value pairs - change the db field names for the met office ones
-            # and convert the units as well
-
-            result ['dateutc'] = result.pop('reading_time').replace(tzinfo=None)
-            result ['baromin'] = convert.hpa_to_inches(result.pop('bar_uncorrected')) 
-            result ['dailyrainin'] = convert.mm_to_inches(result.pop('rain_today'))
-            result ['humidity'] = convert.limit_percent(result.pop('humidity'))
-            result ['tempf'] = convert.celsius_to_f(result.pop('temperature'))
-            result ['winddir'] = result.pop('wind_dir')
-            result ['windspeedmph'] = convert.kph_to_mph(result.pop('wind_speed'))
-            result ['windgustdir'] = result.pop('wind_gust_dir_10m')
-            result ['windgustmph'] = convert.kph_to_mph(result.pop('wind_gust_10m'))
+                result = self._cached_reading()
+                if result is not None:
+                    self.logger.debug("Latest reading from the listener")
+                else:
+                    query = 'select ' + WOW_READING_COLUMNS + ' ' \
+                             'from weather_reading where station_id = ' + str(self.station_id) + ' order by reading_time desc limit 1;'
+                
+                    pcur.execute(query)
+                
+                    columns = pcur.description 
+                    result = [{columns[index][0]:column for index, column in enumerate(value)} for value in pcur.fetchall()] [0]
             
+                reading_time = result['reading_time'] # will need later
+
+                # rain since last wow upload - kept up to date on insert, see
+                # sql/002_wow_rain_pending.sql
+                total_query = 'select wow_rain_pending from weather_station where id = %s'
+                pcur.execute(total_query, (self.station_id,))
+                total_mm = pcur.fetchall()[0][0]
+
+                result = wow_fields(result, total_mm, self.station_data[1],
+                                    self.station_data[2], self.software)
 
-            # calculate rain since last wow upload
-            total_query = 'select sum(rain_since_last) as accumulated_rain from weather_reading where station_id = %s' \
-                          'and reading_time > %s' 
-            pcur.execute(total_query, (self.station_id, self.station_data[3])) 
-            total_mm = pcur.fetchall()[0][0]
-            if total_mm is None: # happens if this is run when no previous uploads to wow
-                total_mm = 0.00
+                query_url = self.upload_url + parse.urlencode(result)
 
-            result['rainin'] = convert.mm_to_inches(total_mm)
+                if upload: 
+                    self.logger.debug("Preparing to update last upload time")
+                    u = request.urlopen(query_url)
+                    response = u.read()
+                    # take off only the rain that was sent - anything that
+                    # arrived since stays pending for the next upload
+                    query = 'UPDATE weather_station set wow_last_upload = (%s), ' \
+                            'wow_rain_pending = greatest(wow_rain_pending - %s, 0) ' \
+                            'WHERE id = (%s) RETURNING wow_rain_pending;'
+                    pcur.execute(query,(reading_time, total_mm or 0, self.station_id))
+                    left_mm = pcur.fetchone()[0]
+                    pconn.commit()
+                    self.logger.debug("Last upload time updated, %s mm rain still pending", left_mm)
+                else:
+                    self.logger.info('url generated: %s', query_url)
+
+                #breakpoint()
             
-            # Add in the wow keys and software id for upload
-            result['siteid'] = self.station_data[1]
-            result['siteAuthenticationKey'] = self.station_data[2]
-            result ['softwaretype'] = self.software
-
-            query_url = self.upload_url + parse.urlencode(result)
-
-            if upload: 
-                self.logger.debug("Preparing to update last upload time")
-                u = request.urlopen(query_url)
-                response = u.read()
-                query = 'UPDATE weather_station set wow_last_upload = (%s) ' \
-                        'WHERE id = (%s);'
-                pcur.execute(query,(reading_time, self.station_id))
-                pconn.commit()
-                self.logger.debug("Last upload time updated")
+                pcur.close()
+
+            self.logger.debug("PostgreSQL connection returned to pool")
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.logger.error("PostgreSQL error")
+            self.logger.error(error)
+    
+
+class metofficeWowFleet(object):
+
+    # Uploads the latest reading for every station with a wow_station, as a
+    # long running service. One query finds what is pending for all
+    # stations, uploads run concurrently over kept-alive http connections
+    # and each station's wow_last_upload is moved as soon as its upload works
+
+    PENDING_QUERY = (
+        'select s.id, s.wow_station, s.wow_key, ' + ', '.join(
+            'r.' + column.strip() for column in WOW_READING_COLUMNS.split(',')) + ', '
+        's.wow_rain_pending as accumulated_rain '
+        'from weather_station s '
+        'cross join lateral ('
+        ' select ' + WOW_READING_COLUMNS + ' from weather_reading '
+        ' where station_id = s.id order by reading_time desc limit 1) r '
+        'where s.wow_station is not null '
+        'and (%(all)s or s.id = any(%(stations)s)) '
+        'and (s.wow_last_upload is null or r.reading_time > s.wow_last_upload)')
+
+    # Catch up - the latest reading in each catchup_minutes interval since
+    # `since`, with the rain for that interval. Used with the upload queue
+    CATCHUP_QUERY = (
+        'select * from ('
+        ' select s.id, s.wow_station, s.wow_key, ' + ', '.join(
+            'r.' + column.strip() for column in WOW_READING_COLUMNS.split(',')) + ', '
+        ' sum(r.rain_since_last) over b as accumulated_rain, '
+        ' row_number() over (b order by r.reading_time desc) as n '
+        ' from weather_station s '
+        ' join (VALUES %s) as since(id, reading_time) on since.id = s.id '
+        ' join weather_reading r on r.station_id = s.id '
+        '  and r.reading_time > since.reading_time '
+        ' window b as (partition by s.id, '
+        '  floor(extract(epoch from r.reading_time) / {interval}))'
+        ') x where n = 1 order by id, reading_time')
+
+    def __init__(self, wow_params, stations=None, **postgres_params):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising metofficeWowFleet object")
+
+        self.postgres_params = postgres_params
+        self.pool = get_pool(**postgres_params)
+
+        self.software = wow_params['software']
+        self.upload_url = wow_params['upload_url']
+        self.workers = int(wow_params.get('workers', 4))
+        self.timeout = float(wow_params.get('timeout', 30))  # seconds per request
+        self.stations = stations  # station ids, None for all of them
+
+        # Optional persistent upload queue - failed uploads are retried and
+        # missed intervals back-filled, oldest first
+        self.queue = None
+        if wow_params.get('queue_path'):
+            self.queue = wowUploadQueue(wow_params['queue_path'])
+        self.catchup_minutes = int(wow_params.get('catchup_minutes', 5))
+        self.catchup_hours = int(wow_params.get('catchup_hours', 24))
+        # WOW rate limit - request starts are spaced out to stay under it
+        self.rate_per_minute = float(wow_params.get('rate_per_minute', 30))
+
+        self._local = threading.local()  # one kept-alive connection per worker
+        self._throttle_lock = threading.Lock()
+        self._next_request = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers)
+
+        self.logger.debug("metofficeWowFleet initialised")
+
+    def reconfigure(self, wow_params):
+        # New [wow] settings (e.g. after a config reload) from the next run.
+        # workers and queue_path need a restart
+        self.software = wow_params['software']
+        self.upload_url = wow_params['upload_url']
+        self.timeout = float(wow_params.get('timeout', 30))
+        self.catchup_minutes = int(wow_params.get('catchup_minutes', 5))
+        self.catchup_hours = int(wow_params.get('catchup_hours', 24))
+        self.rate_per_minute = float(wow_params.get('rate_per_minute', 30))
+        self.logger.info("WOW settings changed - uploading to %s", self.upload_url)
+
+    def pending(self):
+        # [(station id, reading_time, wow fields, rain mm), ...] for every
+        # station with a reading newer than its last upload
+        with self.pool.connection() as pconn:
+            pcur = pconn.cursor()
+            pcur.execute(self.PENDING_QUERY, {'all': self.stations is None,
+                                              'stations': list(self.stations or [])})
+            columns = [column[0] for column in pcur.description]
+            rows = [dict(zip(columns, value)) for value in pcur.fetchall()]
+            pcur.close()
+
+        return [(row['id'], row['reading_time'],
+                 wow_fields(row, row['accumulated_rain'], row['wow_station'],
+                            row['wow_key'], self.software),
+                 row['accumulated_rain'])
+                for row in rows]
+
+    def _connection(self, url):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and getattr(self._local, 'server', None) != (url.scheme, url.netloc):
+            # upload_url has changed to another server (or to https)
+            conn.close()
+            conn = None
+        if conn is None:
+            if url.scheme == 'https':
+                conn = http.client.HTTPSConnection(url.netloc, timeout=self.timeout)
             else:
-                self.logger.info('url generated: %s', query_url)
+                conn = http.client.HTTPConnection(url.netloc, timeout=self.timeout)
+            self._local.conn = conn
+            self._local.server = (url.scheme, url.netloc)
+        return conn
 
-            #breakpoint()
-            
-            # close the communication with the PostgreSQL
-            pconn.close()
-            self.logger.debug("PostgreSQL connection closed")
+    def _throttle(self):
+        if self.rate_per_minute <= 0:
+            return
+        with self._throttle_lock:
+            now = time.monotonic()
+            wait = self._next_request - now
+            self._next_request = max(now, self._next_request) + 60 / self.rate_per_minute
+        if wait > 0:
+            time.sleep(wait)
+
+    def _request(self, url):
+        path = url.path + '?' + url.query
+
+        for attempt in range(2):
+            conn = self._connection(url)
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()  # has to be read before the connection is reused
+                return response
+            except (http.client.HTTPException, ConnectionError):
+                # the server closed a kept-alive connection - reconnect once
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+            except OSError:
+                # timeouts etc - start afresh next time
+                conn.close()
+                self._local.conn = None
+                raise
+
+    def _get(self, fields):
+        self._throttle()
+        url = parse.urlsplit(self.upload_url + parse.urlencode(fields))
+        response = self._request(url)
+
+        location = response.getheader('Location')
+        if response.status in (301, 302, 303, 307, 308) and location:
+            # http.client does not follow redirects (urlopen did) - follow
+            # one, e.g. WOW moving to https. Anything else is a failure
+            location = parse.urljoin(parse.urlunsplit(url), location)
+            self.logger.warning("WOW redirected the upload to %s - update upload_url",
+                                location.split('?')[0])
+            response = self._request(parse.urlsplit(location))
+
+        if not 200 <= response.status < 300:
+            raise OSError('WOW returned %d %s' % (response.status, response.reason))
+        return response.status
+
+    def _upload_one(self, fields):
+        started = time.monotonic()
+        self._get(fields)
+        return time.monotonic() - started
+
+    def upload(self, pending):
+        # uploads concurrently - returns [(station id, reading_time), ...]
+        # for the ones that worked. Each is marked uploaded as soon as it
+        # works, so a crash part way through does not send it again. With
+        # the queue, results are recorded there too
+        futures = {self._executor.submit(self._upload_one, fields): (station_id, reading_time, rain)
+                   for station_id, reading_time, fields, rain in pending}
+        uploaded = []
+        for future in concurrent.futures.as_completed(futures):
+            station_id, reading_time, rain = futures[future]
+            try:
+                latency = future.result()
+            except Exception as error:
+                self.logger.error("WOW upload failed for station %s", station_id)
+                self.logger.error(error)
+                if self.queue is not None:
+                    delay = self.queue.failed(station_id, reading_time, error)
+                    self.logger.info("Station %s %s will be retried in %ds",
+                                     station_id, reading_time, delay)
+                continue
+
+            uploaded.append((station_id, reading_time))
+            self.logger.debug("Station %s uploaded to WOW", station_id)
+            try:
+                self.mark_uploaded([(station_id, reading_time, rain)])
+            except (Exception, psycopg2.DatabaseError) as error:
+                # the next pending() / catch up sends it again
+                self.logger.error("PostgreSQL error")
+                self.logger.error(error)
+            if self.queue is not None:
+                self.queue.done(station_id, reading_time, latency)
+        return uploaded
+
+    def enqueue_missed(self):
+        # queue everything not yet uploaded (or queued), one reading per
+        # catchup_minutes, going back at most catchup_hours
+        last_queued = self.queue.last_queued()
+        oldest = datetime.now(timezone.utc) - timedelta(hours=self.catchup_hours)
+
+        with self.pool.connection() as pconn:
+            pcur = pconn.cursor()
+            pcur.execute('select id, wow_last_upload from weather_station '
+                         'where wow_station is not null '
+                         'and (%(all)s or id = any(%(stations)s))',
+                         {'all': self.stations is None,
+                          'stations': list(self.stations or [])})
+            since = []
+            for station_id, last_upload in pcur.fetchall():
+                times = [oldest]
+                if last_upload is not None:
+                    times.append(as_utc(last_upload))
+                if station_id in last_queued:
+                    times.append(as_utc(last_queued[station_id]))
+                since.append((station_id, max(times)))
+
+            if not since:
+                pcur.close()
+                return 0
+
+            rows = psycopg2.extras.execute_values(
+                pcur, self.CATCHUP_QUERY.format(interval=self.catchup_minutes * 60),
+                since, template='(%s, %s::timestamptz)', fetch=True)
+            columns = [column[0] for column in pcur.description]
+            pcur.close()
+
+        for value in rows:
+            row = dict(zip(columns, value))
+            fields = wow_fields(row, row['accumulated_rain'], row['wow_station'],
+                                row['wow_key'], self.software)
+            self.queue.add(row['id'],
+                           row['reading_time'].astimezone(timezone.utc).isoformat(),
+                           fields, row['accumulated_rain'])
+
+        return len(rows)
+
+    def drain(self):
+        # upload queued readings in order - each round sends the oldest for
+        # every station that is not backing off
+        uploaded = []
+        while True:
+            due = self.queue.due()
+            if not due:
+                break
+            # stations that fail back off and drop out of due() - the rest
+            # carry on
+            uploaded += self.upload(due)
+        return uploaded
+
+    def mark_uploaded(self, uploaded):
+        # [(station id, reading_time, rain mm sent), ...]
+        if not uploaded:
+            return
+        # newest per station and all the rain sent - catch up can upload
+        # several
+        newest = {}
+        for station_id, reading_time, rain in uploaded:
+            reading_time = as_utc(reading_time)
+            last, sent = newest.get(station_id, (reading_time, 0))
+            newest[station_id] = (max(last, reading_time), sent + Decimal(str(rain or 0)))
+        with self.pool.connection() as pconn:
+            pcur = pconn.cursor()
+            # only the rain that was sent comes off - rain from readings
+            # that arrived since stays pending for the next upload
+            rows = psycopg2.extras.execute_values(
+                pcur,
+                'UPDATE weather_station s set '
+                'wow_last_upload = greatest(s.wow_last_upload, v.reading_time), '
+                'wow_rain_pending = greatest(s.wow_rain_pending - v.rain, 0) '
+                'FROM (VALUES %s) AS v(id, reading_time, rain) WHERE s.id = v.id '
+                'RETURNING s.id, s.wow_rain_pending',
+                [(station_id, reading_time, rain)
+                 for station_id, (reading_time, rain) in newest.items()],
+                template='(%s, %s::timestamptz, %s::numeric)', fetch=True)
+            pconn.commit()
+            pcur.close()
+        self.logger.debug("Last upload time updated for %d stations, rain still pending: %s",
+                          len(rows), dict(rows))
+
+    def run_once(self, upload=False):
+        if self.queue is not None and upload:
+            return self._run_queue()
+
+        try:
+            pending = self.pending()
         except (Exception, psycopg2.DatabaseError) as error:
             self.logger.error("PostgreSQL error")
             self.logger.error(error)
+            return
+
+        self.logger.info("%d stations have readings to upload", len(pending))
+
+        if not upload:
+            for station_id, reading_time, fields, rain in pending:
+                self.logger.info('url generated: %s',
+                                 self.upload_url + parse.urlencode(fields))
+            return
+
+        uploaded = self.upload(pending)
+        self.logger.info("%d of %d stations uploaded to WOW", len(uploaded), len(pending))
+
+    def _run_queue(self):
+        try:
+            queued = self.enqueue_missed()
+            self.logger.info("%d readings queued for WOW", queued)
+        except (Exception, psycopg2.DatabaseError) as error:
+            # still upload whatever is already queued
+            self.logger.error("PostgreSQL error")
+            self.logger.error(error)
+
+        uploaded = self.drain()
+        self.logger.info("%d readings uploaded to WOW, %d waiting", len(uploaded),
+                         len(self.queue))
+        for station_id, stats in self.queue.stats().items():
+            self.logger.info("WOW station %s: %s", station_id, stats)
+
+    def run(self, interval=0, upload=False):
+        # interval 0 - one pass, otherwise every interval seconds until
+        # interrupted
+        try:
+            while True:
+                started = time.monotonic()
+                self.run_once(upload)
+                if interval <= 0:
+                    break
+                time.sleep(max(0, interval - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            self.logger.info("Stopping")
         finally:
-            if pconn is not None:
-                pconn.close()
-                self.logger.debug('PostgreSQL connection tidied up')
-    
\ No newline at end of file
+            self._executor.shutdown(wait=True)
+            if self.queue is not None:
+                self.queue.close()
@@ -0,0 +1,108 @@
+import time
+import logging
+from datetime import timedelta, timezone
+
+import psycopg2
+
+from classes.databasePool import get_pool
+
+ROLLUP_COLUMNS = ('station_id, bucket, readings, temperature_min, temperature_max, '
+                  'temperature_avg, wind_gust_max, wind_gust_dir, rain, bar_avg, '
+                  'battery_min')
+
+# every (station, UTC hour) with readings in a time range - fed to
+# weather_rollup_refresh() (sql/003_weather_rollup.sql)
+REFRESH_QUERY = (
+    'SELECT weather_rollup_refresh(array_agg(b.station_id), array_agg(b.bucket)) '
+    'FROM (SELECT DISTINCT station_id, '
+    '      date_trunc(\'hour\', reading_time AT TIME ZONE \'UTC\') AS bucket '
+    '      FROM weather_reading '
+    '      WHERE reading_time >= %(since)s AND reading_time < %(until)s '
+    '      AND (%(all)s OR station_id = ANY(%(stations)s))) b')
+
+
+class weatherRollup(object):
+
+    # Reads, and rebuilds, the hourly / daily rollups of weather_reading.
+    # Day to day they are kept up to date by triggers as readings are
+    # inserted - rebuild() is for history from before the triggers and
+    # after anything that bypassed them (deletes, bulk loads)
+
+    def __init__(self, **postgres_params):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising weatherRollup object")
+
+        self.pool = get_pool(**postgres_params)
+
+        self.logger.debug("weatherRollup initialised")
+
+    def history(self):
+        # (first, last) reading_time in weather_reading
+        with self.pool.connection() as pconn:
+            pcur = pconn.cursor()
+            pcur.execute("SELECT min(reading_time), max(reading_time) FROM weather_reading")
+            first, last = pcur.fetchone()
+            pcur.close()
+        return first, last
+
+    def rebuild(self, since=None, until=None, stations=None, chunk_days=1):
+        # Re-aggregates [since, until) a chunk at a time, committing after
+        # each so a long backfill holds no locks for long and can be
+        # stopped and restarted. Chunks are whole UTC days. Returns the
+        # number of chunks
+        if since is None or until is None:
+            first, last = self.history()
+            if first is None:
+                self.logger.info("No readings to roll up")
+                return 0
+            since = since or first
+            until = until or last + timedelta(seconds=1)
+
+        day = since.astimezone(timezone.utc).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        step = timedelta(days=int(chunk_days))
+
+        chunks = 0
+        while day < until:
+            end = min(day + step, until)
+            started = time.monotonic()
+            try:
+                with self.pool.connection() as pconn:
+                    pcur = pconn.cursor()
+                    pcur.execute(REFRESH_QUERY, {
+                        'since': max(day, since), 'until': end,
+                        'all': stations is None, 'stations': list(stations or [])})
+                    pconn.commit()
+                    pcur.close()
+            except (Exception, psycopg2.DatabaseError) as error:
+                self.logger.error("PostgreSQL error")
+                self.logger.error(error)
+                raise
+
+            chunks += 1
+            self.logger.info("Rolled up %s to %s in %.1fs", day.date(), end,
+                             time.monotonic() - started)
+            day = end
+
+        return chunks
+
+    def _fetch(self, table, station_id, since, until):
+        with self.pool.connection() as pconn:
+            pcur = pconn.cursor()
+            pcur.execute("SELECT " + ROLLUP_COLUMNS + " FROM " + table + " "
+                         "WHERE station_id = %s AND bucket >= %s AND bucket < %s "
+                         "ORDER BY bucket", (station_id, since, until))
+            columns = [column[0] for column in pcur.description]
+            rows = [dict(zip(columns, row)) for row in pcur.fetchall()]
+            pcur.close()
+        return rows
+
+    def hourly(self, station_id, since, until):
+        # since / until are naive UTC datetimes
+        return self._fetch('weather_reading_hourly', station_id, since, until)
+
+    def daily(self, station_id, since, until):
+        # since / until are dates (UTC)
+        return self._fetch('weather_reading_daily', station_id, since, until)
@@ -0,0 +1,149 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+
+class wowUploadQueue(object):
+
+    # Persistent queue of WOW uploads keyed by (station, reading_time), with
+    # per station upload statistics (sqlite). Uploads for a station go
+    # strictly in reading_time order - a failed one is retried with backoff
+    # before anything newer for that station is sent
+
+    def __init__(self, path, max_backoff=3600):
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.debug("initialising wowUploadQueue object")
+
+        self.path = path
+        self.max_backoff = float(max_backoff)  # seconds
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS upload ("
+                           "station_id INTEGER NOT NULL, "
+                           "reading_time TEXT NOT NULL, "
+                           "fields TEXT NOT NULL, "
+                           "rain TEXT NOT NULL DEFAULT '0', "
+                           "queued REAL NOT NULL, "
+                           "attempts INTEGER NOT NULL DEFAULT 0, "
+                           "next_attempt REAL NOT NULL DEFAULT 0, "
+                           "last_error TEXT, "
+                           "PRIMARY KEY (station_id, reading_time))")
+        # queues from before the rain (mm, as text so it stays exact) was kept
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(upload)")]
+        if 'rain' not in columns:
+            self._conn.execute("ALTER TABLE upload ADD COLUMN rain TEXT NOT NULL DEFAULT '0'")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS station_stats ("
+                           "station_id INTEGER PRIMARY KEY, "
+                           "uploaded INTEGER NOT NULL DEFAULT 0, "
+                           "failed INTEGER NOT NULL DEFAULT 0, "
+                           "latency_total REAL NOT NULL DEFAULT 0, "
+                           "latency_max REAL NOT NULL DEFAULT 0, "
+                           "last_success REAL, "
+                           "last_error TEXT)")
+
+        self.logger.debug("wowUploadQueue initialised - %d uploads waiting in %s",
+                          len(self), path)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM upload").fetchone()[0]
+
+    def add(self, station_id, reading_time, fields, rain=0):
+        # reading_time is an ISO string, rain the mm in fields - ignored if
+        # already queued
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO upload "
+                               "(station_id, reading_time, fields, rain, queued) "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               (station_id, reading_time,
+                                json.dumps(fields, default=str), str(rain or 0),
+                                time.time()))
+
+    def last_queued(self):
+        # {station id: newest queued reading_time}
+        with self._lock:
+            return dict(self._conn.execute(
+                "SELECT station_id, max(reading_time) FROM upload GROUP BY station_id"))
+
+    def due(self):
+        # the oldest upload for each station, if it is not backing off
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT u.station_id, u.reading_time, u.fields, u.rain FROM upload u "
+                "WHERE u.reading_time = (SELECT min(reading_time) FROM upload "
+                "                        WHERE station_id = u.station_id) "
+                "AND u.next_attempt <= ? ORDER BY u.station_id",
+                (time.time(),)).fetchall()
+        return [(station_id, reading_time, json.loads(fields), rain)
+                for station_id, reading_time, fields, rain in rows]
+
+    def _stats_row(self, station_id):
+        self._conn.execute("INSERT OR IGNORE INTO station_stats (station_id) "
+                           "VALUES (?)", (station_id,))
+
+    def done(self, station_id, reading_time, latency):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM upload WHERE station_id = ? "
+                               "AND reading_time = ?", (station_id, reading_time))
+            self._stats_row(station_id)
+            self._conn.execute("UPDATE station_stats SET uploaded = uploaded + 1, "
+                               "latency_total = latency_total + ?, "
+                               "latency_max = max(latency_max, ?), "
+                               "last_success = ? WHERE station_id = ?",
+                               (latency, latency, time.time(), station_id))
+            self._conn.execute("COMMIT")
+
+    def failed(self, station_id, reading_time, error):
+        # retry after 1, 2, 4... minutes, up to max_backoff
+        with self._lock:
+            self._conn.execute("BEGIN")
+            attempts = self._conn.execute(
+                "SELECT attempts FROM upload WHERE station_id = ? AND reading_time = ?",
+                (station_id, reading_time)).fetchone()[0] + 1
+            delay = min(60 * 2 ** (attempts - 1), self.max_backoff)
+            self._conn.execute("UPDATE upload SET attempts = ?, next_attempt = ?, "
+                               "last_error = ? WHERE station_id = ? AND reading_time = ?",
+                               (attempts, time.time() + delay, str(error),
+                                station_id, reading_time))
+            self._stats_row(station_id)
+            self._conn.execute("UPDATE station_stats SET failed = failed + 1, "
+                               "last_error = ? WHERE station_id = ?",
+                               (str(error), station_id))
+            self._conn.execute("COMMIT")
+        return delay
+
+    def stats(self):
+        # {station id: {...}} - waiting uploads and upload history
+        with self._lock:
+            waiting = dict(self._conn.execute(
+                "SELECT station_id, count(*) FROM upload GROUP BY station_id"))
+            rows = self._conn.execute(
+                "SELECT station_id, uploaded, failed, latency_total, latency_max, "
+                "last_success, last_error FROM station_stats").fetchall()
+
+        stats = {}
+        for station_id, uploaded, failed, latency_total, latency_max, last_success, last_error in rows:
+            stats[station_id] = {
+                'waiting': waiting.pop(station_id, 0),
+                'uploaded': uploaded,
+                'failed': failed,
+                'latency_avg_ms': round(latency_total / uploaded * 1000) if uploaded else 0,
+                'latency_max_ms': round(latency_max * 1000),
+                'last_success': last_success,
+                'last_error': last_error
+            }
+        for station_id, count in waiting.items():
+            stats[station_id] = {'waiting': count, 'uploaded': 0, 'failed': 0}
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
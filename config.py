@@ -1,71 +1,34 @@
 #!/usr/bin/env python3
-from configparser import ConfigParser
 
-def config(filename='database.ini', section='postgresql'):
-    # create a parser
-    parser = ConfigParser()
-    # read config file
-    parser.read(filename)
+# The functions here are kept for the scripts that use them - they all read
+# through the one cached, validated config per file (see
+# classes/basestationConfig.py), so the file is only parsed once however
+# many sections are asked for, and BASESTATION_<SECTION>_<KEY> environment
+# variables override it
+from classes.basestationConfig import get_config
 
-    # get section, default to postgresql
-    db = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            db[param[0]] = param[1]
-    else:
-        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
 
-    return db
+def config(filename='database.ini', section='postgresql'):
+    return get_config(filename).section(section)
 
 def config_new(filename='config.ini', section='postgresql'):
-    # create a parser
-    parser = ConfigParser()
-    # read config file
-    parser.read(filename)
-
-    # get section, default to postgresql
-    db = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            db[param[0]] = param[1]
-    else:
-        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
-
-    return db
+    return get_config(filename).section(section)
 
 def config_mqtt(filename='config.ini', section='mqtt'):
-    # create a parser
-    parser = ConfigParser()
-    # read config file
-    parser.read(filename)
-
-    # get section, default to postgresql
-    mqtt = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            mqtt[param[0]] = param[1]
-    else:
-        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
-
-    return mqtt
+    return get_config(filename).section(section)
 
-def config_wow(filename='config.ini', section='wow'): 
-    # create a parser
-    parser = ConfigParser()
-    # read config file
-    parser.read(filename)
+def config_mqtt_apps(filename='config.ini', section='mqtt'):
+    # [mqtt] plus one [mqtt:<name>] section for each extra TTN application
+    # to listen to. Anything not set in an extra section (broker address,
+    # port...) is taken from [mqtt]
+    return get_config(filename).mqtt_apps(section)
 
-    # get section, default to postgresql
-    wow = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            wow[param[0]] = param[1]
-    else:
-        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
+def config_wow(filename='config.ini', section='wow'):
+    return get_config(filename).section(section)
 
-    return wow
 
+def config_ingest(filename='config.ini', section='ingest'):
+    # optional section - tuning for the listener. Defaults (in
+    # basestationConfig.SCHEMA) are used for anything missing, and the
+    # numbers come back as ints / floats
+    return get_config(filename).typed(section)
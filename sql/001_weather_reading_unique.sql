@@ -0,0 +1,19 @@
+-- One reading per station per time. Lets replays (basestation_mqtt.py
+-- --action P) upsert with ON CONFLICT (station_id, reading_time), and is
+-- the index the WOW queries on (station_id, reading_time) use.
+--
+-- Any duplicates already in the table are removed first, keeping the
+-- first row inserted.
+
+BEGIN;
+
+DELETE FROM weather_reading a
+      USING weather_reading b
+      WHERE a.station_id = b.station_id
+        AND a.reading_time = b.reading_time
+        AND a.ctid > b.ctid;
+
+CREATE UNIQUE INDEX IF NOT EXISTS weather_reading_station_time_key
+    ON weather_reading (station_id, reading_time);
+
+COMMIT;
@@ -0,0 +1,65 @@
+-- Running total of rain since each station's last WOW upload, so the
+-- uploaders read rainin from weather_station instead of summing
+-- weather_reading. Kept up to date by triggers as readings are inserted or
+-- their rain_since_last corrected; the uploaders take off the rain they sent
+-- when they move wow_last_upload. A station that has never uploaded counts
+-- all of its rain.
+--
+-- The (station_id, reading_time) index these queries rely on is added by
+-- 001_weather_reading_unique.sql. Needs PostgreSQL 10 or later.
+
+BEGIN;
+
+ALTER TABLE weather_station
+    ADD COLUMN IF NOT EXISTS wow_rain_pending numeric NOT NULL DEFAULT 0;
+
+-- seed from what is already there
+UPDATE weather_station s
+   SET wow_rain_pending = coalesce(
+       (SELECT sum(r.rain_since_last) FROM weather_reading r
+         WHERE r.station_id = s.id
+           AND (s.wow_last_upload IS NULL OR r.reading_time > s.wow_last_upload)), 0);
+
+CREATE OR REPLACE FUNCTION weather_reading_rain_pending() RETURNS trigger AS $$
+BEGIN
+    UPDATE weather_station s
+       SET wow_rain_pending = s.wow_rain_pending + n.rain
+      FROM (SELECT r.station_id, sum(r.rain_since_last) AS rain
+              FROM new_rows r
+              JOIN weather_station ws ON ws.id = r.station_id
+             WHERE ws.wow_last_upload IS NULL OR r.reading_time > ws.wow_last_upload
+             GROUP BY r.station_id) n
+     WHERE s.id = n.station_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS weather_reading_rain_pending ON weather_reading;
+CREATE TRIGGER weather_reading_rain_pending
+    AFTER INSERT ON weather_reading
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE weather_reading_rain_pending();
+
+-- a reading re-sent with different rain replaces the old value, so apply
+-- the difference (transition tables can't be used with UPDATE OF, hence
+-- per row)
+CREATE OR REPLACE FUNCTION weather_reading_rain_changed() RETURNS trigger AS $$
+BEGIN
+    UPDATE weather_station s
+       SET wow_rain_pending = s.wow_rain_pending
+                              + coalesce(NEW.rain_since_last, 0)
+                              - coalesce(OLD.rain_since_last, 0)
+     WHERE s.id = NEW.station_id
+       AND (s.wow_last_upload IS NULL OR NEW.reading_time > s.wow_last_upload);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS weather_reading_rain_changed ON weather_reading;
+CREATE TRIGGER weather_reading_rain_changed
+    AFTER UPDATE OF rain_since_last ON weather_reading
+    FOR EACH ROW
+    WHEN (OLD.rain_since_last IS DISTINCT FROM NEW.rain_since_last)
+    EXECUTE PROCEDURE weather_reading_rain_changed();
+
+COMMIT;
@@ -0,0 +1,137 @@
+-- Hourly and daily rollups of weather_reading per station, so dashboards
+-- and exports do not have to aggregate the raw readings.
+--
+-- Buckets are UTC (bucket is the start of the hour / the UTC date). They
+-- are kept up to date by statement level triggers on weather_reading: the
+-- hours a statement touched are re-aggregated from weather_reading, then
+-- the days from the hours. Re-aggregating rather than adding on means
+-- upserts and replays (basestation_mqtt.py --action P) are handled too.
+--
+-- History is filled in with basestation_rollup.py, which calls
+-- weather_rollup_refresh() a day at a time. Needs PostgreSQL 10 or later.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS weather_reading_hourly (
+    station_id      integer NOT NULL,
+    bucket          timestamp NOT NULL,  -- UTC
+    readings        integer NOT NULL,
+    temperature_min numeric,
+    temperature_max numeric,
+    temperature_avg numeric,
+    temperature_n   integer NOT NULL,    -- readings with a temperature
+    wind_gust_max   numeric,
+    wind_gust_dir   integer,             -- direction of wind_gust_max
+    rain            numeric,             -- sum of rain_since_last
+    bar_avg         numeric,             -- bar_corrected
+    bar_n           integer NOT NULL,
+    battery_min     numeric,
+    PRIMARY KEY (station_id, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS weather_reading_daily (
+    station_id      integer NOT NULL,
+    bucket          date NOT NULL,       -- UTC
+    readings        integer NOT NULL,
+    temperature_min numeric,
+    temperature_max numeric,
+    temperature_avg numeric,
+    temperature_n   integer NOT NULL,
+    wind_gust_max   numeric,
+    wind_gust_dir   integer,
+    rain            numeric,
+    bar_avg         numeric,
+    bar_n           integer NOT NULL,
+    battery_min     numeric,
+    PRIMARY KEY (station_id, bucket)
+);
+
+-- Re-aggregate the given (station, UTC hour) buckets, and the days they
+-- fall in. The two arrays are read in step
+CREATE OR REPLACE FUNCTION weather_rollup_refresh(stations integer[], hours timestamp[])
+RETURNS void AS $$
+BEGIN
+    INSERT INTO weather_reading_hourly
+    SELECT r.station_id, b.bucket, count(*),
+           min(r.temperature), max(r.temperature), avg(r.temperature),
+           count(r.temperature),
+           max(r.wind_gust),
+           (array_agg(r.wind_gust_dir ORDER BY r.wind_gust DESC NULLS LAST))[1],
+           sum(r.rain_since_last),
+           avg(r.bar_corrected), count(r.bar_corrected),
+           min(r.battery)
+      FROM (SELECT DISTINCT * FROM unnest(stations, hours) AS u(station_id, bucket)) b
+      JOIN weather_reading r
+        ON r.station_id = b.station_id
+       AND r.reading_time >= b.bucket AT TIME ZONE 'UTC'
+       AND r.reading_time < (b.bucket + interval '1 hour') AT TIME ZONE 'UTC'
+     GROUP BY r.station_id, b.bucket
+        ON CONFLICT (station_id, bucket) DO UPDATE SET
+           readings = EXCLUDED.readings,
+           temperature_min = EXCLUDED.temperature_min,
+           temperature_max = EXCLUDED.temperature_max,
+           temperature_avg = EXCLUDED.temperature_avg,
+           temperature_n = EXCLUDED.temperature_n,
+           wind_gust_max = EXCLUDED.wind_gust_max,
+           wind_gust_dir = EXCLUDED.wind_gust_dir,
+           rain = EXCLUDED.rain,
+           bar_avg = EXCLUDED.bar_avg,
+           bar_n = EXCLUDED.bar_n,
+           battery_min = EXCLUDED.battery_min;
+
+    INSERT INTO weather_reading_daily
+    SELECT h.station_id, b.bucket, sum(h.readings),
+           min(h.temperature_min), max(h.temperature_max),
+           sum(h.temperature_avg * h.temperature_n) / nullif(sum(h.temperature_n), 0),
+           sum(h.temperature_n),
+           max(h.wind_gust_max),
+           (array_agg(h.wind_gust_dir ORDER BY h.wind_gust_max DESC NULLS LAST))[1],
+           sum(h.rain),
+           sum(h.bar_avg * h.bar_n) / nullif(sum(h.bar_n), 0), sum(h.bar_n),
+           min(h.battery_min)
+      FROM (SELECT DISTINCT u.station_id, u.bucket::date AS bucket
+              FROM unnest(stations, hours) AS u(station_id, bucket)) b
+      JOIN weather_reading_hourly h
+        ON h.station_id = b.station_id
+       AND h.bucket >= b.bucket
+       AND h.bucket < b.bucket + 1
+     GROUP BY h.station_id, b.bucket
+        ON CONFLICT (station_id, bucket) DO UPDATE SET
+           readings = EXCLUDED.readings,
+           temperature_min = EXCLUDED.temperature_min,
+           temperature_max = EXCLUDED.temperature_max,
+           temperature_avg = EXCLUDED.temperature_avg,
+           temperature_n = EXCLUDED.temperature_n,
+           wind_gust_max = EXCLUDED.wind_gust_max,
+           wind_gust_dir = EXCLUDED.wind_gust_dir,
+           rain = EXCLUDED.rain,
+           bar_avg = EXCLUDED.bar_avg,
+           bar_n = EXCLUDED.bar_n,
+           battery_min = EXCLUDED.battery_min;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION weather_reading_rollup() RETURNS trigger AS $$
+BEGIN
+    PERFORM weather_rollup_refresh(array_agg(b.station_id), array_agg(b.bucket))
+       FROM (SELECT DISTINCT station_id,
+                    date_trunc('hour', reading_time AT TIME ZONE 'UTC') AS bucket
+               FROM new_rows) b;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- transition tables need one trigger per event
+DROP TRIGGER IF EXISTS weather_reading_rollup_insert ON weather_reading;
+CREATE TRIGGER weather_reading_rollup_insert
+    AFTER INSERT ON weather_reading
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE weather_reading_rollup();
+
+DROP TRIGGER IF EXISTS weather_reading_rollup_update ON weather_reading;
+CREATE TRIGGER weather_reading_rollup_update
+    AFTER UPDATE ON weather_reading
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE weather_reading_rollup();
+
+COMMIT;
@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+from classes.basestationConfig import basestationConfig, ENV_PREFIX
+
+
+CONFIG = """
+[postgresql]
+host = localhost
+port = 5432
+
+[mqtt]
+user = app@ttn
+password = secret
+public_tls_address = eu1.cloud.thethings.network
+public_tls_address_port = 8883
+
+[mqtt:garden]
+user = garden@ttn
+
+[wow]
+software = openaws
+upload_url = http://wow.metoffice.gov.uk/automaticreading?
+"""
+
+
+@pytest.fixture(autouse=True)
+def clean_environment(monkeypatch):
+    # settings in the environment of whoever runs the tests must not leak in
+    for variable in list(os.environ):
+        if variable.startswith(ENV_PREFIX):
+            monkeypatch.delenv(variable)
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    path = tmp_path / 'config.ini'
+    path.write_text(CONFIG)
+    return path
+
+
+def test_typed_values_and_defaults(config_file):
+    config = basestationConfig(str(config_file))
+    assert config.typed('postgresql')['port'] == 5432
+    assert config.typed('mqtt')['public_tls_address_port'] == 8883
+    # [ingest] is optional - its defaults are there without it
+    assert config.typed('ingest')['batch_size'] == 50
+    assert config.get('mqtt', 'all_devices', False) is False
+
+
+def test_missing_required_key(config_file):
+    config_file.write_text(CONFIG.replace('password = secret\n', ''))
+    with pytest.raises(Exception, match=r'\[mqtt\] password is not set'):
+        basestationConfig(str(config_file))
+
+
+def test_required_key_from_the_environment(config_file, monkeypatch):
+    config_file.write_text(CONFIG.replace('password = secret\n', ''))
+    monkeypatch.setenv('BASESTATION_MQTT_PASSWORD', 'from-env')
+    assert basestationConfig(str(config_file)).section('mqtt')['password'] == 'from-env'
+
+
+@pytest.mark.parametrize('setting, error', [
+    ('port = 5432', r'\[postgresql\] port = .five. is not a valid int'),
+    ('public_tls_address_port = 8883', r'\[mqtt\] public_tls_address_port = .five. is not a valid int'),
+])
+def test_bad_int(config_file, setting, error):
+    config_file.write_text(CONFIG.replace(setting, setting.split('=')[0] + '= five'))
+    with pytest.raises(Exception, match=error):
+        basestationConfig(str(config_file))
+
+
+def test_bad_bool(config_file):
+    config_file.write_text(CONFIG + '\n[mqtt:other]\nall_devices = maybe\n')
+    with pytest.raises(Exception, match=r"\[mqtt:other\] all_devices = 'maybe' is not a valid bool"):
+        basestationConfig(str(config_file))
+
+
+def test_bool_values(config_file):
+    config_file.write_text(CONFIG.replace('[mqtt:garden]', 'all_devices = yes\n\n[mqtt:garden]'))
+    assert basestationConfig(str(config_file)).typed('mqtt')['all_devices'] is True
+
+
+def test_environment_names_the_longest_section(config_file, monkeypatch):
+    # BASESTATION_MQTT_GARDEN_USER is [mqtt:garden] user, not [mqtt] garden_user
+    monkeypatch.setenv('BASESTATION_MQTT_GARDEN_USER', 'other@ttn')
+    config = basestationConfig(str(config_file))
+    assert config.section('mqtt:garden')['user'] == 'other@ttn'
+    assert config.section('mqtt')['user'] == 'app@ttn'
+    assert 'garden_user' not in config.section('mqtt')
+    # the extra application takes the rest from [mqtt]
+    garden = config.mqtt_apps()[1]
+    assert garden['user'] == 'other@ttn'
+    assert garden['password'] == 'secret'
+
+
+def test_reload_keeps_the_config_if_invalid(config_file):
+    config = basestationConfig(str(config_file))
+    called = []
+    config.subscribe('mqtt', called.append)
+
+    config_file.write_text(CONFIG.replace('password = secret', 'password = new')
+                           .replace('port = 5432', 'port = five'))
+    assert config.reload() is None
+    assert config.section('mqtt')['password'] == 'secret'
+    assert config.typed('postgresql')['port'] == 5432
+    assert called == []
+
+
+def test_reload_calls_subscribers_for_changed_sections(config_file):
+    config = basestationConfig(str(config_file))
+    called = {'postgresql': [], 'mqtt': [], 'wow': []}
+    for section, calls in called.items():
+        config.subscribe(section, calls.append)
+
+    # nothing changed - nobody is called
+    assert config.reload() == []
+    assert called == {'postgresql': [], 'mqtt': [], 'wow': []}
+
+    # [mqtt:garden] is covered by the mqtt subscribers, once however many
+    # mqtt sections changed
+    config_file.write_text(CONFIG.replace('password = secret', 'password = new')
+                           .replace('user = garden@ttn', 'user = new@ttn'))
+    assert config.reload() == ['mqtt', 'mqtt:garden']
+    assert called['mqtt'] == [config]
+    assert called['postgresql'] == [] and called['wow'] == []
+    assert config.section('mqtt')['password'] == 'new'
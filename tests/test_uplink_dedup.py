@@ -0,0 +1,68 @@
+import pytest
+
+from classes import uplinkDedup as dedup_module
+from classes.uplinkDedup import uplinkDedup
+
+
+def uplink(device_id='station-1', f_cnt=1, payload='AAEC'):
+    message = {'end_device_ids': {'device_id': device_id},
+               'uplink_message': {'frm_payload': payload}}
+    if f_cnt:  # TTN leaves it out when it is 0
+        message['uplink_message']['f_cnt'] = f_cnt
+    return message
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup_module.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_repeats_are_seen(clock):
+    dedup = uplinkDedup(size=10, ttl_hours=1)
+    assert not dedup.seen(uplink())
+    assert dedup.seen(uplink())
+    # another frame, device or payload (a reboot starts f_cnt again) is new
+    assert not dedup.seen(uplink(f_cnt=2))
+    assert not dedup.seen(uplink(device_id='station-2'))
+    assert not dedup.seen(uplink(payload='AAED'))
+    # f_cnt 0 is the same uplink with or without the field
+    assert not dedup.seen(uplink(f_cnt=0))
+    assert dedup.seen({'end_device_ids': {'device_id': 'station-1'},
+                       'uplink_message': {'f_cnt': 0, 'frm_payload': 'AAEC'}})
+    assert dedup.stats() == {'checked': 7, 'duplicates': 2, 'remembered': 5}
+
+
+def test_ttl_eviction(clock):
+    dedup = uplinkDedup(size=10, ttl_hours=1)
+    dedup.seen(uplink(f_cnt=1))
+    clock[0] += 1800
+    dedup.seen(uplink(f_cnt=2))
+
+    clock[0] += 1799  # the first is 3599s old
+    assert dedup.seen(uplink(f_cnt=1))
+    clock[0] += 1  # and now an hour
+    assert not dedup.seen(uplink(f_cnt=1))
+    assert dedup.seen(uplink(f_cnt=2))
+
+
+def test_size_eviction(clock):
+    dedup = uplinkDedup(size=3, ttl_hours=1)
+    for f_cnt in (1, 2, 3, 4):
+        dedup.seen(uplink(f_cnt=f_cnt))
+    assert dedup.stats()['remembered'] == 3
+    # the oldest went first
+    assert dedup.seen(uplink(f_cnt=4))
+    assert dedup.seen(uplink(f_cnt=2))
+    assert not dedup.seen(uplink(f_cnt=1))
+
+
+def test_forget(clock):
+    # an uplink that could not be written lets the next copy through
+    dedup = uplinkDedup(size=10, ttl_hours=1)
+    assert not dedup.seen(uplink())
+    dedup.forget(uplink())
+    assert not dedup.seen(uplink())
+    assert dedup.seen(uplink())
+    dedup.forget(uplink(f_cnt=9))  # never seen - nothing to do
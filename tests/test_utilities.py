@@ -0,0 +1,99 @@
+import math
+import random
+
+import pytest
+
+import utilities as convert
+
+
+# the formulas before the conversions were table driven (kph_to_mph
+# multiplied, which was the wrong way round - see test_kph_to_mph)
+def old_celsius_to_f(celsius):
+    return round((float(celsius) * 1.8) + 32, 2)
+
+def old_hpa_to_inches(hpa):
+    return round(0.02953 * float(hpa), 4)
+
+def old_mm_to_inches(mm):
+    return round(float(mm) * 0.0393701, 4)
+
+def old_limit_percent(percent):
+    return round(100.00, 2) if percent > 100 else round(percent, 2)
+
+
+@pytest.fixture
+def values():
+    rng = random.Random(1)
+    return [rng.uniform(-40, 1100) for n in range(10000)]
+
+
+@pytest.mark.parametrize('new, old', [
+    (convert.celsius_to_f, old_celsius_to_f),
+    (convert.hpa_to_inches, old_hpa_to_inches),
+    (convert.mm_to_inches, old_mm_to_inches),
+    (convert.limit_percent, old_limit_percent),
+])
+def test_scalar_matches_old_formula(values, new, old):
+    for value in values:
+        assert new(value) == old(value)
+
+
+def test_kph_to_mph():
+    # 1 mile is 1.609344 km - the old code multiplied
+    assert convert.kph_to_mph(1.609344) == 1.0
+    assert convert.kph_to_mph(100) == 62.14
+    assert convert.convert(62.14, 'mph', 'kph') == 100.0
+
+
+@pytest.mark.parametrize('units', list(convert.CONVERSIONS))
+def test_array_matches_scalar(values, units):
+    np = pytest.importorskip('numpy')
+    column = convert.convert(np.array(values), *units)
+    assert isinstance(column, np.ndarray)
+    assert column.tolist() == [convert.convert(value, *units) for value in values]
+    # lists are columns too
+    assert convert.convert(values, *units).tolist() == column.tolist()
+
+
+@pytest.mark.parametrize('units', list(convert.CONVERSIONS))
+def test_array_rounding_on_a_half(units):
+    np = pytest.importorskip('numpy')
+    # readings are sent with few decimals, so many land on an exact half -
+    # numpy may round those the other way, by one in the last decimal
+    values = [n / 1000 for n in range(-40000, 110000, 7)]
+    decimals = convert.CONVERSIONS[units][2]
+    np.testing.assert_allclose(convert.convert(values, *units),
+                               [convert.convert(value, *units) for value in values],
+                               rtol=0, atol=1.001 * 10 ** -decimals)
+
+
+def test_none_in_list_is_nan():
+    pytest.importorskip('numpy')
+    column = convert.convert([10.0, None, 20.0], 'celsius', 'fahrenheit')
+    assert column[0] == 50.0
+    assert math.isnan(column[1])
+    assert column[2] == 68.0
+
+
+def test_limit_percent_array():
+    np = pytest.importorskip('numpy')
+    column = convert.limit_percent(np.array([50.123, 100.0, 104.7, None], dtype=float))
+    assert column[:3].tolist() == [50.12, 100.0, 100.0]
+    assert math.isnan(column[3])
+    assert convert.limit_percent([99.999, 120]).tolist() == [100.0, 100.0]
+
+
+@pytest.mark.parametrize('units', list(convert.CONVERSIONS))
+def test_list_without_numpy(monkeypatch, values, units):
+    # lists are still columns - converted value by value, as a list
+    monkeypatch.setattr(convert, 'np', None)
+    assert convert.convert(values, *units) == [convert.convert(value, *units) for value in values]
+    assert convert.convert(tuple(values[:3]), *units) == convert.convert(values[:3], *units)
+    assert math.isnan(convert.convert([None], *units)[0])
+
+
+def test_limit_percent_list_without_numpy(monkeypatch):
+    monkeypatch.setattr(convert, 'np', None)
+    column = convert.limit_percent([50.123, 100.0, 104.7, None])
+    assert column[:3] == [50.12, 100.0, 100.0]
+    assert math.isnan(column[3])
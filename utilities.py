@@ -1,21 +1,71 @@
+import math
+
+try:
+    import numpy as np
+except ImportError:  # only needed to convert arrays
+    np = None
+
+# Unit conversions, keyed by (from_unit, to_unit). Each is
+#   value * factor + offset, rounded to decimals
+# and works on a single value or a whole column (list / numpy array) at a
+# time. Single values give the same results as round() always has; arrays
+# are rounded with numpy, which can differ in the last decimal on an exact
+# half. Without numpy a list / tuple column comes back as a list, converted
+# value by value
+CONVERSIONS = {}
+
+
+def register(from_unit, to_unit, factor, offset=0.0, decimals=2):
+    CONVERSIONS[(from_unit, to_unit)] = (factor, offset, decimals)
+
+
+register('kph', 'mph', 1 / 1.609344)
+register('mph', 'kph', 1.609344)
+register('celsius', 'fahrenheit', 1.8, 32)
+register('fahrenheit', 'celsius', 1 / 1.8, -32 / 1.8)
+register('hpa', 'inhg', 0.02953, decimals=4)
+register('mm', 'in', 0.0393701, decimals=4)
+
+
+def _is_column(value):
+    return isinstance(value, (list, tuple)) or \
+        (np is not None and isinstance(value, np.ndarray))
+
+
+def _floats(column):
+    return [math.nan if value is None else float(value) for value in column]
+
+
+def convert(value, from_unit, to_unit):
+    # e.g. convert(12.5, 'kph', 'mph'), or convert(column, 'kph', 'mph')
+    # for a list / array - None in a list becomes nan
+    factor, offset, decimals = CONVERSIONS[(from_unit, to_unit)]
+    if _is_column(value):
+        if np is None:
+            return [round(value * factor + offset, decimals) for value in _floats(value)]
+        return np.round(np.asarray(value, dtype=float) * factor + offset, decimals)
+    return round(float(value) * factor + offset, decimals)
+
+
 def kph_to_mph (kph):
-    mph = float(kph) * 1.609344
-    return round(mph,2)
+    return convert(kph, 'kph', 'mph')
 
 def celsius_to_f (celsius):
-    f = (float(celsius) * 1.8) + 32
-    return round(f,2)
+    return convert(celsius, 'celsius', 'fahrenheit')
 
 def limit_percent (percent):
+    if _is_column(percent):
+        if np is None:
+            return [value if math.isnan(value) else round(min(value, 100.0), 2)
+                    for value in _floats(percent)]
+        return np.round(np.minimum(np.asarray(percent, dtype=float), 100.0), 2)
     if percent > 100:
         return round(100.00,2)
     else:
-        return round(percent,2) 
+        return round(percent,2)
 
 def hpa_to_inches (hpa):
-    inches = 0.02953 * float(hpa)
-    return round(inches,4)
+    return convert(hpa, 'hpa', 'inhg')
 
 def mm_to_inches (mm):
-    inches = float(mm) * 0.0393701
-    return round(inches,4)
\ No newline at end of file
+    return convert(mm, 'mm', 'in')